@@ -1,44 +1,215 @@
 import os
-import logging
+import weakref
 from datetime import timedelta
+
+import click
 from flask import Flask
+from flask.cli import with_appcontext
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-
-# create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
-app.permanent_session_lifetime = timedelta(minutes=15)
-
-# configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///vehicle_marketplace.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-
-# Upload folder for vehicle images
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-
-# Import and initialize db
-from models import db
-db.init_app(app)
-
-# Apply proxy fix
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Initialize database and create admin user
-with app.app_context():
-    # Create all tables
-    db.create_all()
-    
-    # Create admin user if not exists
-    from models import Admin
+from database import (analytics_is_separate, configure_engines, copy_analytics_tables, tune_sqlite_engines,
+                      watch_replica_engine)
+from logging_config import configure_logging
+from models import db, ANALYTICS_BIND
+
+# Apps built in this process, for the fork handler below
+_apps = weakref.WeakSet()
+
+
+def create_app(test_config=None):
+    """Application factory.
+
+    Building the app only wires configuration and extensions; it never touches
+    the database. Schema creation and the admin bootstrap live in the
+    ``flask init-db`` command so that gunicorn workers (with or without
+    ``--preload``) start without racing on ``create_all``.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+    app.permanent_session_lifetime = timedelta(minutes=15)
+
+    # configure the database
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///vehicle_marketplace.db")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+
+    # Upload folder for vehicle images
+    app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+
+    # Where uploads are stored and how they are served:
+    # UPLOAD_STORAGE=local (this node's UPLOAD_FOLDER) or s3 (any S3-compatible bucket).
+    # UPLOAD_SERVE_MODE=static, x-accel-redirect or x-sendfile (local storage only).
+    app.config['UPLOAD_STORAGE'] = os.environ.get("UPLOAD_STORAGE", "local")
+    app.config['UPLOAD_SERVE_MODE'] = os.environ.get("UPLOAD_SERVE_MODE", "static")
+    app.config['UPLOAD_ACCEL_PREFIX'] = os.environ.get("UPLOAD_ACCEL_PREFIX", "/protected-uploads/")
+    for key in ('S3_BUCKET', 'S3_ENDPOINT_URL', 'S3_REGION', 'S3_ACCESS_KEY_ID', 'S3_SECRET_ACCESS_KEY', 'S3_PUBLIC_URL'):
+        app.config[key] = os.environ.get(key)
+
+    # Browser-side resizing of photos before upload, and the server-side limits
+    app.config['IMAGE_MAX_DIMENSION'] = int(os.environ.get("IMAGE_MAX_DIMENSION", 1600))
+    app.config['IMAGE_QUALITY'] = float(os.environ.get("IMAGE_QUALITY", 0.8))
+    app.config['IMAGE_FORMAT'] = os.environ.get("IMAGE_FORMAT", "webp")  # webp (falls back to jpeg) or jpeg
+    app.config['IMAGE_MAX_UPLOAD_DIMENSION'] = int(os.environ.get("IMAGE_MAX_UPLOAD_DIMENSION", 2560))
+    app.config['IMAGE_MAX_UPLOAD_BYTES'] = int(os.environ.get("IMAGE_MAX_UPLOAD_BYTES", 4 * 1024 * 1024))
+
+    # Orphaned upload cleanup: a background sweep runs when an interval is set
+    app.config['UPLOAD_GC_INTERVAL_SECONDS'] = int(os.environ.get("UPLOAD_GC_INTERVAL_SECONDS", 0))
+    app.config['UPLOAD_GC_GRACE_HOURS'] = float(os.environ.get("UPLOAD_GC_GRACE_HOURS", 24))
+    app.config['UPLOAD_GC_DRY_RUN'] = os.environ.get("UPLOAD_GC_DRY_RUN", "").lower() in ("1", "true", "yes")
+
+    # Admission control for unauthenticated write endpoints. RATE_LIMIT_STORAGE is
+    # "memory" (per worker), "sqlite" (instance/rate_limits.sqlite3, shared by the
+    # workers of a host) or the path of a SQLite file.
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() not in ("0", "false", "no")
+    app.config['RATE_LIMIT_STORAGE'] = os.environ.get("RATE_LIMIT_STORAGE", "memory")
+
+    # Seconds between incremental loads of new view/click events into the funnel store
+    app.config['FUNNEL_REFRESH_SECONDS'] = float(os.environ.get("FUNNEL_REFRESH_SECONDS", 30))
+
+    # Seconds between syncs of the duplicate-listing index with other workers' changes
+    app.config['DUPLICATE_INDEX_REFRESH_SECONDS'] = float(os.environ.get("DUPLICATE_INDEX_REFRESH_SECONDS", 60))
+
+    # Seconds between syncs of the price estimator with other workers' changes
+    app.config['PRICE_ESTIMATOR_REFRESH_SECONDS'] = float(os.environ.get("PRICE_ESTIMATOR_REFRESH_SECONDS", 60))
+
+    # New-listing alerts for saved searches. ALERT_SENDER is "log" (messages only
+    # written to the log) or "twilio" (SMS, or WhatsApp with a "whatsapp:" sender).
+    app.config['ALERT_SENDER'] = os.environ.get("ALERT_SENDER", "log")
+    app.config['TWILIO_ACCOUNT_SID'] = os.environ.get("TWILIO_ACCOUNT_SID")
+    app.config['TWILIO_AUTH_TOKEN'] = os.environ.get("TWILIO_AUTH_TOKEN")
+    app.config['TWILIO_FROM_NUMBER'] = os.environ.get("TWILIO_FROM_NUMBER")
+    app.config['ALERT_DELIVERY_INTERVAL_SECONDS'] = float(os.environ.get("ALERT_DELIVERY_INTERVAL_SECONDS", 30))
+
+    # Proxy hops whose X-Forwarded-For is trusted (see ProxyFix below). Must equal
+    # the number of proxies in front of the app: fewer makes every client share the
+    # proxy's address (one rate-limit bucket for all), more lets clients spoof theirs.
+    app.config['PROXY_FIX_X_FOR'] = int(os.environ.get("PROXY_FIX_X_FOR", 1))
+
+    # ASGI mode (uvicorn asgi:app): threads per worker serving the routes that stay sync
+    app.config['ASGI_SYNC_THREADS'] = int(os.environ.get("ASGI_SYNC_THREADS", 10))
+
+    # Online backups of the databases and uploads (flask --app main backup). BACKUP_DIR
+    # defaults to instance/backups and should live on another volume; a scheduled
+    # snapshot is taken every BACKUP_INTERVAL_SECONDS (0 disables it) and the
+    # newest BACKUP_KEEP are kept. SQLite is copied BACKUP_PAGES_PER_STEP pages at a
+    # time with a BACKUP_STEP_PAUSE_MS pause between steps.
+    app.config['BACKUP_DIR'] = os.environ.get("BACKUP_DIR")
+    app.config['BACKUP_INTERVAL_SECONDS'] = float(os.environ.get("BACKUP_INTERVAL_SECONDS", 0))
+    app.config['BACKUP_KEEP'] = int(os.environ.get("BACKUP_KEEP", 7))
+    app.config['BACKUP_PAGES_PER_STEP'] = int(os.environ.get("BACKUP_PAGES_PER_STEP", 256))
+    app.config['BACKUP_STEP_PAUSE_MS'] = float(os.environ.get("BACKUP_STEP_PAUSE_MS", 5))
+
+    if test_config:
+        app.config.update(test_config)
+
+    # Analytics database, read replica and per-engine pool settings
+    configure_engines(app, os.environ)
+
+    configure_logging(app)
+
+    # Extensions are bound lazily: engines are only connected on first use
+    db.init_app(app)
+    tune_sqlite_engines(app)
+    watch_replica_engine(app)
+
+    import storage
+    storage.init_app(app)
+
+    import assets
+    assets.init_app(app)
+
+    # Apply proxy fix; X-Forwarded-For is trusted for PROXY_FIX_X_FOR hops so that
+    # request.remote_addr (used for tracking and rate limits) is the client's address
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'], x_proto=1, x_host=1)
+
+    import routes
+    routes.init_app(app)
+
+    import similar
+    similar.init_app(app)
+
+    import upload_gc
+    upload_gc.init_app(app)
+
+    import rate_limit
+    rate_limit.init_app(app)
+
+    import funnel
+    funnel.init_app(app)
+
+    import duplicates
+    duplicates.init_app(app)
+
+    import price_estimate
+    price_estimate.init_app(app)
+
+    import notifications
+    notifications.init_app(app)
+
+    import saved_searches
+    saved_searches.init_app(app)
+
+    import backup
+    backup.init_app(app)
+
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(copy_analytics_command)
+    app.cli.add_command(set_exchange_rate_command)
+    app.cli.add_command(gc_uploads_command)
+    app.cli.add_command(fingerprint_images_command)
+    app.cli.add_command(send_alerts_command)
+    app.cli.add_command(backup_command)
+    app.cli.add_command(verify_backup_command)
+    app.cli.add_command(restore_backup_command)
+
+    _apps.add(app)
+
+    return app
+
+
+def _dispose_engines_after_fork():
+    """Drop pooled connections inherited from the master after a fork.
+
+    With ``gunicorn --preload`` the app is built once in the master process;
+    every worker must open its own database connections instead of sharing
+    sockets with its siblings. Registered once per process; apps that were
+    garbage collected drop out of ``_apps``.
+    """
+    for app in list(_apps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+def init_db():
+    """Create all tables and the admin user if it does not exist yet"""
+    from database import schema_binds, upgrade_schema
+    from locations import backfill_vehicle_locations, sync_locality_distances
+    from models import Admin, ExchangeRate
+    from pricing import backfill_normalized_prices
+    from saved_searches import reindex_brand_terms
     from werkzeug.security import generate_password_hash
-    
+
+    db.create_all(bind_key=schema_binds())
+    upgrade_schema()
+
+    # Seed the USD rate so prices in both currencies can be compared
+    if not ExchangeRate.query.filter_by(currency='USD').first():
+        db.session.add(ExchangeRate(currency='USD', rate_to_ars=float(os.environ.get("USD_ARS_RATE", 1000))))
+        db.session.commit()
+    backfill_normalized_prices()
+
+    sync_locality_distances()
+    backfill_vehicle_locations()
+    reindex_brand_terms()
+
     admin = Admin.query.first()
     if not admin:
         admin_password = os.environ.get("ADMIN_PASSWORD", "DiegoPortaz7")
@@ -48,10 +219,162 @@ with app.app_context():
         )
         db.session.add(admin)
         db.session.commit()
-        logging.info("Admin user created with password: " + admin_password)
+        return True
+    return False
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create the database schema and the initial admin user."""
+    created_admin = init_db()
+    click.echo('Database initialized.')
+    if created_admin:
+        click.echo('Admin user created.')
+
+
+@click.command('set-exchange-rate')
+@click.argument('currency')
+@click.argument('rate', type=float)
+@with_appcontext
+def set_exchange_rate_command(currency, rate):
+    """Set the ARS rate of CURRENCY and recompute normalized prices."""
+    from pricing import set_exchange_rate
+
+    updated = set_exchange_rate(currency.upper(), rate)
+    click.echo(f'{currency.upper()} = {rate} ARS ({updated} vehicles updated)')
+
+
+@click.command('copy-analytics')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def copy_analytics_command(batch_size):
+    """Copy tracking rows from the primary database into the analytics database."""
+    if not analytics_is_separate():
+        raise click.ClickException('ANALYTICS_DATABASE_URL is not set to a separate database.')
+    db.create_all(bind_key=ANALYTICS_BIND)
+    for table_name, total in copy_analytics_tables(batch_size).items():
+        click.echo(f'{table_name}: {total} rows copied')
+
+
+
+@click.command('gc-uploads')
+@click.option('--grace-hours', type=float, default=None,
+              help='Only delete orphaned files older than this (default: UPLOAD_GC_GRACE_HOURS).')
+@click.option('--delete', is_flag=True, help='Delete the files instead of only reporting them.')
+@with_appcontext
+def gc_uploads_command(grace_hours, delete):
+    """Report, and with --delete remove, uploads no vehicle or request references."""
+    from flask import current_app
+    from upload_gc import reconcile_uploads
+
+    if grace_hours is None:
+        grace_hours = current_app.config['UPLOAD_GC_GRACE_HOURS']
+    report = reconcile_uploads(timedelta(hours=grace_hours), dry_run=not delete)
+    click.echo(f"{report['scanned']} files scanned, {report['referenced']} referenced, "
+               f"{report['recent']} within the grace period")
+    action = 'deleted' if delete else 'reclaimable'
+    click.echo(f"{report['orphaned']} orphaned files, {report['reclaimable_bytes'] / (1024 * 1024):.1f} MB {action}")
+
+
+@click.command('fingerprint-images')
+@with_appcontext
+def fingerprint_images_command():
+    """Hash the photos of active vehicles and pending requests uploaded before duplicate detection."""
+    from duplicates import fingerprint_missing_images
+
+    report = fingerprint_missing_images()
+    click.echo(f"{report['images']} images, {report['hashed']} hashed, {report['failed']} could not be hashed")
+
+
+@click.command('send-alerts')
+@with_appcontext
+def send_alerts_command():
+    """Deliver the queued new-listing notifications now."""
+    from saved_searches import deliver_pending
+
+    totals = {'sent': 0, 'failed': 0, 'retry': 0}
+    while True:
+        report = deliver_pending()
+        for key, value in report.items():
+            totals[key] += value
+        if not report['sent']:
+            break
+    click.echo(f"{totals['sent']} sent, {totals['retry']} to retry, {totals['failed']} failed")
+
+
+@click.command('backup')
+@click.option('--keep', type=int, default=None, help='Snapshots to keep (default: BACKUP_KEEP, 0 keeps all).')
+@with_appcontext
+def backup_command(keep):
+    """Take an online snapshot of the databases and uploads without stopping the app."""
+    from flask import current_app
+    from backup import backup_folder, create_backup, prune_backups, step_settings
+
+    folder = backup_folder(current_app)
+    manifest = create_backup(folder, *step_settings(current_app))
+    for database in manifest['databases']:
+        click.echo(f"{database['bind']}: {database['file']} ({database['size'] / (1024 * 1024):.1f} MB, "
+                   f"{database['elapsed_ms'] / 1000:.1f} s)")
+    uploads = manifest['upload_report']
+    click.echo(f"uploads: {uploads['files']} files, {uploads['new_objects']} new "
+               f"({uploads['new_bytes'] / (1024 * 1024):.1f} MB copied)")
+    click.echo(f"Snapshot {manifest['path']}")
+    pruned = prune_backups(folder, current_app.config['BACKUP_KEEP'] if keep is None else keep)
+    if pruned['snapshots_removed']:
+        click.echo(f"{pruned['snapshots_removed']} old snapshots and {pruned['objects_removed']} objects removed")
+
+
+def _snapshot_path(snapshot):
+    from flask import current_app
+    from backup import backup_folder, list_snapshots
+
+    folder = backup_folder(current_app)
+    if snapshot is None:
+        snapshots = list_snapshots(folder)
+        if not snapshots:
+            raise click.ClickException(f'No snapshots in {folder}.')
+        snapshot = snapshots[-1]
+    path = snapshot if os.path.isdir(snapshot) else os.path.join(folder, snapshot)
+    if not os.path.isdir(path):
+        raise click.ClickException(f'Snapshot {snapshot} not found.')
+    return path
+
+
+def _echo_verification(report):
+    click.echo(f"{report['databases']} databases, {report['uploads']} uploads checked")
+    for problem in report['problems']:
+        click.echo(f"  {problem}", err=True)
+    if report['problems']:
+        raise click.ClickException(f"{len(report['problems'])} problems found.")
+    click.echo('OK')
+
+
+@click.command('verify-backup')
+@click.argument('snapshot', required=False)
+@with_appcontext
+def verify_backup_command(snapshot):
+    """Check a snapshot (the newest by default) against its checksums and row counts."""
+    from backup import verify_backup
+
+    _echo_verification(verify_backup(_snapshot_path(snapshot)))
+
+
+@click.command('restore-backup')
+@click.argument('snapshot')
+@click.argument('target', type=click.Path(file_okay=False))
+@with_appcontext
+def restore_backup_command(snapshot, target):
+    """Restore SNAPSHOT into the empty directory TARGET and verify the restored files."""
+    from backup import restore_backup
+
+    try:
+        report = restore_backup(_snapshot_path(snapshot), target)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    _echo_verification(report)
+    click.echo(f"Restored into {target}; stop the app before swapping the database and uploads in.")
 
-# Import routes after db is initialized
-import routes
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,228 @@
+import asyncio
+import io
+import logging
+import math
+import sys
+
+from flask import abort, jsonify, redirect, render_template, request
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from werkzeug.exceptions import HTTPException, TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.routing import RequestRedirect
+
+from app import create_app
+from database import create_async_engines
+from db_routing import REPLICA_BIND, primary_pinned, read_only, replica_available
+from models import ANALYTICS_BIND, Click, Vehicle, VehicleView
+from rate_limit import MemoryBuckets, client_key
+from routes import search_result, search_statement, whatsapp_url
+from similar import similar_vehicles
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase:
+    """Async engines with the routing rules of ``RoutingSession`` and ``read_only``"""
+
+    def __init__(self, engines):
+        self.engines = engines
+
+    async def read(self, query, replica=True):
+        """Return ``await query(session)``, on the read replica when one is available.
+
+        As with ``read_only``, a replica failure retries the query once on
+        the primary, and a client that has just written to the primary keeps
+        reading from it. The session is closed afterwards; loaded objects keep
+        their column values but must not lazy-load relationships.
+        """
+        if replica and replica_available(self.engines) and not primary_pinned():
+            try:
+                return await self._run(self.engines[REPLICA_BIND], query)
+            except DBAPIError:
+                if replica_available(self.engines):
+                    raise
+        return await self._run(self.engines[None], query)
+
+    @staticmethod
+    async def _run(engine, query):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            return await query(session)
+
+    async def record(self, model, **values):
+        """Insert one tracking row into the analytics database"""
+        async with self.engines[ANALYTICS_BIND].begin() as connection:
+            await connection.execute(insert(model).values(**values))
+
+    async def dispose(self):
+        for engine in set(self.engines.values()):
+            await engine.dispose()
+
+
+async def _admit(app, name):
+    """Async counterpart of ``rate_limited``"""
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is None:
+        return
+    key = client_key()
+    if isinstance(limiter.buckets, MemoryBuckets):
+        wait = limiter.check(name, key)
+    else:
+        # The shared SQLite store takes a file lock; keep it off the event loop
+        wait = await asyncio.to_thread(limiter.check, name, key)
+    if wait:
+        raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+
+
+def _tracking_values():
+    return {'ip_address': request.remote_addr, 'user_agent': request.headers.get('User-Agent', '')[:500]}
+
+
+async def vehicle_detail(app, database, id):
+    await _admit(app, 'vehicle_detail')
+    vehicle = await database.read(lambda session: session.get(Vehicle, id))
+    if vehicle is None:
+        abort(404)
+    await database.record(VehicleView, vehicle_id=vehicle.id, **_tracking_values())
+    # The index lookup is in memory but may sync with the database now and then
+    similar = await asyncio.to_thread(read_only(similar_vehicles), vehicle)
+    return render_template('vehicle_detail.html', vehicle=vehicle, similar_vehicles=similar)
+
+
+async def api_search(app, database):
+    search_query = request.args.get('q', '').strip()
+    if not search_query:
+        return jsonify({'vehicles': []})
+
+    async def search(session):
+        return (await session.scalars(search_statement(search_query))).all()
+
+    vehicles = await database.read(search)
+    return jsonify({'vehicles': [search_result(vehicle) for vehicle in vehicles]})
+
+
+async def track_click(app, database, vehicle_id, click_type):
+    await _admit(app, 'track_click')
+    vehicle = await database.read(lambda session: session.get(Vehicle, vehicle_id), replica=False)
+    if vehicle is None:
+        abort(404)
+    await database.record(Click, vehicle_id=vehicle_id, click_type=click_type, **_tracking_values())
+    return redirect(whatsapp_url(vehicle, click_type))
+
+
+# Endpoints served by the coroutines above; everything else stays in Flask
+ASYNC_VIEWS = {
+    'vehicle_detail': vehicle_detail,
+    'api_search': api_search,
+    'track_click': track_click,
+}
+
+
+def wsgi_environ(scope):
+    """WSGI environ of a bodiless ASGI HTTP request, for Flask's request context"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f"HTTP_{key}"
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsyncRoutes:
+    """ASGI application serving the hot public routes on async engines.
+
+    ``vehicle_detail``, ``api_search`` and ``track_click`` are matched with
+    the Flask app's own URL map and answered by coroutines, so a request
+    waiting on the database holds no thread. They run inside a regular Flask
+    request context, so templates, ``url_for``, sessions, error handlers and
+    ``after_request`` hooks behave as in the sync views. Every other request
+    (admin, forms, uploads, static files) goes to the unchanged Flask app on
+    a pool of ``ASGI_SYNC_THREADS`` threads.
+    """
+
+    def __init__(self, app):
+        from a2wsgi import WSGIMiddleware  # only needed in ASGI mode
+
+        self.app = app
+        self.wsgi = WSGIMiddleware(app, workers=app.config['ASGI_SYNC_THREADS'])
+        self.database = None
+        # ProxyFix around an app that returns its environ: the request as the Flask app sees it
+        self._proxy_fix = ProxyFix(lambda environ, start_response: environ,
+                                   x_for=app.config['PROXY_FIX_X_FOR'], x_proto=1, x_host=1)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            environ = self._proxy_fix(wsgi_environ(scope), None)
+            try:
+                endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+            except (HTTPException, RequestRedirect):
+                endpoint = None
+            view = ASYNC_VIEWS.get(endpoint)
+            if view is not None:
+                await self._send(await self._dispatch(view, environ, args), scope, send)
+                return
+        await self.wsgi(scope, receive, send)
+
+    def _database(self):
+        # Created on first use, inside the worker's event loop
+        if self.database is None:
+            self.database = AsyncDatabase(create_async_engines(self.app))
+        return self.database
+
+    async def _dispatch(self, view, environ, args):
+        app = self.app
+        with app.request_context(environ):
+            try:
+                response = app.preprocess_request()
+                if response is None:
+                    response = await view(app, self._database(), **args)
+            except HTTPException as e:
+                response = app.handle_user_exception(e)
+            except Exception as e:
+                response = app.handle_exception(e)
+            return app.process_response(app.make_response(response))
+
+    @staticmethod
+    async def _send(response, scope, send):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response.headers.to_wsgi_list()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        body = b'' if scope['method'] == 'HEAD' else response.get_data()
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.database is not None:
+                    await self.database.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = AsyncRoutes(create_app())
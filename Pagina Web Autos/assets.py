@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+from flask import request
+
+# Static files fingerprinted and precached by the service worker
+ASSET_EXTENSIONS = ('.css', '.js', '.svg')
+
+# Third-party files linked from base.html, precached next to our own
+CDN_ASSETS = (
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+    'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+)
+
+# Browser cache lifetime of a static file requested with its current hash
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def hash_assets(static_folder, exclude=('uploads',)):
+    """Short content hash of every asset under ``static_folder``, keyed by its static filename"""
+    hashes = {}
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [name for name in dirs if name not in exclude]
+        for name in files:
+            if name.endswith(ASSET_EXTENSIONS):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()[:12]
+                hashes[os.path.relpath(path, static_folder).replace(os.sep, '/')] = digest
+    return hashes
+
+
+def asset_version(hashes):
+    """Version of the deployed assets as a whole; changes whenever any of them does"""
+    digest = hashlib.sha256()
+    for filename, file_hash in sorted(hashes.items()):
+        digest.update(f"{filename}={file_hash}\n".encode())
+    for url in CDN_ASSETS:
+        digest.update(f"{url}\n".encode())
+    return digest.hexdigest()[:12]
+
+
+def init_app(app):
+    """Fingerprint static URLs with their content hash (``?v=``).
+
+    ``url_for('static', ...)`` adds the hash of the file as deployed, so a
+    changed file gets a new URL; requests carrying the current hash are
+    cacheable for a year.
+    """
+    hashes = hash_assets(app.static_folder)
+    app.extensions['asset_hashes'] = hashes
+    app.extensions['asset_version'] = asset_version(hashes)
+
+    @app.url_defaults
+    def add_asset_hash(endpoint, values):
+        if endpoint == 'static' and 'v' not in values and values.get('filename') in hashes:
+            values['v'] = hashes[values['filename']]
+
+    default_max_age = app.get_send_file_max_age
+
+    def get_send_file_max_age(filename):
+        if filename in hashes and request.args.get('v') == hashes[filename]:
+            return IMMUTABLE_MAX_AGE
+        return default_max_age(filename)
+
+    app.get_send_file_max_age = get_send_file_max_age
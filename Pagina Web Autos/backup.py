@@ -0,0 +1,474 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from database import analytics_is_separate
+from models import db, ANALYTICS_BIND
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Database pages copied per step of an SQLite online backup
+PAGES_PER_STEP = 256
+
+# Seconds slept between steps, so the copy never hogs the disk
+STEP_PAUSE = 0.005
+
+# Upload files hashed between short pauses
+UPLOAD_BATCH = 200
+
+MANIFEST = 'manifest.json'
+
+# Held by whoever writes or prunes a backup directory
+LOCK_FILE = '.lock'
+
+# Unfinished snapshots older than this are removed when pruning
+STALE_PARTIAL_SECONDS = 24 * 3600
+
+# Content-addressed upload copies, shared by every snapshot
+OBJECTS = 'objects'
+
+_READ_SIZE = 1024 * 1024
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# -- databases ----------------------------------------------------------------
+
+def _table_counts(connection):
+    names = [name for (name,) in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+    return {name: connection.execute(f'SELECT count(*) FROM "{name}"').fetchone()[0] for name in names}
+
+
+def backup_sqlite(source_path, target_path, pages=PAGES_PER_STEP, pause=STEP_PAUSE):
+    """Copy a live SQLite database with the online backup API.
+
+    In WAL mode (the app's default) a read transaction is held for the whole
+    copy: every step copies the same snapshot, so the copy is consistent and
+    never restarts, while writers keep committing to the WAL in between. The
+    row count of every table in that snapshot is recorded for verification.
+    Other journal modes are copied in a single step, which holds off writers
+    for its duration.
+    """
+    started = time.perf_counter()
+    source = sqlite3.connect(source_path, isolation_level=None, timeout=30)
+    target = sqlite3.connect(target_path)
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if pause:
+            time.sleep(pause)
+
+    try:
+        wal = source.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal'
+        if wal:
+            source.execute("BEGIN")
+            tables = _table_counts(source)  # also starts the read transaction
+        else:
+            logger.warning("Database %s is not in WAL mode; copying it in one step", source_path)
+            tables = None
+        source.backup(target, pages=pages if wal else -1, progress=progress)
+        if wal:
+            source.execute("COMMIT")
+        # A self-contained file: no -wal / -shm next to the copy
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+    return {
+        'file': os.path.basename(target_path),
+        'size': os.path.getsize(target_path),
+        'sha256': _sha256_file(target_path),
+        'tables': tables,
+        'steps': steps,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def _libpq_arguments(url):
+    """pg_dump / pg_restore connection string and environment, keeping the password out of argv"""
+    env = dict(os.environ)
+    if url.password:
+        env['PGPASSWORD'] = url.password
+    dsn = url.set(drivername='postgresql', password=None).render_as_string(hide_password=False)
+    return dsn, env
+
+
+def _run_pg_tool(arguments, env=None):
+    try:
+        return subprocess.run(arguments, env=env, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise RuntimeError(f"{arguments[0]} not found; install the PostgreSQL client tools")
+
+
+def backup_postgres(url, target_path):
+    """Dump a PostgreSQL database with ``pg_dump`` (custom format).
+
+    pg_dump reads one MVCC snapshot, so it is consistent and writers are
+    never blocked.
+    """
+    started = time.perf_counter()
+    dsn, env = _libpq_arguments(url)
+    result = _run_pg_tool(['pg_dump', '--format=custom', '--no-owner', '--file', target_path, dsn], env)
+    if result.returncode != 0:
+        raise RuntimeError(f"pg_dump failed: {result.stderr.strip()}")
+    return {
+        'file': os.path.basename(target_path),
+        'size': os.path.getsize(target_path),
+        'sha256': _sha256_file(target_path),
+        'tables': None,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def _backup_engines():
+    """(name, engine) of every database to back up: the primary and a separate analytics one"""
+    engines = [('primary', db.engines[None])]
+    if analytics_is_separate():
+        engines.append((ANALYTICS_BIND, db.engines[ANALYTICS_BIND]))
+    return engines
+
+
+# -- uploads ------------------------------------------------------------------
+
+def _object_path(backup_dir, sha256):
+    return os.path.join(backup_dir, OBJECTS, sha256[:2], sha256)
+
+
+def _store_object(backup_dir, storage, name):
+    """Copy an upload into the object store; returns (sha256, size, whether it was new)"""
+    os.makedirs(os.path.join(backup_dir, OBJECTS), exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=os.path.join(backup_dir, OBJECTS), delete=False) as output:
+        try:
+            with storage.open(name) as stream:
+                for block in iter(lambda: stream.read(_READ_SIZE), b''):
+                    digest.update(block)
+                    output.write(block)
+                    size += len(block)
+        except BaseException:
+            os.unlink(output.name)
+            raise
+    path = _object_path(backup_dir, digest.hexdigest())
+    if os.path.exists(path):
+        os.unlink(output.name)
+        return digest.hexdigest(), size, False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(output.name, path)
+    return digest.hexdigest(), size, True
+
+
+def snapshot_uploads(backup_dir, previous=None, pause=STEP_PAUSE):
+    """Record every stored upload by content hash, copying only unseen content.
+
+    Files whose size and mtime match the previous snapshot are not read
+    again; the rest are hashed while being copied, and content already in
+    the object store is not stored twice.
+    """
+    storage = get_storage()
+    previous = previous or {}
+    files = {}
+    report = {'files': 0, 'hashed': 0, 'new_objects': 0, 'new_bytes': 0}
+    for stored in storage.iter_files():
+        report['files'] += 1
+        if pause and report['files'] % UPLOAD_BATCH == 0:
+            time.sleep(pause)
+        known = previous.get(stored.name)
+        if (known and known['size'] == stored.size and known['mtime'] == stored.mtime
+                and os.path.exists(_object_path(backup_dir, known['sha256']))):
+            files[stored.name] = known
+            continue
+        try:
+            sha256, size, new = _store_object(backup_dir, storage, stored.name)
+        except Exception as e:
+            # Deleted since it was listed (e.g. by the upload cleanup)
+            logger.warning("Error copying upload %s: %s", stored.name, e, extra={'upload': stored.name})
+            continue
+        report['hashed'] += 1
+        if new:
+            report['new_objects'] += 1
+            report['new_bytes'] += size
+        files[stored.name] = {'sha256': sha256, 'size': size, 'mtime': stored.mtime}
+    return files, report
+
+
+# -- snapshots ----------------------------------------------------------------
+
+@contextmanager
+def backup_lock(backup_dir, blocking=True):
+    """Exclusive lock on ``backup_dir`` across processes; yields whether it was taken.
+
+    Backups and pruning hold it, so pruning never drops an object that a
+    backup in progress has just found in the store and relies on.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    with open(os.path.join(backup_dir, LOCK_FILE), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def list_snapshots(backup_dir):
+    """Names of the complete snapshots in ``backup_dir``, oldest first"""
+    try:
+        entries = os.listdir(backup_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in entries
+                  if not name.endswith('.partial') and os.path.isfile(os.path.join(backup_dir, name, MANIFEST)))
+
+
+def load_manifest(snapshot_path):
+    with open(os.path.join(snapshot_path, MANIFEST)) as f:
+        return json.load(f)
+
+
+def create_backup(backup_dir, pages=PAGES_PER_STEP, pause=STEP_PAUSE):
+    """Back up the databases and uploads into a new snapshot of ``backup_dir``.
+
+    The snapshot is written to ``<name>.partial`` and renamed when complete,
+    so an interrupted backup never looks like a usable one. Holds
+    ``backup_lock``. Returns the manifest, with the snapshot path under
+    ``path``.
+    """
+    with backup_lock(backup_dir):
+        return _create_backup(backup_dir, pages, pause)
+
+
+def _create_backup(backup_dir, pages, pause):
+    started = time.perf_counter()
+    name = datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+    path = os.path.join(backup_dir, name)
+    partial = path + '.partial'
+    os.makedirs(partial)
+    snapshots = list_snapshots(backup_dir)
+    previous = load_manifest(os.path.join(backup_dir, snapshots[-1]))['uploads'] if snapshots else {}
+    try:
+        databases = []
+        for bind, engine in _backup_engines():
+            backend = engine.url.get_backend_name()
+            if backend == 'sqlite':
+                info = backup_sqlite(engine.url.database, os.path.join(partial, f"{bind}.sqlite3"), pages, pause)
+            elif backend == 'postgresql':
+                info = backup_postgres(engine.url, os.path.join(partial, f"{bind}.dump"))
+            else:
+                raise ValueError(f"Backups are not supported for {backend} databases")
+            databases.append({'bind': bind, 'engine': backend, **info})
+        uploads, upload_report = snapshot_uploads(backup_dir, previous, pause)
+        manifest = {
+            'created_at': datetime.utcnow().isoformat(),
+            'databases': databases,
+            'uploads': uploads,
+            'upload_report': upload_report,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+        with open(os.path.join(partial, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(partial, path)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    logger.info("Backup created", extra={
+        'snapshot': name, 'databases': len(databases), 'uploads': upload_report['files'],
+        'new_objects': upload_report['new_objects'], 'elapsed_ms': manifest['elapsed_ms']})
+    manifest['path'] = path
+    return manifest
+
+
+def _verify_database(path, info):
+    problems = []
+    if not os.path.isfile(path):
+        return [f"{info['file']}: missing"]
+    if _sha256_file(path) != info['sha256']:
+        return [f"{info['file']}: checksum mismatch"]
+    if info['engine'] == 'sqlite':
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            result = connection.execute("PRAGMA integrity_check").fetchone()[0]
+            if result != 'ok':
+                problems.append(f"{info['file']}: integrity check failed ({result})")
+            elif info['tables'] is not None:
+                counts = _table_counts(connection)
+                for table, expected in info['tables'].items():
+                    if counts.get(table) != expected:
+                        problems.append(f"{info['file']}: {table} has {counts.get(table)} rows, "
+                                        f"{expected} when backed up")
+        finally:
+            connection.close()
+    else:
+        result = _run_pg_tool(['pg_restore', '--list', path])
+        if result.returncode != 0:
+            problems.append(f"{info['file']}: pg_restore cannot read the dump ({result.stderr.strip()})")
+    return problems
+
+
+def verify_backup(snapshot_path, uploads_folder=None):
+    """Check a snapshot (or a restore of it) against its manifest.
+
+    Database files must match their checksum; SQLite copies must also pass
+    ``integrity_check`` and hold the row counts of the backed-up snapshot,
+    and PostgreSQL dumps must be readable by ``pg_restore``. Every upload
+    must exist with its recorded hash, in the object store or, for a
+    restore, in ``uploads_folder``. Returns a report with a ``problems`` list.
+    """
+    manifest = load_manifest(snapshot_path)
+    backup_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    problems = []
+    for info in manifest['databases']:
+        problems.extend(_verify_database(os.path.join(snapshot_path, info['file']), info))
+    checked = {}
+    for name, upload in manifest['uploads'].items():
+        if uploads_folder is not None:
+            path = os.path.join(uploads_folder, name)
+        else:
+            path = _object_path(backup_dir, upload['sha256'])
+        if path not in checked:
+            checked[path] = os.path.isfile(path) and _sha256_file(path) == upload['sha256']
+        if not checked[path]:
+            problems.append(f"upload {name}: missing or corrupt")
+    return {'databases': len(manifest['databases']), 'uploads': len(manifest['uploads']), 'problems': problems}
+
+
+def restore_backup(snapshot_path, target_dir):
+    """Restore a snapshot into the empty directory ``target_dir`` and verify the result.
+
+    The database files (SQLite copies, or dumps for ``pg_restore``) and the
+    manifest go to ``target_dir``, the uploads to ``target_dir/uploads``. The
+    live database is never touched: swapping the restored files in is left
+    to the operator.
+    """
+    if os.path.exists(target_dir) and os.listdir(target_dir):
+        raise ValueError(f"{target_dir} is not empty")
+    manifest = load_manifest(snapshot_path)
+    backup_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    uploads_folder = os.path.join(target_dir, 'uploads')
+    os.makedirs(uploads_folder)
+    for info in manifest['databases']:
+        shutil.copyfile(os.path.join(snapshot_path, info['file']), os.path.join(target_dir, info['file']))
+    shutil.copyfile(os.path.join(snapshot_path, MANIFEST), os.path.join(target_dir, MANIFEST))
+    for name, upload in manifest['uploads'].items():
+        shutil.copyfile(_object_path(backup_dir, upload['sha256']),
+                        os.path.join(uploads_folder, os.path.basename(name)))
+    return verify_backup(target_dir, uploads_folder)
+
+
+def prune_backups(backup_dir, keep):
+    """Keep the ``keep`` newest snapshots and drop objects none of them references (holds ``backup_lock``)"""
+    with backup_lock(backup_dir):
+        return _prune_backups(backup_dir, keep)
+
+
+def _prune_backups(backup_dir, keep):
+    snapshots = list_snapshots(backup_dir)
+    removed = snapshots[:-keep] if keep else []
+    for name in removed:
+        shutil.rmtree(os.path.join(backup_dir, name))
+    # Leftovers of interrupted backups; recent ones may still be in progress
+    for name in os.listdir(backup_dir) if os.path.isdir(backup_dir) else ():
+        path = os.path.join(backup_dir, name)
+        if name.endswith('.partial') and os.path.getmtime(path) < time.time() - STALE_PARTIAL_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+    referenced = set()
+    for name in list_snapshots(backup_dir):
+        referenced.update(upload['sha256'] for upload in load_manifest(os.path.join(backup_dir, name))['uploads'].values())
+    deleted = 0
+    objects = os.path.join(backup_dir, OBJECTS)
+    for root, dirs, files in os.walk(objects):
+        if root == objects:
+            continue  # copies still being written
+        for name in files:
+            if name not in referenced:
+                os.remove(os.path.join(root, name))
+                deleted += 1
+    return {'snapshots_removed': len(removed), 'objects_removed': deleted}
+
+
+class BackupScheduler:
+    """Background thread that takes a snapshot every ``interval`` seconds.
+
+    One thread runs per worker process, started on its first request so it
+    survives ``gunicorn --preload``. A worker skips its turn when another
+    process holds ``backup_lock`` or has taken a snapshot recently.
+    """
+
+    def __init__(self, app, backup_dir, interval, keep):
+        self.app = app
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+        self._pid = None
+        self._guard = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._guard:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='backup-scheduler', daemon=True).start()
+
+    def _due(self):
+        snapshots = list_snapshots(self.backup_dir)
+        if not snapshots:
+            return True
+        created = datetime.fromisoformat(load_manifest(os.path.join(self.backup_dir, snapshots[-1]))['created_at'])
+        return (datetime.utcnow() - created).total_seconds() >= self.interval / 2
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with backup_lock(self.backup_dir, blocking=False) as locked:
+                    if not locked or not self._due():
+                        continue  # another process is backing up, or just did
+                    with self.app.app_context():
+                        try:
+                            _create_backup(self.backup_dir, *step_settings(self.app))
+                            _prune_backups(self.backup_dir, self.keep)
+                        finally:
+                            db.session.remove()
+            except Exception:
+                logger.exception("Scheduled backup failed")
+
+
+def step_settings(app):
+    """(pages per step, pause in seconds) of SQLite backups from the app config"""
+    return (app.config.get('BACKUP_PAGES_PER_STEP', PAGES_PER_STEP),
+            app.config.get('BACKUP_STEP_PAUSE_MS', STEP_PAUSE * 1000) / 1000)
+
+
+def backup_folder(app):
+    return app.config.get('BACKUP_DIR') or os.path.join(app.instance_path, 'backups')
+
+
+def init_app(app):
+    interval = app.config.get('BACKUP_INTERVAL_SECONDS', 0)
+    if not interval:
+        return
+    scheduler = BackupScheduler(app, backup_folder(app), interval, app.config.get('BACKUP_KEEP', 7))
+    app.extensions['backup_scheduler'] = scheduler
+    app.before_request(scheduler.ensure_started)
@@ -0,0 +1,216 @@
+"""Sync workers vs. ASGI mode benchmark.
+
+Starts the app twice with the same number of worker processes, once under
+gunicorn's sync workers (``main:app``) and once under uvicorn (``asgi:app``),
+checks that both use about the same memory, and drives each with the hot
+public routes (vehicle detail, AJAX search, WhatsApp click) at increasing
+numbers of concurrent clients. Reports throughput, latency percentiles and
+errors per level.
+
+With the default throwaway SQLite database every query is a local file
+read, so this mostly measures serving overhead; point ``--database-url`` at
+a PostgreSQL server on another host to measure the I/O-bound case the ASGI
+mode is meant for (the schema is created and seeded there).
+
+Requires the ``asgi`` extra and gunicorn. Linux only (memory is read from
+/proc).
+
+Usage (from the project directory):
+
+    python benchmarks/asgi.py [--workers 2] [--concurrency 8,64,256] [--seconds 10]
+                              [--vehicles 2000] [--database-url URL]
+"""
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+SEARCH_TERMS = ["toyota", "gol", "diesel", "2015", "ford", "automatica", "rojo", "sedan"]
+
+
+def seed(database_url, vehicles):
+    os.environ["DATABASE_URL"] = database_url
+    from app import create_app, init_db
+    from models import db, Vehicle
+
+    app = create_app({"RATE_LIMIT_ENABLED": False})
+    rng = random.Random(42)
+    brands = ["Toyota", "Ford", "Volkswagen", "Renault", "Chevrolet", "Fiat", "Peugeot"]
+    with app.app_context():
+        init_db()
+        existing = Vehicle.query.count()
+        rows = []
+        for i in range(existing, vehicles):
+            brand = rng.choice(brands)
+            rows.append({
+                "title": f"{brand} {rng.choice(['Gol', 'Corolla', 'Ka', 'Clio', 'Onix'])} {i}",
+                "description": f"Unico dueño, {rng.choice(['sedan', 'hatchback', 'pickup'])}, "
+                               f"{rng.choice(['rojo', 'gris', 'blanco'])}",
+                "price": rng.randint(5_000_000, 40_000_000), "currency": "ARS",
+                "price_ars_normalized": rng.randint(5_000_000, 40_000_000),
+                "year": rng.randint(2000, 2024), "brand": brand, "model": "",
+                "kilometers": rng.randint(0, 250_000), "fuel_type": rng.choice(["Nafta", "Diesel"]),
+                "transmission": rng.choice(["Manual", "Automática"]), "images": "[]",
+                "whatsapp_number": "+5492604000000", "is_active": True,
+            })
+        if rows:
+            db.session.execute(Vehicle.__table__.insert(), rows)
+            db.session.commit()
+        ids = [vehicle_id for (vehicle_id,) in db.session.query(Vehicle.id).filter(Vehicle.is_active == True)]
+    return ids
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, port, workers, env):
+    if kind == "sync":
+        command = [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}",
+                   "--backlog", "2048", "--log-level", "warning", "main:app"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "--workers", str(workers), "--port", str(port),
+                   "--backlog", "2048", "--log-level", "warning", "--no-access-log", "asgi:app"]
+    process = subprocess.Popen(command, cwd=PROJECT_DIR, env=env, start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError(f"{kind} server did not start")
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def tree_rss_mb(pid):
+    """Resident memory of a process and all its descendants"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+async def fetch(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nUser-Agent: bench\r\n"
+                     f"Connection: close\r\n\r\n".encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+def request_path(rng, vehicle_ids):
+    roll = rng.random()
+    if roll < 0.6:
+        return f"/vehicle/{rng.choice(vehicle_ids)}"
+    if roll < 0.9:
+        return f"/api/search?q={rng.choice(SEARCH_TERMS)}"
+    return f"/track_click/{rng.choice(vehicle_ids)}/whatsapp"
+
+
+async def load(port, vehicle_ids, concurrency, seconds):
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+
+    async def client(number):
+        nonlocal errors
+        rng = random.Random(number)
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(fetch(port, request_path(rng, vehicle_ids)), 30)
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                status = None
+            if status in (200, 302):
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(client(number) for number in range(concurrency)))
+    return latencies, errors, time.monotonic() - started
+
+
+def report(kind, concurrency, latencies, errors, elapsed):
+    if not latencies:
+        print(f"{kind:>5} c={concurrency:<4} no successful requests, {errors} errors")
+        return
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{kind:>5} c={concurrency:<4} {len(latencies) / elapsed:8.1f} req/s"
+          f"   p50 {statistics.median(latencies) * 1000:7.1f} ms   p99 {p99 * 1000:7.1f} ms   errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", default="8,64,256")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--vehicles", type=int, default=2000)
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = args.database_url or f"sqlite:///{tmp}/bench.db"
+        vehicle_ids = seed(database_url, args.vehicles)
+        env = dict(os.environ, DATABASE_URL=database_url, RATE_LIMIT_ENABLED="false", LOG_LEVEL="WARNING",
+                   UPLOAD_GC_INTERVAL_SECONDS="0", ALERT_DELIVERY_INTERVAL_SECONDS="0")
+        print(f"{len(vehicle_ids):,} vehicles, {args.workers} workers per server, {args.seconds:g} s per level")
+        for kind in ("sync", "asgi"):
+            port = free_port()
+            process = start_server(kind, port, args.workers, env)
+            try:
+                # Warm up every worker (templates, similar-vehicle index) before measuring memory
+                asyncio.run(load(port, vehicle_ids, args.workers * 4, 2))
+                print(f"{kind:>5} memory {tree_rss_mb(process.pid):7.1f} MB")
+                for concurrency in levels:
+                    report(kind, concurrency, *asyncio.run(load(port, vehicle_ids, concurrency, args.seconds)))
+            finally:
+                stop_server(process)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Online backup benchmark.
+
+Builds a throwaway SQLite database of about ``--size-mb`` (vehicles plus
+tracking rows), then serves ``/`` and ``/vehicle/<id>`` (a page that writes
+a view row) from reader and writer threads while taking backups. Reports
+the latency of both per phase: no backup, a stepped backup
+(``--pages`` per step, ``--pause-ms`` between steps) and a single-step
+backup of the same snapshot, plus the duration of each backup.
+
+Usage (from the project directory):
+
+    python benchmarks/backup.py [--size-mb 200] [--pages 256] [--pause-ms 5] [--baseline-seconds 5]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def seed(app, size_mb, vehicles=2000):
+    from app import init_db
+    from models import db, Vehicle, VehicleView
+
+    rng = random.Random(42)
+    with app.app_context():
+        init_db()
+        db.session.execute(Vehicle.__table__.insert(), [{
+            "title": f"Vehiculo {i}", "description": "Unico dueño " * 20, "price": rng.randint(5_000_000, 40_000_000),
+            "currency": "ARS", "price_ars_normalized": rng.randint(5_000_000, 40_000_000),
+            "year": rng.randint(2000, 2024), "brand": rng.choice(["Toyota", "Ford", "Fiat"]), "model": "",
+            "kilometers": rng.randint(0, 250_000), "images": "[]", "whatsapp_number": "+5492604000000",
+            "is_active": True,
+        } for i in range(vehicles)])
+        db.session.commit()
+        # Tracking rows of ~600 bytes make up the rest of the file
+        rows = size_mb * 1024 * 1024 // 600
+        agent = "Mozilla/5.0 (Linux; Android 14) " + "x" * 500
+        for start in range(0, rows, 50_000):
+            db.session.execute(VehicleView.__table__.insert(), [
+                {"vehicle_id": rng.randint(1, vehicles), "ip_address": "10.0.0.1", "user_agent": agent}
+                for _ in range(min(50_000, rows - start))])
+            db.session.commit()
+    return vehicles
+
+
+class Load:
+    """Reader and writer threads recording latencies into the current phase"""
+
+    def __init__(self, app, vehicles):
+        self.app = app
+        self.vehicles = vehicles
+        self.phase = None
+        self.samples = {}
+        self.stop = threading.Event()
+
+    def _loop(self, kind, path_for):
+        client = self.app.test_client()
+        rng = random.Random(kind)
+        while not self.stop.is_set():
+            phase = self.phase
+            started = time.perf_counter()
+            status = client.get(path_for(rng)).status_code
+            elapsed = time.perf_counter() - started
+            if phase is not None and status == 200:
+                self.samples.setdefault((phase, kind), []).append(elapsed)
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self._loop, args=("read /", lambda rng: "/"), daemon=True),
+            threading.Thread(target=self._loop, args=("write /vehicle", lambda rng: f"/vehicle/{rng.randint(1, self.vehicles)}"),
+                             daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def finish(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def report(phase, load, duration=None):
+    label = phase + (f" ({duration:.1f} s)" if duration is not None else "")
+    print(label)
+    for kind in ("read /", "write /vehicle"):
+        samples = sorted(load.samples.get((phase, kind), []))
+        if not samples:
+            print(f"  {kind:<15} no requests completed")
+            continue
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        print(f"  {kind:<15} {len(samples):6d} requests   p50 {statistics.median(samples) * 1000:7.1f} ms"
+              f"   p99 {p99 * 1000:7.1f} ms   max {samples[-1] * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=256)
+    parser.add_argument("--pause-ms", type=float, default=5)
+    parser.add_argument("--baseline-seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        from app import create_app
+        from backup import backup_sqlite
+
+        app = create_app({"RATE_LIMIT_ENABLED": False, "UPLOAD_FOLDER": os.path.join(tmp, "uploads")})
+        vehicles = seed(app, args.size_mb)
+        print(f"database {os.path.getsize(f'{tmp}/bench.db') / (1024 * 1024):.0f} MB, "
+              f"{args.pages} pages per step, {args.pause_ms:g} ms pause")
+
+        load = Load(app, vehicles)
+        load.start()
+        time.sleep(1)  # warm up
+        load.phase = "no backup"
+        time.sleep(args.baseline_seconds)
+        results = [("no backup", None)]
+        for phase, pages, pause in (("stepped backup", args.pages, args.pause_ms / 1000),
+                                    ("single-step backup", -1, 0)):
+            target = os.path.join(tmp, f"{phase.replace(' ', '-')}.sqlite3")
+            load.phase = phase
+            started = time.perf_counter()
+            backup_sqlite(f"{tmp}/bench.db", target, pages=pages, pause=pause)
+            results.append((phase, time.perf_counter() - started))
+            load.phase = None
+            os.remove(target)
+            time.sleep(0.5)
+        load.finish()
+        for phase, duration in results:
+            report(phase, load, duration)
+
+
+if __name__ == "__main__":
+    main()
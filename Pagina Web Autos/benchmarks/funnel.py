@@ -0,0 +1,73 @@
+"""Funnel report benchmark.
+
+Fills a FunnelStore with a year of synthetic view and click events and
+times the report for the whole catalog, for a group of vehicles and for a
+single listing, cold (aggregated) and warm (cached). The target is under
+200 ms for a year across the whole catalog.
+
+Usage (from the project directory):
+
+    python benchmarks/funnel.py [--events 3000000] [--vehicles 2000] [--runs 10]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from funnel import FunnelStore, _day_number  # noqa: E402
+
+
+def build_store(events, vehicles, start, days):
+    rng = np.random.default_rng(42)
+    store = FunnelStore(refresh_seconds=float('inf'))
+    store.last_refresh = time.monotonic()  # no database behind this store
+    store.vehicle_ids = rng.integers(1, vehicles + 1, events, dtype=np.int32)
+    store.days = (_day_number(start) + rng.integers(0, days, events)).astype(np.int32)
+    # Roughly 90% views, then WhatsApp, calls and offers
+    store.steps = rng.choice(4, events, p=[0.9, 0.06, 0.02, 0.02]).astype(np.int8)
+    return store
+
+
+def time_report(store, start, end, vehicle_ids, runs):
+    cold = []
+    for _ in range(runs):
+        store._cache.clear()
+        begin = time.perf_counter()
+        store.report(start, end, vehicle_ids)
+        cold.append((time.perf_counter() - begin) * 1000)
+    begin = time.perf_counter()
+    store.report(start, end, vehicle_ids)
+    warm = (time.perf_counter() - begin) * 1000
+    return statistics.median(cold), max(cold), warm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=3_000_000)
+    parser.add_argument("--vehicles", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    end = date.today()
+    start = end - timedelta(days=364)
+    store = build_store(args.events, args.vehicles, start, 365)
+    print(f"{args.events:,} events, {args.vehicles:,} vehicles, {start} .. {end}")
+
+    cases = [
+        ("whole catalog", None),
+        ("50 vehicles", list(range(1, 51))),
+        ("one vehicle", [1]),
+    ]
+    for label, vehicle_ids in cases:
+        median, worst, warm = time_report(store, start, end, vehicle_ids, args.runs)
+        print(f"{label:>14}: cold median {median:7.1f} ms, worst {worst:7.1f} ms, cached {warm:6.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Startup-time benchmark.
+
+Measures two things against a throwaway SQLite database:
+
+* cold start: a fresh interpreter importing ``main`` (what a sync gunicorn
+  worker pays without ``--preload``);
+* worker spawn: forking an already built app and serving the first request
+  (what each worker pays with ``--preload``).
+
+Both are compared with the legacy import path, which also ran the schema
+creation and admin lookup on every import.
+
+Usage (from the project directory):
+
+    python benchmarks/startup.py [--runs 20]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLD_START = "import main"
+LEGACY_COLD_START = (
+    "from app import create_app, init_db\n"
+    "app = create_app()\n"
+    "with app.app_context():\n"
+    "    init_db()\n"
+)
+
+
+def time_subprocess(code, env, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=PROJECT_DIR, env=env, check=True)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_fork_spawn(app, runs, legacy=False):
+    from app import init_db
+
+    samples = []
+    for _ in range(runs):
+        read_fd, write_fd = os.pipe()
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            if legacy:
+                with app.app_context():
+                    init_db()
+            app.test_client().get("/terminos-y-condiciones")
+            os.write(write_fd, b"1")
+            os._exit(0)
+        os.close(write_fd)
+        os.read(read_fd, 1)
+        samples.append(time.perf_counter() - start)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    return samples
+
+
+def report(label, samples):
+    print(f"{label:<28} median {statistics.median(samples) * 1000:8.1f} ms"
+          f"   p90 {sorted(samples)[int(len(samples) * 0.9) - 1] * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp}/bench.db", LOG_LEVEL="WARNING")
+        os.environ.update(env)
+        sys.path.insert(0, PROJECT_DIR)
+        os.chdir(PROJECT_DIR)
+
+        from app import create_app, init_db
+
+        app = create_app()
+        with app.app_context():
+            init_db()
+
+        report("cold start (legacy)", time_subprocess(LEGACY_COLD_START, env, args.runs))
+        report("cold start (factory)", time_subprocess(COLD_START, env, args.runs))
+        if hasattr(os, "fork"):
+            report("worker spawn (legacy)", time_fork_spawn(app, args.runs, legacy=True))
+            report("worker spawn (preload)", time_fork_spawn(app, args.runs))
+
+
+if __name__ == "__main__":
+    main()
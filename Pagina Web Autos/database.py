@@ -0,0 +1,226 @@
+import logging
+import re
+from functools import partial
+
+from sqlalchemy import event, insert, inspect, select, text
+from sqlalchemy.engine import make_url
+
+from db_routing import REPLICA_BIND, watch_replica
+from models import db, ANALYTICS_BIND
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the per-connection SQLite tuning, overridable through app.config
+SQLITE_DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+}
+
+
+def pool_options(environ, prefix, url):
+    """Engine options for one database read from ``<prefix>_*`` environment variables.
+
+    Supported: ``_POOL_SIZE``, ``_MAX_OVERFLOW``, ``_POOL_TIMEOUT`` and
+    ``_STATEMENT_TIMEOUT_MS`` (PostgreSQL only). Unset values keep the
+    SQLAlchemy defaults.
+    """
+    options = {}
+    for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+        value = environ.get(f"{prefix}_{option.upper()}")
+        if value:
+            options[option] = int(value)
+    statement_timeout = environ.get(f"{prefix}_STATEMENT_TIMEOUT_MS")
+    if statement_timeout and make_url(url).get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f"-c statement_timeout={int(statement_timeout)}"}
+    return options
+
+
+def configure_engines(app, environ):
+    """Configure the primary engine and the analytics and replica binds.
+
+    The tracking tables use their own database when ``ANALYTICS_DATABASE_URL``
+    is set, otherwise they share the primary one (and its engine, see
+    ``RoutingSession``), which keeps single-file setups working unchanged. ``REPLICA_DATABASE_URL``
+    adds a read replica used by views marked ``read_only``. Pool settings are
+    read per engine from ``DATABASE_*``, ``ANALYTICS_DATABASE_*`` and
+    ``REPLICA_DATABASE_*``; the primary settings are the defaults for all.
+    """
+    primary_url = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_options(environ, 'DATABASE', primary_url))
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    analytics_url = environ.get('ANALYTICS_DATABASE_URL') or primary_url
+    binds.setdefault(ANALYTICS_BIND, {'url': analytics_url,
+                                      **pool_options(environ, 'ANALYTICS_DATABASE', analytics_url)})
+    replica_url = environ.get('REPLICA_DATABASE_URL')
+    if replica_url:
+        binds.setdefault(REPLICA_BIND, {'url': replica_url,
+                                        **pool_options(environ, 'REPLICA_DATABASE', replica_url)})
+
+
+def watch_replica_engine(app):
+    """Fall back to the primary when the replica's connections fail"""
+    with app.app_context():
+        if REPLICA_BIND in db.engines:
+            watch_replica(db.engines[REPLICA_BIND])
+
+
+def _apply_sqlite_pragmas(settings, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={settings['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.execute(f"PRAGMA synchronous={settings['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings['SQLITE_MMAP_SIZE'])}")
+    finally:
+        cursor.close()
+
+
+def _sqlite_settings(config):
+    return {key: config.get(key, default) for key, default in SQLITE_DEFAULTS.items()}
+
+
+def tune_sqlite_engines(app):
+    """Register a connect hook applying WAL, busy_timeout, synchronous and mmap_size.
+
+    WAL lets readers proceed while a writer holds the lock, and busy_timeout
+    makes a blocked writer wait instead of failing with "database is locked".
+    """
+    settings = _sqlite_settings(app.config)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', partial(_apply_sqlite_pragmas, settings))
+
+
+# Async driver used for each backend by the ASGI entry point
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+def _async_engine_options(options, backend):
+    options = {key: value for key, value in options.items() if key != 'url'}
+    connect_args = options.pop('connect_args', None)
+    if connect_args and backend == 'postgresql':
+        # psycopg2 takes "-c name=value" options, asyncpg takes server_settings
+        settings = dict(re.findall(r'-c\s*(\w+)=(\S+)', connect_args.get('options', '')))
+        if settings:
+            options['connect_args'] = {'server_settings': settings}
+    return options
+
+
+def create_async_engines(app):
+    """Async engines for the primary, analytics and replica databases, keyed like ``db.engines``.
+
+    They connect to the same URLs as the sync engines (so relative SQLite
+    paths resolve the same way) with the same pool settings and SQLite
+    pragmas. As with ``RoutingSession``, an analytics bind pointing at the
+    primary database shares its engine.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    with app.app_context():
+        sync_engines = dict(db.engines)
+    binds = app.config.get('SQLALCHEMY_BINDS', {})
+    settings = _sqlite_settings(app.config)
+    engines = {}
+    for key in (None, ANALYTICS_BIND, REPLICA_BIND):
+        if key not in sync_engines:
+            continue
+        url = sync_engines[key].url
+        if key == ANALYTICS_BIND and url == sync_engines[None].url:
+            engines[key] = engines[None]
+            continue
+        backend = url.get_backend_name()
+        if backend not in ASYNC_DRIVERS:
+            raise ValueError(f"No async driver for the {backend} database")
+        options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        if key is not None and isinstance(binds.get(key), dict):
+            options.update(binds[key])
+        engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[backend]),
+                                     **_async_engine_options(options, backend))
+        if backend == 'sqlite':
+            event.listen(engine.sync_engine, 'connect', partial(_apply_sqlite_pragmas, settings))
+        if key == REPLICA_BIND:
+            watch_replica(engine.sync_engine)
+        engines[key] = engine
+    return engines
+
+
+def schema_binds():
+    """Bind keys whose tables the app creates; the replica gets them through replication"""
+    return [key for key in db.metadatas if key != REPLICA_BIND]
+
+
+def upgrade_schema():
+    """Add columns and indexes declared on the models but missing from existing tables.
+
+    ``create_all`` only creates missing tables; this covers the columns added
+    to existing ones since a database was first initialized. New columns are
+    added as nullable and filled in by the caller where needed.
+    """
+    added = []
+    for bind_key in schema_binds():
+        metadata = db.metadatas[bind_key]
+        engine = db.engines[bind_key]
+        preparer = engine.dialect.identifier_preparer
+        inspector = inspect(engine)
+        with engine.begin() as connection:
+            for table in metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    continue
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(
+                        f"ALTER TABLE {preparer.quote(table.name)} "
+                        f"ADD COLUMN {preparer.quote(column.name)} {column_type}"))
+                    added.append(f"{table.name}.{column.name}")
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+    for column in added:
+        logger.info("Added column %s", column)
+    return added
+
+
+def analytics_is_separate():
+    """True when the analytics bind points at a different database than the primary one"""
+    return db.engines[ANALYTICS_BIND].url != db.engines[None].url
+
+
+def copy_analytics_tables(batch_size=1000):
+    """Copy tracking rows left in the primary database into the analytics database.
+
+    Used once when switching an existing deployment to a separate analytics
+    database. Rows are moved in primary-key order and in batches, so the copy
+    can be interrupted and resumed.
+    """
+    source_engine = db.engines[None]
+    target_engine = db.engines[ANALYTICS_BIND]
+    copied = {}
+    for table in db.metadatas[ANALYTICS_BIND].tables.values():
+        if not inspect(source_engine).has_table(table.name):
+            continue
+        with target_engine.connect() as target:
+            last_id = target.execute(select(db.func.max(table.c.id))).scalar() or 0
+        total = 0
+        with source_engine.connect() as source:
+            while True:
+                rows = source.execute(
+                    select(table).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+                ).mappings().all()
+                if not rows:
+                    break
+                with target_engine.begin() as target:
+                    target.execute(insert(table), [dict(row) for row in rows])
+                last_id = rows[-1]['id']
+                total += len(rows)
+        copied[table.name] = total
+        logger.info("Copied %s rows of %s into the analytics database", total, table.name)
+    return copied
@@ -0,0 +1,130 @@
+import logging
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+# Bind key for the high-volume tracking tables (PageVisit, VehicleView, Click).
+# They may live in their own database, so they carry no foreign keys to the
+# listing tables and are never joined with them in SQL.
+ANALYTICS_BIND = 'analytics'
+
+# Bind key of the optional read replica of the primary database
+REPLICA_BIND = 'replica'
+
+# Seconds a replica stays out of rotation after a connection failure
+REPLICA_RETRY_AFTER = 30
+
+# Seconds a client's reads stay on the primary after it writes there, so it
+# sees its own changes even when the replica lags behind
+PRIMARY_AFTER_WRITE = 10
+
+_replica_down_until = {}
+
+
+class RoutingSession(Session):
+    """Session that sends reads of primary-bound models to the read replica.
+
+    Only applies inside views marked with :func:`read_only`. Flushes always go
+    to the bind chosen by Flask-SQLAlchemy, so writes (e.g. analytics rows
+    recorded by a read-only page) still reach the primary or analytics
+    database.
+
+    A write to the primary sends the rest of the request's reads, and the
+    client's reads for ``PRIMARY_AFTER_WRITE`` seconds, to the primary too
+    (read-your-writes while the replica catches up).
+
+    When the analytics bind points at the primary database, its tables are
+    reached through the primary engine, so a transaction touching both (such
+    as deleting a vehicle and its views) uses a single connection instead of
+    competing with itself for the SQLite write lock.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None:
+            return engine
+        engines = self._db.engines
+        if engine is engines.get(ANALYTICS_BIND):
+            primary = engines[None]
+            return primary if engine.url == primary.url else engine
+        if self._flushing or (clause is not None and getattr(clause, 'is_dml', False)):
+            if engine is engines.get(None) and replica_available(engines):
+                _stick_to_primary()
+            return engine
+        if not _reads_from_replica():
+            return engine
+        if engine is engines.get(None) and replica_available(engines):
+            return engines[REPLICA_BIND]
+        return engine
+
+
+def _reads_from_replica():
+    if not has_app_context() or not g.get('db_read_only', False):
+        return False
+    return not primary_pinned()
+
+
+def primary_pinned():
+    """True while the client's reads stay on the primary after a write of its own"""
+    return has_request_context() and session.get('db_primary_until', 0) > time.time()
+
+
+def _stick_to_primary():
+    if has_request_context():
+        session['db_primary_until'] = time.time() + PRIMARY_AFTER_WRITE
+
+
+def replica_available(engines):
+    """True when a replica is configured and has not failed recently"""
+    replica = engines.get(REPLICA_BIND)
+    if replica is None:
+        return False
+    return _replica_down_until.get(replica.url, 0) <= time.monotonic()
+
+
+def _mark_replica_down(engine):
+    _replica_down_until[engine.url] = time.monotonic() + REPLICA_RETRY_AFTER
+    logger.warning("Read replica unavailable, falling back to primary for %ss", REPLICA_RETRY_AFTER,
+                   extra={'replica': engine.url.render_as_string(hide_password=True)})
+
+
+def watch_replica(engine):
+    """Take the replica out of rotation when its connections fail"""
+    def handle_error(context):
+        if context.is_disconnect or context.connection is None:
+            _mark_replica_down(engine)
+
+    event.listen(engine, 'handle_error', handle_error)
+
+
+def read_only(view_func):
+    """Serve the view's primary-database reads from the read replica.
+
+    If the replica fails while the view runs, the view is run again from
+    the start with all reads on the primary, so anything it commits must
+    come after its last read (e.g. render the page, then record the visit)
+    or be safe to repeat.
+    """
+    @wraps(view_func)
+    def wrapper(*args, **kwargs):
+        db = current_app.extensions['sqlalchemy']
+        if not replica_available(db.engines):
+            return view_func(*args, **kwargs)
+        g.db_read_only = True
+        try:
+            return view_func(*args, **kwargs)
+        except DBAPIError:
+            if replica_available(db.engines):
+                raise
+            db.session.rollback()
+            g.db_read_only = False
+            return view_func(*args, **kwargs)
+        finally:
+            g.db_read_only = False
+    return wrapper
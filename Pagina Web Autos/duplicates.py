@@ -0,0 +1,274 @@
+import logging
+import re
+import unicodedata
+import zlib
+from collections import defaultdict, namedtuple
+
+import numpy as np
+from flask import current_app
+
+from incremental_index import IncrementalIndex, Source
+from listing_images import image_paths
+from models import db, ClientRequest, ImageFingerprint, Vehicle
+from storage import UPLOAD_PREFIX, get_storage
+
+logger = logging.getLogger(__name__)
+
+# MinHash signature of 128 permutations split into 32 LSH bands of 4 rows:
+# texts with Jaccard similarity 0.5 share a band 87% of the time, 0.3 only 23%
+NUM_PERMUTATIONS = 128
+BAND_ROWS = 4
+SHINGLE_SIZE = 5
+
+# Estimated Jaccard similarity above which two texts are reported
+TEXT_THRESHOLD = 0.5
+
+# 64-bit image hashes are split into 4 bands of 16 bits, so any two hashes
+# within 3 bits share a band; candidates are then kept up to this distance
+IMAGE_BANDS = 4
+MAX_IMAGE_DISTANCE = 6
+
+# Paths looked up per query while loading image hashes
+CHUNK_SIZE = 500
+
+# Universal hashing (a * x + b) mod p; with p < 2**31 the product fits in uint64
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(20240611)
+_PERM_A = _rng.integers(1, _PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, _PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+_pillow_missing_logged = False
+
+# Indexed listing: key is ('vehicle' | 'request', id)
+Entry = namedtuple('Entry', 'key title signature image_hashes buckets')
+
+
+# -- fingerprints -----------------------------------------------------------
+
+def normalize_text(text):
+    """Lowercase, drop accents and punctuation and collapse whitespace"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    return _NON_WORD.sub(' ', text).strip()
+
+
+def minhash_signature(text):
+    """MinHash signature of the character shingles of ``text`` (None if empty)"""
+    text = normalize_text(text)
+    if not text:
+        return None
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))}
+    hashes = np.array([zlib.crc32(shingle.encode()) for shingle in shingles], dtype=np.uint64) % np.uint64(_PRIME)
+    permuted = (_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % np.uint64(_PRIME)
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def image_hash(stream):
+    """64-bit difference hash of an image as 16 hex digits, or None.
+
+    The image is shrunk to 9x8 grey pixels and each bit says whether a pixel
+    is brighter than its right neighbour, so re-encoding, resizing and mild
+    colour changes keep the hash within a few bits. Needs Pillow (the
+    ``duplicates`` extra); without it None is returned. The stream position
+    is restored.
+    """
+    global _pillow_missing_logged
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_missing_logged:
+            logger.warning("Pillow is not installed; duplicate detection only compares texts")
+            _pillow_missing_logged = True
+        return None
+    position = stream.tell()
+    try:
+        with Image.open(stream) as image:
+            image.draft('L', (64, 64))  # JPEG decodes straight at a fraction of the size
+            pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    except Exception:
+        logger.warning("Could not hash image", exc_info=True)
+        return None
+    finally:
+        stream.seek(position)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    value = int(np.packbits(bits).view('>u8')[0])
+    # Flat images (placeholders, blank photos) all hash to 0 and say nothing
+    return f"{value:016x}" if value else None
+
+
+def record_image_hash(path, phash):
+    """Add the fingerprint of a stored image to the session; a None hash (unreadable image) is skipped"""
+    if phash is not None:
+        db.session.add(ImageFingerprint(path=path, phash=phash))
+
+
+def fingerprint_missing_images(batch_size=CHUNK_SIZE):
+    """Hash stored images of active vehicles and pending requests that have no fingerprint yet"""
+    statements = (
+        db.select(Vehicle.images).where(Vehicle.is_active == True, Vehicle.images.isnot(None)),
+        db.select(ClientRequest.images).where(ClientRequest.status == 'pending', ClientRequest.images.isnot(None)),
+    )
+    paths = set()
+    for statement in statements:
+        for images in db.session.execute(statement).scalars():
+            paths.update(path for path in image_paths(images) if path.startswith(UPLOAD_PREFIX))
+    known = _known_hashes(paths)
+    storage = get_storage()
+    report = {'images': len(paths), 'hashed': 0, 'failed': 0}
+    for path in sorted(paths - set(known)):
+        try:
+            with storage.open(path[len(UPLOAD_PREFIX):]) as stream:
+                phash = image_hash(stream)
+        except Exception:
+            logger.warning("Could not read image %s", path, exc_info=True, extra={'upload': path})
+            phash = None
+        if phash is None:
+            report['failed'] += 1
+            continue
+        db.session.add(ImageFingerprint(path=path, phash=phash))
+        report['hashed'] += 1
+        if report['hashed'] % batch_size == 0:
+            db.session.commit()
+    db.session.commit()
+    return report
+
+
+def _known_hashes(paths):
+    paths = list(paths)
+    hashes = {}
+    for start in range(0, len(paths), CHUNK_SIZE):
+        chunk = paths[start:start + CHUNK_SIZE]
+        rows = db.session.query(ImageFingerprint.path, ImageFingerprint.phash).filter(
+            ImageFingerprint.path.in_(chunk))
+        hashes.update((path, int(phash, 16)) for path, phash in rows)
+    return hashes
+
+
+# -- index ------------------------------------------------------------------
+
+class _FetchedRows(list):
+    """Listing rows with ``image_hashes``, the known hash of each of their photos"""
+
+
+class DuplicateIndex(IncrementalIndex):
+    """Locality-sensitive hash index over active vehicles and pending requests.
+
+    Every listing is reduced to a MinHash signature of its title and
+    description and to the perceptual hashes of its photos. Bands of both
+    go into hash buckets, so a lookup only compares the listings sharing at
+    least one bucket instead of the whole catalog.
+    """
+
+    name = 'duplicate_index'
+    sources = {
+        'vehicle': Source(Vehicle, (Vehicle.id, Vehicle.title, Vehicle.description, Vehicle.images,
+                                    Vehicle.updated_at), Vehicle.is_active == True),
+        'request': Source(ClientRequest, (ClientRequest.id, ClientRequest.title, ClientRequest.description,
+                                          ClientRequest.images, ClientRequest.updated_at),
+                          ClientRequest.status == 'pending'),
+    }
+
+    def _reset(self):
+        self.entries = {}
+        self.buckets = defaultdict(set)
+
+    # -- public API -------------------------------------------------------
+
+    def duplicates_of(self, keys, limit=5):
+        """Likely duplicates of each indexed listing in ``keys``, best first.
+
+        Returns {key: [match, ...]} where a match is a dict with ``kind``,
+        ``id``, ``title``, ``text_similarity`` (estimated Jaccard),
+        ``similar_text`` and ``shared_images`` (photos of the listing found
+        in the other one).
+        """
+        with self._synced() as ready:
+            return {key: self._matches(key, limit) if ready else [] for key in keys}
+
+    # -- building ---------------------------------------------------------
+
+    def _count(self, kind):
+        return sum(1 for key in self.entries if key[0] == kind)
+
+    def _fetch(self, kind, query):
+        rows = _FetchedRows(query.all())
+        rows.image_hashes = _known_hashes({path for row in rows if row.live for path in image_paths(row.images)})
+        return rows
+
+    def _apply(self, kind, rows, requested_ids):
+        seen = {row.id for row in rows}
+        for item_id in requested_ids:
+            if item_id not in seen:
+                self._remove((kind, item_id))
+        hashes = rows.image_hashes
+        for row in rows:
+            key = (kind, row.id)
+            self._remove(key)
+            if not row.live:
+                continue
+            signature = minhash_signature(f"{row.title} {row.description}")
+            image_hashes = tuple(hashes[path] for path in image_paths(row.images) if path in hashes)
+            buckets = []
+            if signature is not None:
+                buckets += [('text', band, signature[band * BAND_ROWS:(band + 1) * BAND_ROWS].tobytes())
+                            for band in range(NUM_PERMUTATIONS // BAND_ROWS)]
+            buckets += [('image', band, (value >> (16 * band)) & 0xFFFF)
+                        for value in image_hashes for band in range(IMAGE_BANDS)]
+            for bucket in buckets:
+                self.buckets[bucket].add(key)
+            self.entries[key] = Entry(key, row.title, signature, image_hashes, buckets)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket in entry.buckets:
+            members = self.buckets.get(bucket)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del self.buckets[bucket]
+
+    # -- matching ---------------------------------------------------------
+
+    def _matches(self, key, limit):
+        entry = self.entries.get(key)
+        if entry is None:
+            return []
+        candidates = set()
+        for bucket in entry.buckets:
+            candidates |= self.buckets.get(bucket, set())
+        candidates.discard(key)
+        matches = []
+        for other_key in candidates:
+            other = self.entries[other_key]
+            similarity = 0.0
+            if entry.signature is not None and other.signature is not None:
+                similarity = float(np.mean(entry.signature == other.signature))
+            shared = sum(1 for value in entry.image_hashes
+                         if any((value ^ other_value).bit_count() <= MAX_IMAGE_DISTANCE
+                                for other_value in other.image_hashes))
+            if similarity >= TEXT_THRESHOLD or shared:
+                matches.append({'kind': other_key[0], 'id': other_key[1], 'title': other.title,
+                                'text_similarity': round(similarity, 2), 'similar_text': similarity >= TEXT_THRESHOLD,
+                                'shared_images': shared})
+        matches.sort(key=lambda match: (match['shared_images'], match['text_similarity']), reverse=True)
+        return matches[:limit]
+
+
+def find_duplicates(client_requests, limit=5):
+    """Likely duplicates of pending ``client_requests``, keyed by request id"""
+    index = current_app.extensions['duplicate_index']
+    found = index.duplicates_of([('request', item.id) for item in client_requests], limit)
+    return {key[1]: matches for key, matches in found.items() if matches}
+
+
+def init_app(app):
+    index = DuplicateIndex(refresh_seconds=app.config.get('DUPLICATE_INDEX_REFRESH_SECONDS', 60))
+    app.extensions[index.name] = index
+    app.before_request(index.ensure_started)
+
+
+DuplicateIndex.track_changes()
@@ -0,0 +1,131 @@
+import csv
+import io
+import json
+import logging
+import time
+import zlib
+from collections import namedtuple
+from datetime import date, datetime, time as day_time, timedelta
+
+from sqlalchemy import select
+
+from models import db, Click, ClientRequest, PageVisit, Vehicle, VehicleView
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip from the server-side cursor
+CHUNK_SIZE = 2000
+
+# Bytes buffered before a chunk is sent (and compressed)
+FLUSH_BYTES = 64 * 1024
+
+# An exportable table: its columns, the column filtered by date and the one
+# filtered by vehicle id (None when the table has no vehicle)
+Dataset = namedtuple('Dataset', 'model columns date_column vehicle_column')
+
+
+def _columns(model, exclude=()):
+    return [column for column in model.__table__.columns if column.name not in exclude]
+
+
+DATASETS = {
+    'vehiculos': Dataset(Vehicle, _columns(Vehicle), Vehicle.created_at, Vehicle.id),
+    'solicitudes': Dataset(ClientRequest, _columns(ClientRequest), ClientRequest.created_at, None),
+    'visitas': Dataset(VehicleView, _columns(VehicleView), VehicleView.timestamp, VehicleView.vehicle_id),
+    'clics': Dataset(Click, _columns(Click), Click.timestamp, Click.vehicle_id),
+    'paginas': Dataset(PageVisit, _columns(PageVisit), PageVisit.created_at, None),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def parse_dates(start, end):
+    """Optional inclusive ISO date range as datetimes (end exclusive); raises ValueError"""
+    start = datetime.combine(date.fromisoformat(start), day_time.min) if start else None
+    end = datetime.combine(date.fromisoformat(end) + timedelta(days=1), day_time.min) if end else None
+    if start and end and start >= end:
+        raise ValueError("start after end")
+    return start, end
+
+
+def export_statement(dataset, start=None, end=None, vehicle_ids=None):
+    """SELECT of the dataset's columns in primary key order, filtered"""
+    statement = select(*dataset.columns).order_by(*dataset.model.__table__.primary_key.columns)
+    if start is not None:
+        statement = statement.where(dataset.date_column >= start)
+    if end is not None:
+        statement = statement.where(dataset.date_column < end)
+    if vehicle_ids is not None:
+        if dataset.model is ClientRequest:
+            # Requests are selected through the vehicles published from them
+            statement = statement.where(ClientRequest.id.in_(
+                select(Vehicle.client_request_id).where(Vehicle.id.in_(vehicle_ids))))
+        elif dataset.vehicle_column is not None:
+            statement = statement.where(dataset.vehicle_column.in_(vehicle_ids))
+    return statement
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _csv_lines(names, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([_value(value) for value in row])
+        yield buffer.getvalue()
+
+
+def _jsonl_lines(names, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(names, (_value(value) for value in row))), ensure_ascii=False) + '\n'
+
+
+def stream_export(dataset, fmt, statement, compress=False):
+    """Yield the export as byte chunks of about FLUSH_BYTES.
+
+    Rows come from a server-side cursor ``CHUNK_SIZE`` at a time and are
+    encoded, buffered and (with ``compress``) gzipped as they arrive, so the
+    memory used does not depend on the number of rows.
+    """
+    started = time.perf_counter()
+    names = [column.name for column in dataset.columns]
+    result = db.session.execute(statement.execution_options(yield_per=CHUNK_SIZE))
+    lines = (_csv_lines if fmt == 'csv' else _jsonl_lines)(names, result)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # 31: gzip container
+    buffer, size, rows, total = [], 0, 0, 0
+    try:
+        for line in lines:
+            buffer.append(line)
+            size += len(line)
+            rows += 1
+            if size >= FLUSH_BYTES:
+                chunk = ''.join(buffer).encode()
+                buffer, size = [], 0
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    total += len(chunk)
+                    yield chunk
+        chunk = ''.join(buffer).encode()
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            total += len(chunk)
+            yield chunk
+    finally:
+        result.close()
+        logger.info("Export streamed", extra={
+            'dataset': dataset.model.__tablename__, 'format': fmt, 'gzip': compress,
+            'lines': rows, 'bytes': total,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)})
@@ -0,0 +1,325 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from flask import current_app, request, url_for
+from sqlalchemy import func, select
+
+from models import db, Vehicle
+from storage import upload_url
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip from the server-side cursor
+CHUNK_SIZE = 500
+
+# Limits of a single sitemap file (sitemaps.org); a larger sitemap is split
+# into numbered pages listed by a sitemap index
+SITEMAP_MAX_URLS = 50_000
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+_FEED_COLUMNS = (Vehicle.id, Vehicle.title, Vehicle.description, Vehicle.price, Vehicle.currency,
+                 Vehicle.price_ars_normalized, Vehicle.year, Vehicle.brand, Vehicle.model,
+                 Vehicle.kilometers, Vehicle.fuel_type, Vehicle.transmission, Vehicle.color,
+                 Vehicle.location, Vehicle.images, Vehicle.is_plus, Vehicle.updated_at)
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def catalog_signature():
+    """(ETag, Last-Modified) of the active catalog from a single aggregate query"""
+    count, last_modified = db.session.execute(
+        select(func.count(Vehicle.id), func.max(Vehicle.updated_at)).where(Vehicle.is_active == True)
+    ).one()
+    etag = hashlib.sha1(f"{count}:{last_modified}".encode()).hexdigest()
+    return etag, last_modified
+
+
+def _xml_text(value):
+    # Fragments are stored one per line, so newlines are kept as character references
+    return escape(str(value)).replace('\n', '&#10;').replace('\r', '')
+
+
+def _absolute(path):
+    return request.host_url.rstrip('/') + path
+
+
+def _images(row):
+    if not row.is_plus or not row.images:
+        return []
+    try:
+        images = json.loads(row.images)
+    except ValueError:
+        return []
+    urls = (upload_url(img) for img in images)
+    return [_absolute(url) if url.startswith('/') else url for url in urls]
+
+
+def render_sitemap_entry(row):
+    lastmod = f"<lastmod>{row.updated_at.date().isoformat()}</lastmod>" if row.updated_at else ""
+    return f"<url><loc>{_xml_text(_absolute(url_for('vehicle_detail', id=row.id)))}</loc>{lastmod}</url>"
+
+
+def _catalog_item(row):
+    return {
+        'id': row.id,
+        'url': _absolute(url_for('vehicle_detail', id=row.id)),
+        'title': row.title,
+        'description': row.description,
+        'price': row.price,
+        'currency': row.currency,
+        'price_ars': row.price_ars_normalized,
+        'year': row.year,
+        'brand': row.brand,
+        'model': row.model,
+        'kilometers': row.kilometers,
+        'fuel_type': row.fuel_type,
+        'transmission': row.transmission,
+        'color': row.color,
+        'location': row.location,
+        'images': _images(row),
+        'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+    }
+
+
+def render_json_entry(row):
+    return json.dumps(_catalog_item(row), ensure_ascii=False)
+
+
+def render_xml_entry(row):
+    parts = []
+    for key, value in _catalog_item(row).items():
+        if key == 'images':
+            value = ''.join(f"<image>{_xml_text(image)}</image>" for image in value)
+            parts.append(f"<images>{value}</images>")
+        elif value is not None:
+            parts.append(f"<{key}>{_xml_text(value)}</{key}>")
+    return f"<vehicle>{''.join(parts)}</vehicle>"
+
+
+class Feed:
+    """A feed rendered from one fragment per active vehicle.
+
+    Fragments are cached on disk, one line per vehicle ordered by id, in one
+    file per host the site is reached through (their URLs are absolute). A
+    regeneration merges three id-ordered streams: the ids of active vehicles,
+    the full rows changed since the last build (both read through server-side
+    cursors) and the previous fragment file. Only changed vehicles are
+    re-rendered and memory use does not grow with the catalog.
+    """
+
+    def __init__(self, name, mimetype, render, header, footer, separator=''):
+        self.name = name
+        self.mimetype = mimetype
+        self.render = render
+        self.header = header
+        self.footer = footer
+        self.separator = separator
+
+    def _paths(self):
+        directory = current_app.config.get('FEED_CACHE_DIR') or os.path.join(current_app.instance_path, 'feeds')
+        os.makedirs(directory, exist_ok=True)
+        host = hashlib.sha1(request.host_url.encode()).hexdigest()[:12]
+        base = os.path.join(directory, f"{self.name}-{host}")
+        return base + '.fragments', base + '.meta.json'
+
+    def _load_meta(self, meta_path):
+        try:
+            with open(meta_path) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+
+    def ensure_fresh(self, etag):
+        """Bring the fragment file up to date with the catalog state ``etag``"""
+        fragments_path, meta_path = self._paths()
+        with _locks_guard:
+            lock = _locks.setdefault(fragments_path, threading.Lock())
+        with lock:
+            meta = self._load_meta(meta_path)
+            if meta.get('etag') == etag and os.path.exists(fragments_path):
+                return fragments_path
+            reuse = meta.get('watermark') and os.path.exists(fragments_path)
+            watermark = datetime.fromisoformat(meta['watermark']) if reuse else None
+            new_watermark, rendered = self._regenerate(fragments_path, watermark)
+            with open(meta_path + '.tmp', 'w') as meta_file:
+                json.dump({'etag': etag, 'host': request.host_url,
+                           'watermark': new_watermark.isoformat() if new_watermark else None}, meta_file)
+            os.replace(meta_path + '.tmp', meta_path)
+            logger.info("Feed regenerated", extra={'feed': self.name, 'rendered': rendered,
+                                                   'incremental': watermark is not None})
+            return fragments_path
+
+    def _regenerate(self, fragments_path, watermark):
+        active_ids = db.session.execute(
+            select(Vehicle.id).where(Vehicle.is_active == True).order_by(Vehicle.id)
+            .execution_options(yield_per=CHUNK_SIZE * 10)
+        ).scalars()
+        changed_query = select(*_FEED_COLUMNS).where(Vehicle.is_active == True).order_by(Vehicle.id)
+        if watermark is not None:
+            # >= so rows written in the same instant as the last build are re-rendered
+            changed_query = changed_query.where(Vehicle.updated_at >= watermark)
+        changed = db.session.execute(changed_query.execution_options(yield_per=CHUNK_SIZE))
+
+        old = open(fragments_path, encoding='utf-8') if watermark is not None else None
+        tmp_path = f"{fragments_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        new_watermark = watermark
+        rendered = 0
+        try:
+            changed_row = next(changed, None)
+            old_id, old_fragment = _next_fragment(old)
+            with open(tmp_path, 'w', encoding='utf-8') as output:
+                for vehicle_id in active_ids:
+                    while changed_row is not None and changed_row.id < vehicle_id:
+                        changed_row = next(changed, None)
+                    if changed_row is not None and changed_row.id == vehicle_id:
+                        fragment = self.render(changed_row)
+                        rendered += 1
+                        if changed_row.updated_at and (new_watermark is None or changed_row.updated_at > new_watermark):
+                            new_watermark = changed_row.updated_at
+                    else:
+                        while old_id is not None and old_id < vehicle_id:
+                            old_id, old_fragment = _next_fragment(old)
+                        if old_id != vehicle_id:
+                            # Not in the previous build and not changed: should not happen, render it
+                            row = db.session.execute(select(*_FEED_COLUMNS).where(Vehicle.id == vehicle_id)).one()
+                            fragment = self.render(row)
+                            rendered += 1
+                        else:
+                            fragment = old_fragment
+                    output.write(f"{vehicle_id}\t{fragment}\n")
+            os.replace(tmp_path, fragments_path)
+        finally:
+            if old is not None:
+                old.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return new_watermark, rendered
+
+    def stream(self, etag, extra_entries=()):
+        """Yield the feed document from the fragment file, one entry at a time.
+
+        The fragment file is refreshed when the generator starts, so a
+        response answered with 304 never triggers a regeneration.
+        """
+        yield from self._document(self.ensure_fresh(etag), extra_entries)
+
+    def _document(self, fragments_path, extra_entries, start=0, end=None):
+        """Header, ``extra_entries`` and the fragments between byte offsets ``start`` and ``end``, then footer"""
+        yield self.header()
+        first = True
+        for entry in extra_entries:
+            yield entry if first else self.separator + entry
+            first = False
+        with open(fragments_path, 'rb') as fragments:
+            fragments.seek(start)
+            offset = start
+            for line in fragments:
+                if end is not None and offset >= end:
+                    break
+                offset += len(line)
+                fragment = line.decode('utf-8').rstrip('\n').split('\t', 1)[1]
+                yield fragment if first else self.separator + fragment
+                first = False
+        yield self.footer()
+
+
+class Sitemap(Feed):
+    """The sitemap, split into pages once it outgrows a single file.
+
+    Each page holds at most ``max_urls`` entries and ``max_bytes`` bytes, the
+    extra entries (static pages) leading the first one. With more than one
+    page the sitemap document is a sitemap index of the ``sitemap_page``
+    URLs. Page boundaries are byte offsets into the fragment file, computed
+    once per catalog state.
+    """
+
+    def __init__(self, max_urls=SITEMAP_MAX_URLS, max_bytes=SITEMAP_MAX_BYTES):
+        super().__init__(
+            'sitemap', 'application/xml', render_sitemap_entry,
+            header=lambda: '<?xml version="1.0" encoding="UTF-8"?>\n'
+                           '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n',
+            footer=lambda: '\n</urlset>\n',
+            separator='\n',
+        )
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        # Page bounds per fragment file (one per host): (cache key, bounds)
+        self._bounds = {}
+
+    def page_count(self, etag, extra_entries=()):
+        return len(self._page_bounds(self.ensure_fresh(etag), etag, extra_entries))
+
+    def stream(self, etag, extra_entries=(), page=None):
+        """Yield the whole sitemap, or the sitemap index when it has several pages, or one ``page`` (from 1)"""
+        fragments_path = self.ensure_fresh(etag)
+        bounds = self._page_bounds(fragments_path, etag, extra_entries)
+        if page is None and len(bounds) > 1:
+            yield from self._index(len(bounds))
+            return
+        start, end = bounds[page - 1] if page else (0, None)
+        yield from self._document(fragments_path, extra_entries if page in (None, 1) else (), start, end)
+
+    def _index(self, pages):
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for page in range(1, pages + 1):
+            yield f"<sitemap><loc>{_xml_text(_absolute(url_for('sitemap_page', page=page)))}</loc></sitemap>\n"
+        yield '</sitemapindex>\n'
+
+    def _page_bounds(self, fragments_path, etag, extra_entries):
+        key = (etag, tuple(extra_entries), self.max_urls, self.max_bytes)
+        cached_key, bounds = self._bounds.get(fragments_path, (None, None))
+        if cached_key == key:
+            return bounds
+        separator = len(self.separator.encode())
+        fixed = len(self.header().encode()) + len(self.footer().encode())
+        count = len(extra_entries)
+        size = fixed + sum(len(entry.encode()) + separator for entry in extra_entries)
+        bounds = []
+        start = offset = 0
+        with open(fragments_path, 'rb') as fragments:
+            for line in fragments:
+                # The fragment without its "<id>\t" prefix and newline
+                entry_size = len(line) - line.index(b'\t') - 2 + separator
+                if count and (count >= self.max_urls or size + entry_size > self.max_bytes):
+                    bounds.append((start, offset))
+                    start, count, size = offset, 0, fixed
+                count += 1
+                size += entry_size
+                offset += len(line)
+        bounds.append((start, offset))
+        self._bounds[fragments_path] = (key, bounds)
+        return bounds
+
+
+def _next_fragment(handle):
+    if handle is None:
+        return None, None
+    line = handle.readline()
+    if not line:
+        return None, None
+    vehicle_id, fragment = line.rstrip('\n').split('\t', 1)
+    return int(vehicle_id), fragment
+
+
+SITEMAP = Sitemap()
+
+CATALOG_JSON = Feed(
+    'catalog_json', 'application/json', render_json_entry,
+    header=lambda: '{"vehicles": [\n',
+    footer=lambda: '\n]}\n',
+    separator=',\n',
+)
+
+CATALOG_XML = Feed(
+    'catalog_xml', 'application/xml', render_xml_entry,
+    header=lambda: '<?xml version="1.0" encoding="UTF-8"?>\n<catalog>\n',
+    footer=lambda: '\n</catalog>\n',
+    separator='\n',
+)
@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, Click, VehicleView
+
+logger = logging.getLogger(__name__)
+
+# Funnel steps, in order; index 0 is a listing view, the rest are click types
+STEPS = ('views', 'whatsapp', 'call', 'offer')
+_CLICK_STEPS = {step: code for code, step in enumerate(STEPS) if code}
+
+# Rows fetched per round trip while loading events
+CHUNK_SIZE = 20_000
+
+# Ids below the watermark read again on every refresh: PostgreSQL assigns ids
+# before commit, so a transaction that commits late adds rows under ids
+# already loaded
+RECHECK_IDS = 1000
+
+_EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def _day_number(day):
+    return int((np.datetime64(day, 'D') - _EPOCH).astype(np.int64))
+
+
+class FunnelStore:
+    """Columnar copy of the view and click events, aggregated with NumPy.
+
+    Every event is stored as three compact arrays (vehicle id, day number,
+    funnel step), 9 bytes per event. New rows are appended by primary key
+    watermark at most every ``refresh_seconds``, so a report never re-reads
+    history from the database (only the last ``RECHECK_IDS`` ids, to catch
+    rows committed late); results are cached per (range, vehicles) until new
+    events arrive.
+    """
+
+    def __init__(self, refresh_seconds=30, cache_size=64):
+        self.refresh_seconds = refresh_seconds
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.vehicle_ids = np.empty(0, dtype=np.int32)
+        self.days = np.empty(0, dtype=np.int32)
+        self.steps = np.empty(0, dtype=np.int8)
+        self.last_view_id = 0
+        self.last_click_id = 0
+        # Loaded ids within RECHECK_IDS of each watermark
+        self._recent_view_ids = set()
+        self._recent_click_ids = set()
+        self.last_refresh = None
+
+    # -- loading ----------------------------------------------------------
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self.last_refresh is not None and now - self.last_refresh < self.refresh_seconds:
+            return
+        self.last_refresh = now
+        started = time.perf_counter()
+        chunks = []
+        self.last_view_id = self._load(
+            select(VehicleView.id, VehicleView.vehicle_id, VehicleView.timestamp)
+            .where(VehicleView.id > self.last_view_id - RECHECK_IDS).order_by(VehicleView.id),
+            chunks, step=0, last_id=self.last_view_id, recent=self._recent_view_ids)
+        self.last_click_id = self._load(
+            select(Click.id, Click.vehicle_id, Click.timestamp, Click.click_type)
+            .where(Click.id > self.last_click_id - RECHECK_IDS).order_by(Click.id),
+            chunks, step=None, last_id=self.last_click_id, recent=self._recent_click_ids)
+        if chunks:
+            self.vehicle_ids = np.concatenate([self.vehicle_ids] + [chunk[0] for chunk in chunks])
+            self.days = np.concatenate([self.days] + [chunk[1] for chunk in chunks])
+            self.steps = np.concatenate([self.steps] + [chunk[2] for chunk in chunks])
+            self._cache.clear()
+            logger.info("Funnel events loaded", extra={
+                'events': int(sum(len(chunk[0]) for chunk in chunks)), 'total_events': len(self.steps),
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)})
+
+    def _load(self, statement, chunks, step, last_id, recent):
+        result = db.session.execute(statement.execution_options(yield_per=CHUNK_SIZE))
+        for rows in result.partitions():
+            rows = [row for row in rows if row[0] not in recent]
+            if not rows:
+                continue
+            ids, vehicle_ids, timestamps = zip(*((row[0], row[1], row[2]) for row in rows))
+            recent.update(ids)
+            days = np.array(timestamps, dtype='datetime64[D]')
+            if step is None:
+                steps = np.array([_CLICK_STEPS.get(row[3], -1) for row in rows], dtype=np.int8)
+            else:
+                steps = np.full(len(rows), step, dtype=np.int8)
+            known = (steps >= 0) & ~np.isnat(days)
+            chunks.append((np.array(vehicle_ids, dtype=np.int32)[known],
+                           (days[known] - _EPOCH).astype(np.int32), steps[known]))
+            last_id = max(last_id, ids[-1])
+        recent.difference_update([item_id for item_id in recent if item_id <= last_id - RECHECK_IDS])
+        return last_id
+
+    # -- reports ----------------------------------------------------------
+
+    def report(self, start, end, vehicle_ids=None):
+        """Funnel between ``start`` and ``end`` (inclusive dates).
+
+        Returns the daily totals of every step for the selected vehicles (all
+        when ``vehicle_ids`` is None) and the totals of each vehicle.
+        """
+        with self._lock:
+            self._refresh()
+            key = (start, end, None if vehicle_ids is None else tuple(sorted(set(vehicle_ids))))
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+            result = self._aggregate(start, end, key[2])
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return result
+
+    def _aggregate(self, start, end, vehicle_ids):
+        first_day, last_day = _day_number(start), _day_number(end)
+        n_days = max(last_day - first_day + 1, 0)
+        n_steps = len(STEPS)
+
+        mask = (self.days >= first_day) & (self.days <= last_day)
+        if vehicle_ids is not None:
+            mask &= np.isin(self.vehicle_ids, np.array(vehicle_ids, dtype=np.int32))
+        steps = self.steps[mask]
+        vehicles = self.vehicle_ids[mask]
+
+        # One bincount per table: cell = row * steps + step
+        cells = (self.days[mask] - first_day) * n_steps + steps
+        daily = np.bincount(cells, minlength=n_days * n_steps).reshape(n_days, n_steps)
+
+        # Vehicle ids are small dense integers, so they index the counts directly
+        cells = vehicles.astype(np.intp) * n_steps + steps
+        size = (int(vehicles.max()) + 1) * n_steps if len(vehicles) else 0
+        per_vehicle = np.bincount(cells, minlength=size).reshape(-1, n_steps)
+        unique_ids = np.flatnonzero(per_vehicle.any(axis=1))
+        per_vehicle = per_vehicle[unique_ids]
+
+        return {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'steps': list(STEPS),
+            'days': [(start + timedelta(days=offset)).isoformat() for offset in range(n_days)],
+            'daily': daily.tolist(),
+            'totals': dict(zip(STEPS, daily.sum(axis=0).tolist())),
+            'vehicles': {int(vehicle_id): dict(zip(STEPS, counts))
+                         for vehicle_id, counts in zip(unique_ids.tolist(), per_vehicle.tolist())},
+        }
+
+
+def conversion_rates(totals):
+    """Share of views that reached each later step"""
+    views = totals.get('views') or 0
+    return {step: round(totals.get(step, 0) / views * 100, 1) if views else 0.0 for step in STEPS[1:]}
+
+
+def parse_range(start, end, default_days=30):
+    """Parse ISO dates, defaulting to the last ``default_days`` days; raises ValueError"""
+    end = date.fromisoformat(end) if end else datetime.utcnow().date()
+    start = date.fromisoformat(start) if start else end - timedelta(days=default_days - 1)
+    if start > end:
+        raise ValueError("start after end")
+    if (end - start).days > 366 * 3:
+        raise ValueError("range too long")
+    return start, end
+
+
+def funnel_report(start, end, vehicle_ids=None):
+    return current_app.extensions['funnel_store'].report(start, end, vehicle_ids)
+
+
+def init_app(app):
+    app.extensions['funnel_store'] = FunnelStore(
+        refresh_seconds=app.config.get('FUNNEL_REFRESH_SECONDS', 30),
+    )
@@ -0,0 +1,70 @@
+import struct
+
+# JPEG start-of-frame markers that carry the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_size(stream):
+    """Return (width, height) read from the image header, or None if unknown.
+
+    Supports JPEG, PNG, GIF and WEBP. Only the header is read and the stream
+    position is restored, so the file can still be saved afterwards.
+    """
+    position = stream.tell()
+    try:
+        head = stream.read(32)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return _webp_size(head)
+        if head[:2] == b'\xff\xd8':
+            stream.seek(position + 2)
+            return _jpeg_size(stream)
+        return None
+    except (struct.error, ValueError):
+        return None
+    finally:
+        stream.seek(position)
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        bits = int.from_bytes(head[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+    return None
+
+
+def _jpeg_size(stream):
+    while True:
+        byte = stream.read(1)
+        while byte and byte != b'\xff':
+            byte = stream.read(1)
+        while byte == b'\xff':
+            byte = stream.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            continue
+        length = struct.unpack('>H', stream.read(2))[0]
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', stream.read(5))
+            return width, height
+        stream.seek(length - 2, 1)
+
+
+def stream_size(stream):
+    """Size in bytes of a seekable stream, keeping its position"""
+    position = stream.tell()
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(position)
+    return size
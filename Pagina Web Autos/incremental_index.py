@@ -0,0 +1,243 @@
+import copy
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# A table an index is built from: its model, the columns loaded for each row,
+# and the condition a row must meet to be indexed (loaded as ``row.live``)
+Source = namedtuple('Source', 'model columns live')
+
+# Seconds a worker waits before retrying a failed build
+BUILD_RETRY_SECONDS = 30
+
+
+class IncrementalIndex:
+    """In-memory index over listing rows, kept up to date without rebuilding.
+
+    Subclasses set ``name`` (their key in ``app.extensions``) and
+    ``sources``, keep everything they index in attributes assigned by
+    ``_reset()``, and implement ``_apply()`` and ``_count()``; ``_load()``
+    may replace the row-by-row first load with a bulk one, and ``_fetch()``
+    may load more data with the rows. Lookups run inside
+    ``with self._synced() as ready:``. Index keys are ``(source name, id)``
+    pairs.
+
+    Full builds run on a background thread, started by the first request a
+    worker serves and again after ``invalidate()``; lookups see the previous
+    contents, or an empty index, until the new build is swapped in. Rows
+    committed in this process are applied on the next lookup, and rows
+    changed by other workers are picked up every ``refresh_seconds`` through
+    ``updated_at``. The database is only queried outside ``_lock``, so
+    lookups never wait on it; a failed build is retried after
+    ``BUILD_RETRY_SECONDS``.
+    """
+
+    name = None
+    sources = {}
+
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        # Held while changes are fetched and applied, so they apply in order
+        self._sync_lock = threading.Lock()
+        self._pending = set()
+        self._generation = 0
+        self._swaps = 0
+        self._stale = True
+        self._builder_pid = None
+        self._next_attempt = 0.0
+        settings = set(vars(self))
+        self._clear()
+        self._state = tuple(set(vars(self)) - settings)
+
+    def _clear(self):
+        self.ready = False
+        self.watermarks = dict.fromkeys(self.sources)
+        self.last_sync = 0.0
+        self._reset()
+
+    # -- subclass hooks ---------------------------------------------------
+
+    def _reset(self):
+        """Assign empty index contents"""
+        raise NotImplementedError
+
+    def _fetch(self, kind, query):
+        """Rows of source ``kind`` selected by ``query``, as passed to ``_apply()``; runs outside the lock"""
+        return query.all()
+
+    def _load(self, rows):
+        """First load of the live rows of every source ({source name: rows})"""
+        for kind, kind_rows in rows.items():
+            self._apply(kind, kind_rows, ())
+
+    def _apply(self, kind, rows, requested_ids):
+        """Index, update or drop ``rows`` of source ``kind``; drop requested ids that have no row"""
+        raise NotImplementedError
+
+    def _count(self, kind):
+        """Number of rows of source ``kind`` in the index"""
+        raise NotImplementedError
+
+    # -- public API -------------------------------------------------------
+
+    def mark_dirty(self, keys):
+        """Schedule rows for an incremental update on the next lookup"""
+        with self._lock:
+            self._pending.update(keys)
+
+    def invalidate(self):
+        """Rebuild in the background (e.g. after bulk updates)"""
+        with self._lock:
+            self._expire()
+
+    def ensure_started(self):
+        """Start a background build if the index is stale and none is running in this process"""
+        if not self._stale or self._builder_pid == os.getpid() or time.monotonic() < self._next_attempt:
+            return
+        with self._lock:
+            if not self._stale or self._builder_pid == os.getpid() or time.monotonic() < self._next_attempt:
+                return
+            self._builder_pid = os.getpid()
+        threading.Thread(target=self._build_in_background, args=(current_app._get_current_object(),),
+                         name=f'{self.name}-build', daemon=True).start()
+
+    def build(self):
+        """Build the index from the database and swap it in"""
+        started = time.perf_counter()
+        generation = self._generation
+        fresh = copy.copy(self)
+        fresh._clear()
+        rows = {kind: self._fetch(kind, self._query(kind).filter(source.live))
+                for kind, source in self.sources.items()}
+        for kind, kind_rows in rows.items():
+            fresh._advance_watermark(kind, kind_rows)
+        fresh._load(rows)
+        # last_sync stays 0, so the first lookup after the swap refreshes from
+        # the watermarks and catches up with rows committed during the build
+        fresh.ready = True
+        with self._lock:
+            for attribute in self._state:
+                setattr(self, attribute, getattr(fresh, attribute))
+            self._stale = self._generation != generation
+            self._swaps += 1
+        logger.info("Index built", extra={
+            'index': self.name, 'rows': sum(len(kind_rows) for kind_rows in rows.values()),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)})
+
+    # -- syncing ----------------------------------------------------------
+
+    def _build_in_background(self, app):
+        try:
+            with app.app_context():
+                try:
+                    self.build()
+                finally:
+                    db.session.remove()
+        except Exception:
+            logger.exception("Index build failed", extra={'index': self.name})
+            self._next_attempt = time.monotonic() + BUILD_RETRY_SECONDS
+        finally:
+            self._builder_pid = None
+
+    def _expire(self):
+        self._generation += 1
+        self._stale = True
+
+    def _query(self, kind):
+        source = self.sources[kind]
+        return db.session.query(*source.columns, source.live.label('live'))
+
+    @contextmanager
+    def _synced(self):
+        """Hold the lock with pending and due changes applied; yields False until the first build is in"""
+        self.ensure_started()
+        if self.ready and (self._pending or time.monotonic() - self.last_sync >= self.refresh_seconds):
+            with self._sync_lock:
+                self._sync()
+        with self._lock:
+            yield self.ready
+
+    def _sync(self):
+        """Fetch pending and (when due) refreshed rows without the lock, then apply them under it"""
+        with self._lock:
+            if not self.ready:
+                return
+            changed, self._pending = self._pending, set()
+            refresh = time.monotonic() - self.last_sync >= self.refresh_seconds
+            if refresh:
+                self.last_sync = time.monotonic()
+            watermarks = dict(self.watermarks)
+            swaps = self._swaps
+        updates, live_counts = [], {}
+        for kind, source in self.sources.items():
+            ids = [item_id for item_kind, item_id in changed if item_kind == kind]
+            if ids:
+                updates.append((kind, self._fetch(kind, self._query(kind).filter(source.model.id.in_(ids))), ids))
+        if refresh:
+            # Rows changed by other processes since the last refresh
+            for kind, source in self.sources.items():
+                query = self._query(kind)
+                if watermarks[kind] is not None:
+                    query = query.filter(source.model.updated_at > watermarks[kind])
+                updates.append((kind, self._fetch(kind, query), ()))
+                live_counts[kind] = db.session.query(source.model.id).filter(source.live).count()
+        with self._lock:
+            if self._swaps != swaps:
+                # A build was swapped in meanwhile and may hold newer rows than
+                # these; fetch the changes again (the build resets last_sync)
+                self._pending |= changed
+                return
+            for kind, rows, requested_ids in updates:
+                self._update(kind, rows, requested_ids)
+            for kind, count in live_counts.items():
+                if count != self._count(kind):
+                    # Rows were hard-deleted elsewhere: rebuild
+                    self._expire()
+
+    def _update(self, kind, rows, requested_ids):
+        self._advance_watermark(kind, rows)
+        self._apply(kind, rows, requested_ids)
+
+    def _advance_watermark(self, kind, rows):
+        for row in rows:
+            if row.updated_at and (self.watermarks[kind] is None or row.updated_at > self.watermarks[kind]):
+                self.watermarks[kind] = row.updated_at
+
+    # -- change tracking --------------------------------------------------
+
+    @classmethod
+    def track_changes(cls):
+        """Queue the source rows each session commits for the current app's index"""
+        kinds = {source.model: kind for kind, source in cls.sources.items()}
+        dirty = f'{cls.name}_dirty'
+
+        def record_change(mapper, connection, target):
+            session = Session.object_session(target)
+            if session is not None:
+                session.info.setdefault(dirty, set()).add((kinds[mapper.class_], target.id))
+
+        def flush_changes(session):
+            changed = session.info.pop(dirty, None)
+            if changed and has_app_context() and cls.name in current_app.extensions:
+                current_app.extensions[cls.name].mark_dirty(changed)
+
+        def discard_changes(session, previous_transaction):
+            session.info.pop(dirty, None)
+
+        for model in kinds:
+            for identifier in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(model, identifier, record_change)
+        event.listen(Session, 'after_commit', flush_changes)
+        event.listen(Session, 'after_soft_rollback', discard_changes)
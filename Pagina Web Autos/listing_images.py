@@ -0,0 +1,141 @@
+import json
+import logging
+
+from sqlalchemy import select, update
+
+from models import db, ClientRequest, Vehicle
+from storage import UPLOAD_PREFIX, get_storage, upload_url
+
+logger = logging.getLogger(__name__)
+
+# Attempts of the read / conditional-update cycle before giving up
+MAX_ATTEMPTS = 3
+
+
+class ImageListConflict(Exception):
+    """The image list kept changing while it was being updated"""
+
+
+def image_paths(images):
+    """Parse the JSON ``images`` column into a list of stored paths"""
+    if not images:
+        return []
+    try:
+        paths = json.loads(images)
+    except ValueError:
+        return []
+    return paths if isinstance(paths, list) else []
+
+
+def image_items(item):
+    """Image list of a vehicle or request as sent to the image manager"""
+    return {
+        'images': [{'path': path, 'url': upload_url(path)} for path in image_paths(item.images)],
+        'main_index': _main_index(item),
+    }
+
+
+def _main_index(item):
+    # Requests have no main image column: their main image is the first one
+    if isinstance(item, Vehicle):
+        return item.main_image_index or 0
+    return 0
+
+
+def update_images(item, change):
+    """Apply ``change`` to the images of ``item`` with a single conditional UPDATE.
+
+    ``change`` receives (paths, main_index) and returns the new pair, or
+    raises ValueError if the operation does not apply; ``main_index`` is None
+    for requests, whose main image is always the first one. The UPDATE only
+    matches the row if its images are still the ones that were read, so
+    concurrent edits from two tabs never overwrite each other; on a conflict
+    the row is re-read and the change applied again.
+
+    Returns the (old, new) lists of paths.
+    """
+    model = type(item)
+    has_main_index = model is Vehicle
+    for _ in range(MAX_ATTEMPTS):
+        columns = [model.images] + ([model.main_image_index] if has_main_index else [])
+        current = db.session.execute(select(*columns).where(model.id == item.id)).one()
+        paths = image_paths(current.images)
+        main_index = (current.main_image_index or 0) if has_main_index else None
+        new_paths, new_main_index = change(list(paths), main_index)
+
+        conditions = [model.id == item.id, model.images == current.images]
+        values = {'images': json.dumps(new_paths)}
+        if has_main_index:
+            conditions.append(model.main_image_index == current.main_image_index)
+            values['main_image_index'] = new_main_index
+        matched = db.session.execute(
+            update(model).where(*conditions).values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if matched:
+            db.session.commit()
+            db.session.refresh(item)
+            return paths, new_paths
+        db.session.rollback()
+    raise ImageListConflict(item.id)
+
+
+def add_images(paths, main_index, new_paths):
+    return paths + new_paths, main_index
+
+
+def remove_image(paths, main_index, path):
+    if path not in paths:
+        raise ValueError(path)
+    position = paths.index(path)
+    paths.pop(position)
+    if main_index is not None:
+        if position == main_index:
+            main_index = 0
+        elif position < main_index:
+            main_index -= 1
+    return paths, main_index
+
+
+def reorder_images(paths, main_index, order):
+    if sorted(order) != sorted(paths):
+        raise ValueError(order)
+    if main_index is None:
+        return list(order), None
+    main_path = paths[main_index] if main_index < len(paths) else None
+    return list(order), order.index(main_path) if main_path in order else 0
+
+
+def set_main_image(paths, main_index, path):
+    if path not in paths:
+        raise ValueError(path)
+    if main_index is None:
+        paths.insert(0, paths.pop(paths.index(path)))
+        return paths, None
+    return paths, paths.index(path)
+
+
+def is_referenced(path):
+    """Whether any vehicle or request still lists ``path``
+
+    Approved requests share their files with the vehicle created from them,
+    so a file can only be deleted once no row mentions it.
+    """
+    pattern = f'%{json.dumps(path)}%'
+    for model in (Vehicle, ClientRequest):
+        for images in db.session.execute(select(model.images).where(model.images.like(pattern))).scalars():
+            if path in image_paths(images):
+                return True
+    return False
+
+
+def delete_unreferenced(paths):
+    """Delete the uploaded files among ``paths`` that no row references any more"""
+    storage = get_storage()
+    for path in paths:
+        if not path.startswith(UPLOAD_PREFIX) or is_referenced(path):
+            continue
+        try:
+            storage.delete(path[len(UPLOAD_PREFIX):])
+        except Exception as e:
+            logger.warning("Error deleting image %s: %s", path, e, extra={'path': path})
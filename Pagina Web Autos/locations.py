@@ -0,0 +1,128 @@
+import logging
+import math
+import unicodedata
+
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from models import db, ClientRequest, LocalityDistance, Vehicle
+
+logger = logging.getLogger(__name__)
+
+# Localities served by the marketplace and their coordinates (lat, lon)
+LOCALITIES = {
+    'Tunuyán': (-33.5781, -69.0150),
+    'Tupungato': (-33.3713, -69.1480),
+    'San Carlos': (-33.7743, -69.0426),
+}
+
+# Radius options offered by the "within N km" filter
+RADIUS_OPTIONS_KM = (30, 50)
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def haversine_km(origin, destination):
+    """Great-circle distance in kilometers between two (lat, lon) pairs"""
+    lat1, lon1 = map(math.radians, origin)
+    lat2, lon2 = map(math.radians, destination)
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def sync_locality_distances():
+    """Rebuild the locality distance table from LOCALITIES.
+
+    Every (origin, destination) pair is stored, including each locality with
+    itself at 0 km, so a radius filter is a single indexed lookup on origin.
+    """
+    db.session.execute(delete(LocalityDistance))
+    db.session.add_all(
+        LocalityDistance(origin=origin, destination=destination,
+                         distance_km=round(haversine_km(origin_point, destination_point), 1))
+        for origin, origin_point in LOCALITIES.items()
+        for destination, destination_point in LOCALITIES.items()
+    )
+    db.session.commit()
+
+
+def _fold(value):
+    value = unicodedata.normalize('NFKD', value or '')
+    return ' '.join(''.join(char for char in value if not unicodedata.combining(char)).casefold().split())
+
+
+_LOCALITY_NAMES = {_fold(name): name for name in LOCALITIES}
+
+
+def canonical_locality(value):
+    """The LOCALITIES name ``value`` spells, ignoring case, accents and spacing; None if it is none of them"""
+    return _LOCALITY_NAMES.get(_fold(value))
+
+
+def localities_within(origin, radius_km):
+    """Subquery of the localities at most ``radius_km`` away from ``origin``"""
+    return select(LocalityDistance.destination).where(
+        LocalityDistance.origin == origin,
+        LocalityDistance.distance_km <= radius_km,
+    )
+
+
+def location_filter(location, radius_km=None):
+    """Condition on vehicles in ``location``, or within ``radius_km`` of it.
+
+    Only listings located in one of LOCALITIES can be placed by distance. A
+    search without a radius also keeps the others: those whose free-text
+    location contains ``location`` and, for listings without one, those
+    whose title does.
+    """
+    if radius_km:
+        return Vehicle.location.in_(localities_within(location, radius_km))
+    pattern = f"%{location}%"
+    return or_(
+        Vehicle.location == location,
+        and_(Vehicle.location.notin_(list(LOCALITIES)), Vehicle.location.ilike(pattern)),
+        and_(Vehicle.location.is_(None), Vehicle.title.ilike(pattern)),
+    )
+
+
+def backfill_vehicle_locations():
+    """Fill and normalize Vehicle.location; return a report of the changes.
+
+    Vehicles without a location get the one of their originating client
+    request, and locations spelling one of LOCALITIES differently are
+    rewritten to its name. Values that match no locality are left as they
+    are, counted in ``unmatched`` and logged, since radius searches cannot
+    place them.
+    """
+    request_location = (
+        select(ClientRequest.location)
+        .where(ClientRequest.id == Vehicle.client_request_id)
+        .scalar_subquery()
+    )
+    report = {'copied': 0, 'normalized': 0, 'unmatched': 0}
+    report['copied'] = db.session.execute(
+        update(Vehicle)
+        .where(Vehicle.location.is_(None), Vehicle.client_request_id.isnot(None))
+        .values(location=request_location)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    unmatched = {}
+    for value, count in db.session.execute(
+        select(Vehicle.location, func.count())
+        .where(Vehicle.location.isnot(None), Vehicle.location.notin_(list(LOCALITIES)))
+        .group_by(Vehicle.location)
+    ):
+        locality = canonical_locality(value)
+        if locality is None:
+            unmatched[value] = count
+            continue
+        report['normalized'] += db.session.execute(
+            update(Vehicle).where(Vehicle.location == value).values(location=locality)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    db.session.commit()
+    report['unmatched'] = sum(unmatched.values())
+    if unmatched:
+        logger.warning("Vehicle locations outside the known localities", extra={
+            'unmatched': unmatched, 'localities': list(LOCALITIES)})
+    return report
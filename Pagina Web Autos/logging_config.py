@@ -0,0 +1,165 @@
+import atexit
+import copy
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import has_request_context, request
+
+# Default level per deployment environment (APP_ENV, INFO when unset or
+# unknown); LOG_LEVEL overrides it
+ENVIRONMENT_LEVELS = {
+    'development': logging.DEBUG,
+    'testing': logging.WARNING,
+    'production': logging.INFO,
+}
+
+# Libraries whose debug output is too chatty to ever reach the request path
+NOISY_LOGGERS = {
+    'sqlalchemy.engine': logging.WARNING,
+    'sqlalchemy.pool': logging.WARNING,
+    'werkzeug': logging.INFO,
+}
+
+# Attributes every LogRecord has; anything else was passed through ``extra=``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener = None
+
+# The queue handler configure_logging() put on the root logger
+_handler = None
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach the current request method and path to records emitted inside a request"""
+
+    def filter(self, record):
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keep only one out of every ``every`` DEBUG records; other levels always pass"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, int(every))
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+        return next(self._counter) % self.every == 0
+
+
+class _StructuredQueueHandler(QueueHandler):
+    """QueueHandler that keeps records structured.
+
+    The stock ``prepare`` runs the full formatter in the calling thread; here
+    only the message is merged so JSON encoding and the write happen on the
+    listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _start_listener(handler_queue, stream):
+    global _listener
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter())
+    _listener = QueueListener(handler_queue, output, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+# The queue handler configure_logging() put on the root logger
+_handler = None
+
+
+def configure_logging(app, stream=None):
+    """Route all logging through a queue drained by a background thread.
+
+    Request threads only enqueue records; formatting to JSON and writing to
+    ``stream`` (stderr by default) happen on the listener thread. Configuring
+    more than once in a process is a no-op, and forked workers restart their
+    own listener since threads do not survive ``fork``. An unknown
+    ``LOG_LEVEL`` falls back to the environment's level with a warning.
+    """
+    environment = app.config.get('APP_ENV') or os.environ.get('APP_ENV')
+    level = ENVIRONMENT_LEVELS.get(environment, logging.INFO)
+    level_name = app.config.get('LOG_LEVEL') or os.environ.get('LOG_LEVEL')
+    named_level = logging.getLevelName(str(level_name).upper()) if level_name else None
+    if isinstance(named_level, int):
+        level = named_level
+    sample_every = app.config.get('LOG_DEBUG_SAMPLE_EVERY') or os.environ.get('LOG_DEBUG_SAMPLE_EVERY', 10)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for name, noisy_level in NOISY_LOGGERS.items():
+        logging.getLogger(name).setLevel(max(level, noisy_level))
+
+    if _listener is None:
+        _install_handler(root, sample_every, stream or sys.stderr)
+    if level_name and not isinstance(named_level, int):
+        logger.warning("Unknown LOG_LEVEL %r, using %s", level_name, logging.getLevelName(level))
+
+
+def _install_handler(root, sample_every, stream):
+    global _handler
+    handler_queue = queue.SimpleQueue()
+    handler = _StructuredQueueHandler(handler_queue)
+    handler.addFilter(RequestContextFilter())
+    handler.addFilter(DebugSamplingFilter(sample_every))
+    # Only our own earlier handler is replaced; handlers added by others
+    # (e.g. pytest's log capture) stay
+    if _handler is not None:
+        root.removeHandler(_handler)
+    root.addHandler(handler)
+    _handler = handler
+
+    _start_listener(handler_queue, stream)
+    atexit.register(_stop_listener)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: _start_listener(handler_queue, stream))
@@ -1,21 +1,50 @@
 from datetime import datetime
 from sqlalchemy import func
 from flask_sqlalchemy import SQLAlchemy
+from db_routing import ANALYTICS_BIND, RoutingSession
+from storage import upload_url
 
 # Create db instance
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class Admin(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
 
+class ExchangeRate(db.Model):
+    """Cotización en pesos argentinos de una moneda extranjera"""
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), unique=True, nullable=False)  # USD
+    rate_to_ars = db.Column(db.Float, nullable=False)  # ARS per unit of currency
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LocalityDistance(db.Model):
+    """Distancia precalculada entre dos localidades (incluida cada una consigo misma)"""
+    origin = db.Column(db.String(50), primary_key=True)
+    destination = db.Column(db.String(50), primary_key=True)
+    distance_km = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_locality_distance_origin_km', 'origin', 'distance_km'),
+    )
+
 class Vehicle(db.Model):
+    # Composite indexes back the SQL sort modes of index(); the trailing id
+    # makes every ordering total, so pages can also be walked by keyset
+    __table_args__ = (
+        db.Index('ix_vehicle_active_price', 'is_active', 'price_ars_normalized', 'id'),
+        db.Index('ix_vehicle_active_created', 'is_active', 'created_at', 'id'),
+        db.Index('ix_vehicle_active_km', 'is_active', 'kilometers', 'id'),
+        db.Index('ix_vehicle_active_location', 'is_active', 'location', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=False)
     price = db.Column(db.Integer, nullable=False)
     currency = db.Column(db.String(3), default='ARS')  # USD or ARS
+    price_ars_normalized = db.Column(db.BigInteger, nullable=True)  # price in ARS, maintained by pricing.py
     year = db.Column(db.Integer)
     brand = db.Column(db.String(100))
     model = db.Column(db.String(100))
@@ -23,6 +52,7 @@ class Vehicle(db.Model):
     fuel_type = db.Column(db.String(50))
     transmission = db.Column(db.String(50))
     color = db.Column(db.String(50))
+    location = db.Column(db.String(50), nullable=True)  # Tunuyán, Tupungato, San Carlos
     images = db.Column(db.Text)  # JSON string of image URLs
     main_image_index = db.Column(db.Integer, default=0)  # Index of the main image to display
     whatsapp_number = db.Column(db.String(20), nullable=True)  # WhatsApp number
@@ -39,22 +69,16 @@ class Vehicle(db.Model):
     client_request_id = db.Column(db.Integer, db.ForeignKey('client_request.id'), nullable=True)  # Link to original request if created from client request
     
     # Relationships
-    clicks = db.relationship('Click', backref='vehicle', lazy=True, cascade='all, delete-orphan')
+    clicks = db.relationship('Click', backref='vehicle', lazy=True, cascade='all, delete-orphan',
+                             primaryjoin='Vehicle.id == foreign(Click.vehicle_id)')
     
     def get_images_list(self):
         if self.images:
             import json
             try:
                 images = json.loads(self.images)
-                # Convert relative paths to full URLs for Flask
-                processed_images = []
-                for img in images:
-                    if img.startswith('uploads/'):
-                        from flask import url_for
-                        processed_images.append(url_for('static', filename=img))
-                    else:
-                        processed_images.append(img)
-                return processed_images
+                # Convert stored paths to public URLs of the upload storage
+                return [upload_url(img) for img in images]
             except:
                 return []
         return []
@@ -68,13 +92,7 @@ class Vehicle(db.Model):
         if images:
             # Use the main_image_index to get the selected main image
             main_index = self.main_image_index if self.main_image_index < len(images) else 0
-            main_image = images[main_index]
-            
-            # If it's a local file path, add static/ prefix for Flask url_for
-            if main_image.startswith('uploads/'):
-                from flask import url_for
-                return url_for('static', filename=main_image)
-            return main_image
+            return images[main_index]
         return None  # Return None instead of placeholder for free publications
     
     def format_price(self):
@@ -167,21 +185,24 @@ class Vehicle(db.Model):
         return request.host_url.rstrip('/') + url_for('vehicle_detail', id=self.id)
 
 class Click(db.Model):
+    __bind_key__ = ANALYTICS_BIND
     id = db.Column(db.Integer, primary_key=True)
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, nullable=False, index=True)  # References vehicle.id
     click_type = db.Column(db.String(20), nullable=False)  # 'whatsapp' or 'offer'
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.String(500))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class VehicleView(db.Model):
+    __bind_key__ = ANALYTICS_BIND
     id = db.Column(db.Integer, primary_key=True)
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, nullable=False, index=True)  # References vehicle.id
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.String(500))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
-    vehicle = db.relationship('Vehicle', backref='views')
+    vehicle = db.relationship('Vehicle', backref=db.backref('views', cascade='all, delete-orphan'),
+                              primaryjoin='foreign(VehicleView.vehicle_id) == Vehicle.id')
 
 class ClientRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -224,15 +245,8 @@ class ClientRequest(db.Model):
             import json
             try:
                 images = json.loads(self.images)
-                # Convert relative paths to full URLs for Flask
-                processed_images = []
-                for img in images:
-                    if img.startswith('uploads/'):
-                        from flask import url_for
-                        processed_images.append(url_for('static', filename=img))
-                    else:
-                        processed_images.append(img)
-                return processed_images
+                # Convert stored paths to public URLs of the upload storage
+                return [upload_url(img) for img in images]
             except:
                 return []
         return []
@@ -273,8 +287,57 @@ class ClientRequest(db.Model):
         import urllib.parse
         return f"https://wa.me/{self.phone_number.replace('+', '')}?text={urllib.parse.quote(message)}"
 
+class ImageFingerprint(db.Model):
+    """Hash perceptual (dHash de 64 bits, en hexadecimal) de una imagen subida"""
+    path = db.Column(db.String(300), primary_key=True)  # "uploads/<name>"
+    phash = db.Column(db.String(16), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SavedSearch(db.Model):
+    """Búsqueda guardada por un comprador para recibir avisos de vehículos nuevos"""
+    id = db.Column(db.Integer, primary_key=True)
+    phone_number = db.Column(db.String(20), nullable=False, index=True)
+    filters = db.Column(db.Text, nullable=False)  # JSON with the filters of index()
+    term_count = db.Column(db.Integer, nullable=False)  # Distinct fields in saved_search_term
+    token = db.Column(db.String(64), unique=True, nullable=False)  # For the unsubscribe link
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_notified_at = db.Column(db.DateTime, nullable=True)
+    
+    terms = db.relationship('SavedSearchTerm', backref='saved_search', cascade='all, delete-orphan')
+
+class SavedSearchTerm(db.Model):
+    """Entrada del índice invertido: una condición de igualdad de una búsqueda guardada"""
+    search_id = db.Column(db.Integer, db.ForeignKey('saved_search.id'), primary_key=True)
+    field = db.Column(db.String(20), primary_key=True)  # brand, location, fuel_type, transmission or *
+    value = db.Column(db.String(100), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_saved_search_term_lookup', 'field', 'value', 'search_id'),
+    )
+
+class AlertNotification(db.Model):
+    """Aviso de vehículo nuevo pendiente de envío (bandeja de salida)"""
+    id = db.Column(db.Integer, primary_key=True)
+    saved_search_id = db.Column(db.Integer, db.ForeignKey('saved_search.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, nullable=False)
+    phone_number = db.Column(db.String(20), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime, nullable=True)  # When a worker took it for sending
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('saved_search_id', 'vehicle_id'),
+        db.Index('ix_alert_notification_status', 'status', 'id'),
+    )
+
 class PageVisit(db.Model):
     """Model to track page visits"""
+    __bind_key__ = ANALYTICS_BIND
     id = db.Column(db.Integer, primary_key=True)
     page = db.Column(db.String(100), nullable=False)  # 'index', 'vehicle_detail', etc.
     ip_address = db.Column(db.String(45), nullable=True)  # IPv4 or IPv6
@@ -0,0 +1,55 @@
+import logging
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+class LogSender:
+    """Writes messages to the log instead of sending them.
+
+    The default sender for development and tests.
+    """
+
+    def send(self, to, body):
+        logger.info("Notification (not sent, log sender)", extra={'to': to, 'body': body})
+
+
+class TwilioSender:
+    """SMS or WhatsApp messages through Twilio.
+
+    A ``from_number`` like ``whatsapp:+14155238886`` sends through the
+    WhatsApp channel; recipients are prefixed the same way.
+    """
+
+    def __init__(self, account_sid, auth_token, from_number):
+        from twilio.rest import Client  # only needed with ALERT_SENDER=twilio
+
+        self.client = Client(account_sid, auth_token)
+        self.from_number = from_number
+        self.channel = 'whatsapp:' if from_number.startswith('whatsapp:') else ''
+
+    def send(self, to, body):
+        to = to if to.startswith(self.channel) else self.channel + to
+        self.client.messages.create(to=to, from_=self.from_number, body=body)
+
+
+def get_sender():
+    return current_app.extensions['notification_sender']
+
+
+def create_sender(config):
+    backend = config.get('ALERT_SENDER', 'log')
+    if backend == 'twilio':
+        return TwilioSender(
+            account_sid=config['TWILIO_ACCOUNT_SID'],
+            auth_token=config['TWILIO_AUTH_TOKEN'],
+            from_number=config['TWILIO_FROM_NUMBER'],
+        )
+    if backend == 'log':
+        return LogSender()
+    raise ValueError(f"Unknown ALERT_SENDER backend: {backend}")
+
+
+def init_app(app):
+    app.extensions['notification_sender'] = create_sender(app.config)
@@ -0,0 +1,287 @@
+import math
+import unicodedata
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import and_
+
+from incremental_index import IncrementalIndex, Source
+from models import Vehicle
+from pricing import get_rate
+
+# Categories offered by the submission form; anything else is the baseline
+FUEL_TYPES = ('nafta', 'diesel', 'gnc', 'hibrido', 'electrico')
+TRANSMISSIONS = ('manual', 'automatica', 'cvt')
+
+# Features: intercept, age and age squared (decades from REFERENCE_YEAR),
+# log kilometers, kilometers missing, then fuel and transmission indicators
+REFERENCE_YEAR = 2015
+NUM_FEATURES = 5 + len(FUEL_TYPES) + len(TRANSMISSIONS)
+
+# A group needs this many listings to be used; smaller ones fall back to the parent
+MIN_GROUP_SIZE = 3
+
+# Weight (in pseudo-listings) pulling a group's coefficients towards its parent's
+# (model -> brand -> all listings), so small groups only adjust the market curve
+PRIOR_STRENGTH = 5.0
+GLOBAL_RIDGE = 1e-3
+
+# Residual spread used when a group is too small to measure its own
+DEFAULT_SIGMA = 0.35
+
+_GLOBAL = ('global',)
+
+
+def _key(value):
+    value = unicodedata.normalize('NFKD', (value or '').strip().lower())
+    return ''.join(char for char in value if not unicodedata.combining(char))
+
+
+_KM_COLUMNS = slice(3, 5)
+_FUEL_COLUMNS = slice(5, 5 + len(FUEL_TYPES))
+_TRANSMISSION_COLUMNS = slice(5 + len(FUEL_TYPES), NUM_FEATURES)
+
+
+def features(year, kilometers, fuel_type, transmission):
+    """Feature vector of a vehicle (``year`` is required)"""
+    x = np.zeros(NUM_FEATURES)
+    age = (year - REFERENCE_YEAR) / 10
+    x[0], x[1], x[2] = 1.0, age, age * age
+    if kilometers is None:
+        x[4] = 1.0
+    else:
+        x[3] = math.log1p(max(kilometers, 0)) / 10
+    fuel = _key(fuel_type)
+    if fuel in FUEL_TYPES:
+        x[_FUEL_COLUMNS][FUEL_TYPES.index(fuel)] = 1.0
+    transmission = _key(transmission)
+    if transmission in TRANSMISSIONS:
+        x[_TRANSMISSION_COLUMNS][TRANSMISSIONS.index(transmission)] = 1.0
+    return x
+
+
+def _unknown_columns(kilometers, fuel_type, transmission):
+    """Feature columns the seller has not filled in yet"""
+    unknown = []
+    if kilometers is None:
+        unknown.append(_KM_COLUMNS)
+    if _key(fuel_type) not in FUEL_TYPES:
+        unknown.append(_FUEL_COLUMNS)
+    if _key(transmission) not in TRANSMISSIONS:
+        unknown.append(_TRANSMISSION_COLUMNS)
+    return unknown
+
+
+def groups(brand, model):
+    """Groups a vehicle belongs to, most specific first"""
+    brand, model = _key(brand), _key(model)
+    found = []
+    if brand and model:
+        found.append(('model', brand, model))
+    if brand:
+        found.append(('brand', brand))
+    found.append(_GLOBAL)
+    return tuple(found)
+
+
+class _GroupStats:
+    """Sufficient statistics of a least-squares fit: X'X, X'y, y'y and n"""
+
+    __slots__ = ('xtx', 'xty', 'yty', 'n')
+
+    def __init__(self):
+        self.xtx = np.zeros((NUM_FEATURES, NUM_FEATURES))
+        self.xty = np.zeros(NUM_FEATURES)
+        self.yty = 0.0
+        self.n = 0
+
+    def add(self, x, y, sign=1):
+        self.xtx += sign * np.outer(x, x)
+        self.xty += sign * y * x
+        self.yty += sign * y * y
+        self.n += sign
+
+
+class PriceEstimator(IncrementalIndex):
+    """Log-price regression of active vehicles, per brand/model with fallbacks.
+
+    Each group (model, brand, whole catalog) keeps the sufficient statistics
+    of its least-squares problem, so a changed listing updates them in
+    O(features²) and only the groups it belongs to are solved again, lazily,
+    on the next estimate. Coefficients are shrunk towards the parent group's,
+    which keeps rare models sensible. Prices are fitted in ARS
+    (``price_ars_normalized``) and converted to the requested currency.
+    """
+
+    name = 'price_estimator'
+    sources = {
+        'vehicle': Source(Vehicle, (Vehicle.id, Vehicle.brand, Vehicle.model, Vehicle.year, Vehicle.kilometers,
+                                    Vehicle.fuel_type, Vehicle.transmission, Vehicle.price_ars_normalized,
+                                    Vehicle.updated_at),
+                          and_(Vehicle.is_active == True, Vehicle.year.isnot(None), Vehicle.price_ars_normalized > 0)),
+    }
+
+    def _reset(self):
+        self.stats = {}
+        self.contributions = {}
+        self.fits = {}
+
+    # -- public API -------------------------------------------------------
+
+    def estimate(self, brand, model, year, kilometers=None, fuel_type=None, transmission=None):
+        """Estimated ARS price as a dict, or None if there is no usable group"""
+        x = features(year, kilometers, fuel_type, transmission)
+        unknown = _unknown_columns(kilometers, fuel_type, transmission)
+        with self._synced() as ready:
+            if not ready:
+                return None
+            for group in groups(brand, model):
+                fit = self._fit(group)
+                if fit is None:
+                    continue
+                beta, sigma, n = fit
+                # Details not given yet take the group's average (row 0 of X'X holds the sums)
+                stats = self.stats[group]
+                for columns in unknown:
+                    x[columns] = stats.xtx[0, columns] / stats.n
+                log_price = float(x @ beta)
+                return {
+                    'price': math.exp(log_price),
+                    'low': math.exp(log_price - sigma),
+                    'high': math.exp(log_price + sigma),
+                    'group': group[0],
+                    'sample_size': n,
+                }
+        return None
+
+    # -- building ---------------------------------------------------------
+
+    def _load(self, rows):
+        rows = rows['vehicle']
+        if not rows:
+            return
+        # Accumulate every group's statistics with one scatter-add per array
+        X = np.array([features(row.year, row.kilometers, row.fuel_type, row.transmission) for row in rows])
+        y = np.log(np.array([row.price_ars_normalized for row in rows], dtype=float))
+        memberships = [groups(row.brand, row.model) for row in rows]
+        index = {}
+        pairs = [(position, index.setdefault(group, len(index)))
+                 for position, row_groups in enumerate(memberships) for group in row_groups]
+        positions, codes = np.array(pairs).T
+        xtx = np.zeros((len(index), NUM_FEATURES, NUM_FEATURES))
+        np.add.at(xtx, codes, X[positions, :, None] * X[positions, None, :])
+        xty = np.zeros((len(index), NUM_FEATURES))
+        np.add.at(xty, codes, X[positions] * y[positions, None])
+        yty = np.bincount(codes, weights=y[positions] ** 2, minlength=len(index))
+        n = np.bincount(codes, minlength=len(index))
+        for group, code in index.items():
+            stats = self.stats[group] = _GroupStats()
+            stats.xtx, stats.xty, stats.yty, stats.n = xtx[code], xty[code], float(yty[code]), int(n[code])
+        self.contributions = {row.id: (row_groups, X[i], y[i])
+                              for i, (row, row_groups) in enumerate(zip(rows, memberships))}
+
+    def _count(self, kind):
+        return len(self.contributions)
+
+    def _apply(self, kind, rows, requested_ids):
+        seen = {row.id for row in rows}
+        for vehicle_id in requested_ids:
+            if vehicle_id not in seen:
+                self._withdraw(vehicle_id)
+        for row in rows:
+            self._withdraw(row.id)
+            if not row.live:
+                continue
+            row_groups = groups(row.brand, row.model)
+            x = features(row.year, row.kilometers, row.fuel_type, row.transmission)
+            y = math.log(row.price_ars_normalized)
+            for group in row_groups:
+                self.stats.setdefault(group, _GroupStats()).add(x, y)
+            self.contributions[row.id] = (row_groups, x, y)
+            self._forget(row_groups)
+
+    def _withdraw(self, vehicle_id):
+        contribution = self.contributions.pop(vehicle_id, None)
+        if contribution is None:
+            return
+        row_groups, x, y = contribution
+        for group in row_groups:
+            stats = self.stats[group]
+            stats.add(x, y, sign=-1)
+            if not stats.n:
+                del self.stats[group]
+        self._forget(row_groups)
+
+    def _forget(self, row_groups):
+        # A parent's coefficients are the prior of its children, so a change to
+        # a brand or to the whole catalog invalidates every fit below it
+        if _GLOBAL in row_groups:
+            self.fits.clear()
+            return
+        for group in row_groups:
+            self.fits.pop(group, None)
+
+    # -- fitting ----------------------------------------------------------
+
+    def _fit(self, group):
+        """(coefficients, residual sigma, size) of ``group``, or None if too small"""
+        if group in self.fits:
+            return self.fits[group]
+        stats = self.stats.get(group)
+        fit = None
+        if stats is not None and stats.n >= MIN_GROUP_SIZE:
+            parent = self._parent_fit(group)
+            if parent is None:
+                prior, strength, parent_sigma = np.zeros(NUM_FEATURES), GLOBAL_RIDGE, DEFAULT_SIGMA
+            else:
+                prior, parent_sigma, _ = parent
+                strength = PRIOR_STRENGTH
+            beta = np.linalg.solve(stats.xtx + strength * np.eye(NUM_FEATURES),
+                                   stats.xty + strength * prior)
+            sse = max(stats.yty - 2 * beta @ stats.xty + beta @ stats.xtx @ beta, 0.0)
+            # Blend the measured spread with the parent's until the group has enough listings
+            sigma = math.sqrt((sse + PRIOR_STRENGTH * parent_sigma ** 2) / (stats.n + PRIOR_STRENGTH))
+            fit = (beta, sigma, stats.n)
+        self.fits[group] = fit
+        return fit
+
+    def _parent_fit(self, group):
+        if group[0] == 'model':
+            return self._fit(('brand', group[1])) or self._fit(_GLOBAL)
+        if group[0] == 'brand':
+            return self._fit(_GLOBAL)
+        return None
+
+
+def _round_price(value):
+    """Round to three significant digits, as sellers would write the price"""
+    if value <= 0:
+        return 0
+    digits = int(math.floor(math.log10(value))) - 2
+    return int(round(value, -digits)) if digits > 0 else int(round(value))
+
+
+def suggest_price(brand, model, year, kilometers=None, fuel_type=None, transmission=None, currency='ARS'):
+    """Suggested price in ``currency`` as {price, low, high, ...}, or None"""
+    estimator = current_app.extensions['price_estimator']
+    estimate = estimator.estimate(brand, model, year, kilometers, fuel_type, transmission)
+    rate = get_rate(currency)
+    if estimate is None or not rate:
+        return None
+    return {
+        'currency': currency,
+        'price': _round_price(estimate['price'] / rate),
+        'low': _round_price(estimate['low'] / rate),
+        'high': _round_price(estimate['high'] / rate),
+        'group': estimate['group'],
+        'sample_size': estimate['sample_size'],
+    }
+
+
+def init_app(app):
+    index = PriceEstimator(refresh_seconds=app.config.get('PRICE_ESTIMATOR_REFRESH_SECONDS', 60))
+    app.extensions[index.name] = index
+    app.before_request(index.ensure_started)
+
+
+PriceEstimator.track_changes()
@@ -0,0 +1,87 @@
+import logging
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, select, update
+
+from models import db, ExchangeRate, Vehicle
+
+logger = logging.getLogger(__name__)
+
+BASE_CURRENCY = 'ARS'
+
+
+def normalized_price(price, currency, rate):
+    """Price expressed in ARS given the rate of its currency"""
+    if price is None:
+        return None
+    if not currency or currency == BASE_CURRENCY:
+        return int(price)
+    return int(round(price * rate)) if rate else None
+
+
+def get_rate(currency, connection=None):
+    """Current ARS rate of ``currency``, or None if it has not been set"""
+    if not currency or currency == BASE_CURRENCY:
+        return 1
+    statement = select(ExchangeRate.rate_to_ars).where(ExchangeRate.currency == currency)
+    executor = connection if connection is not None else db.session
+    return executor.execute(statement).scalar()
+
+
+def set_exchange_rate(currency, rate):
+    """Store a new rate and recompute the normalized price of every vehicle in that currency.
+
+    The recomputation is a single UPDATE, so its cost does not depend on how
+    many listings are loaded in Python.
+    """
+    exchange_rate = ExchangeRate.query.filter_by(currency=currency).first()
+    if exchange_rate is None:
+        exchange_rate = ExchangeRate(currency=currency)
+        db.session.add(exchange_rate)
+    exchange_rate.rate_to_ars = rate
+    result = db.session.execute(
+        update(Vehicle)
+        .where(Vehicle.currency == currency)
+        .values(price_ars_normalized=func.round(Vehicle.price * rate))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    logger.info("Exchange rate updated", extra={'currency': currency, 'rate': rate, 'vehicles': result.rowcount})
+    if has_app_context():
+        for name in ('similar_vehicles', 'price_estimator'):
+            if name in current_app.extensions:
+                current_app.extensions[name].invalidate()
+    return result.rowcount
+
+
+def backfill_normalized_prices():
+    """Fill price_ars_normalized for vehicles created before the column existed"""
+    updated = db.session.execute(
+        update(Vehicle)
+        .where(Vehicle.price_ars_normalized.is_(None), db.or_(Vehicle.currency == BASE_CURRENCY,
+                                                               Vehicle.currency.is_(None)))
+        .values(price_ars_normalized=Vehicle.price)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    for exchange_rate in ExchangeRate.query.all():
+        updated += db.session.execute(
+            update(Vehicle)
+            .where(Vehicle.price_ars_normalized.is_(None), Vehicle.currency == exchange_rate.currency)
+            .values(price_ars_normalized=func.round(Vehicle.price * exchange_rate.rate_to_ars))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    db.session.commit()
+    return updated
+
+
+@event.listens_for(Vehicle, 'before_insert')
+def _normalize_new_vehicle_price(mapper, connection, target):
+    target.price_ars_normalized = normalized_price(
+        target.price, target.currency, get_rate(target.currency, connection))
+
+
+@event.listens_for(Vehicle, 'before_update')
+def _normalize_updated_vehicle_price(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.price.history.has_changes() or state.attrs.currency.history.has_changes():
+        _normalize_new_vehicle_price(mapper, connection, target)
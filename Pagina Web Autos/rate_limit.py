@@ -0,0 +1,203 @@
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+
+logger = logging.getLogger(__name__)
+
+# Default limits: name -> (requests, per seconds, burst)
+DEFAULT_LIMITS = {
+    'vehicle_detail': (120, 60, 40),
+    'track_click': (30, 60, 10),
+    'client_request': (5, 3600, 3),
+    'price_estimate': (60, 60, 30),
+    'saved_search': (10, 3600, 5),
+}
+
+# Buckets kept by the in-process backend before the least recently used are dropped
+MAX_MEMORY_BUCKETS = 100_000
+
+# Shared buckets untouched for this long are deleted now and then
+STALE_BUCKET_SECONDS = 24 * 3600
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryBuckets:
+    """Token buckets held in this process (limits apply per worker)"""
+
+    def __init__(self, max_buckets=MAX_MEMORY_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, name=None):
+        """Take one token; return the seconds to wait, 0 if the request is admitted"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def totals(self):
+        return None
+
+
+class SQLiteBuckets:
+    """Token buckets in a SQLite file shared by every worker of this host.
+
+    Each decision is one short ``BEGIN IMMEDIATE`` transaction, so workers
+    never hand out the same token twice. The per-limit counters are kept in
+    the same file so monitoring sees totals across workers.
+    """
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS bucket "
+                               "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS counter "
+                               "(name TEXT NOT NULL, outcome TEXT NOT NULL, total INTEGER NOT NULL, "
+                               "PRIMARY KEY (name, outcome))")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, rate, burst, name=None):
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens = _refill(*(row or (burst, now)), now, rate, burst)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            connection.execute("INSERT INTO bucket (key, tokens, updated) VALUES (?, ?, ?) "
+                               "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                               (key, tokens, now))
+            if name is not None:
+                connection.execute("INSERT INTO counter (name, outcome, total) VALUES (?, ?, 1) "
+                                   "ON CONFLICT (name, outcome) DO UPDATE SET total = total + 1",
+                                   (name, 'limited' if wait else 'allowed'))
+            if random.random() < 0.001:
+                connection.execute("DELETE FROM bucket WHERE updated < ?", (now - STALE_BUCKET_SECONDS,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+    def totals(self):
+        rows = self._connection().execute("SELECT name, outcome, total FROM counter").fetchall()
+        return {f"{name}.{outcome}": total for name, outcome, total in rows}
+
+
+class RateLimiter:
+    """Token-bucket admission control keyed by client (see ``client_key``) and endpoint"""
+
+    def __init__(self, buckets, limits, enabled=True):
+        self.buckets = buckets
+        self.limits = limits
+        self.enabled = enabled
+        self.counters = Counter()
+
+    def check(self, name, client):
+        """Seconds the client must wait before calling ``name`` again, 0 if admitted"""
+        limit = self.limits.get(name)
+        if not self.enabled or limit is None:
+            return 0.0
+        requests_allowed, per_seconds, burst = limit
+        rate = requests_allowed / per_seconds
+        key = f"{name}|{client}"
+        try:
+            wait = self.buckets.take(key, rate, burst, name=name)
+        except sqlite3.Error:
+            # Fail open: a busy limiter store must not take the site down
+            self.counters[f"{name}.errors"] += 1
+            logger.warning("Rate limiter store unavailable", exc_info=True, extra={'limit': name})
+            return 0.0
+        self.counters[f"{name}.{'limited' if wait else 'allowed'}"] += 1
+        if wait:
+            logger.info("Rate limit exceeded", extra={'limit': name, 'client': client,
+                                                      'retry_after': math.ceil(wait)})
+        return wait
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'limits': {name: {'requests': requests_allowed, 'per_seconds': per_seconds, 'burst': burst}
+                       for name, (requests_allowed, per_seconds, burst) in self.limits.items()},
+            'process': dict(self.counters),
+            'shared': self.buckets.totals(),
+        }
+
+
+def client_key():
+    """Who a limit applies to: the logged-in admin, otherwise the client IP.
+
+    The IP is ``request.remote_addr`` as rewritten by ProxyFix, which is the
+    real client only when ``PROXY_FIX_X_FOR`` equals the number of proxies in
+    front of the app: with fewer, every client shares the proxy's bucket;
+    with more, clients pick their own key through X-Forwarded-For.
+    """
+    if session.get('admin_logged_in') and session.get('admin_id') is not None:
+        return f"admin:{session['admin_id']}"
+    return request.remote_addr
+
+
+def rate_limited(name, methods=None):
+    """Reject requests over the ``name`` limit with 429 and a Retry-After header.
+
+    ``methods`` restricts the limit to some HTTP methods (e.g. only POST of
+    a form page). The check runs before the view reads the request body, so
+    rejected uploads are never written to disk.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiter')
+            if limiter is not None and (methods is None or request.method in methods):
+                wait = limiter.check(name, client_key())
+                if wait:
+                    raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+            return view_func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(app.config.get('RATE_LIMITS') or {})
+    storage = app.config.get('RATE_LIMIT_STORAGE') or 'memory'
+    if storage == 'memory':
+        buckets = MemoryBuckets()
+    else:
+        buckets = SQLiteBuckets(storage if storage != 'sqlite' else
+                                os.path.join(app.instance_path, 'rate_limits.sqlite3'))
+    app.extensions['rate_limiter'] = RateLimiter(buckets, limits, enabled=app.config.get('RATE_LIMIT_ENABLED', True))
@@ -1,19 +1,103 @@
 import os
 import json
+import logging
 import hashlib
+import mimetypes
 import secrets
-from flask import render_template, request, redirect, url_for, session, flash, jsonify
+from flask import abort, current_app, render_template, request, redirect, url_for, session, flash, jsonify, stream_with_context
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
-from app import app, db
-from models import Vehicle, Admin, Click, VehicleView, ClientRequest, PageVisit
-from datetime import datetime
+from db_routing import read_only
+from rate_limit import rate_limited
+from similar import similar_vehicles
+from models import db, Vehicle, Admin, Click, VehicleView, ClientRequest, PageVisit, ExchangeRate
+from pricing import set_exchange_rate
+from locations import LOCALITIES, RADIUS_OPTIONS_KM, location_filter
+from images import image_size, stream_size
+from storage import CACHE_CONTROL, get_storage
+from listing_images import (ImageListConflict, add_images, delete_unreferenced, image_items, image_paths,
+                            remove_image, reorder_images, set_main_image, update_images)
+from duplicates import find_duplicates, image_hash, record_image_hash
+from price_estimate import suggest_price
+from saved_searches import normalize_phone, parse_filters, queue_alerts, save_search, unsubscribe
+from exports import DATASETS, FORMATS, export_statement, parse_dates, stream_export
+from funnel import STEPS as FUNNEL_STEPS, conversion_rates, funnel_report, parse_range
+from assets import CDN_ASSETS
+from feeds import CATALOG_JSON, CATALOG_XML, SITEMAP, catalog_signature
+from datetime import datetime, timedelta
 import urllib.parse
 
+logger = logging.getLogger(__name__)
+
+# Views are collected here and bound to the application by init_app(), so that
+# importing this module has no side effects on any particular app instance.
+_url_rules = []
+_error_handlers = []
+
+def route(rule, **options):
+    """Register a view to be added to the app in init_app()"""
+    def decorator(view_func):
+        _url_rules.append((rule, view_func, options))
+        return view_func
+    return decorator
+
+def errorhandler(code):
+    """Register an error handler to be added to the app in init_app()"""
+    def decorator(handler):
+        _error_handlers.append((code, handler))
+        return handler
+    return decorator
+
+def init_app(app):
+    """Bind all routes and error handlers to the given app"""
+    for rule, view_func, options in _url_rules:
+        app.add_url_rule(rule, view_func=view_func, **options)
+    for code, handler in _error_handlers:
+        app.register_error_handler(code, handler)
+
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_uploaded_images(files, prefix=''):
+    """Save uploaded images and return (relative URLs, names of rejected files).
+
+    Images are expected to arrive already resized by the browser; anything
+    above IMAGE_MAX_UPLOAD_DIMENSION pixels or IMAGE_MAX_UPLOAD_BYTES, or
+    whose dimensions cannot be read, is rejected.
+    """
+    max_dimension = current_app.config['IMAGE_MAX_UPLOAD_DIMENSION']
+    max_bytes = current_app.config['IMAGE_MAX_UPLOAD_BYTES']
+    image_urls = []
+    rejected = []
+    for file in files:
+        if not (file and file.filename and allowed_file(file.filename)):
+            continue
+        dimensions = image_size(file.stream)
+        if dimensions is None or max(dimensions) > max_dimension or stream_size(file.stream) > max_bytes:
+            rejected.append(file.filename)
+            continue
+        
+        # Generate unique filename
+        filename = secure_filename(file.filename)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        filename = f"{prefix}{timestamp}_{filename}"
+        
+        # Fingerprint for duplicate detection, recorded once the file is stored
+        phash = image_hash(file.stream)
+        get_storage().save(file.stream, filename, file.mimetype)
+        record_image_hash(f"uploads/{filename}", phash)
+        
+        # Store relative URL
+        image_urls.append(f"uploads/{filename}")
+    return image_urls, rejected
+
+def flash_rejected_images(rejected):
+    if rejected:
+        max_mb = current_app.config['IMAGE_MAX_UPLOAD_BYTES'] // (1024 * 1024)
+        flash(f"Algunas imágenes no se guardaron porque superan "
+              f"{current_app.config['IMAGE_MAX_UPLOAD_DIMENSION']}px o {max_mb}MB: {', '.join(rejected)}", 'warning')
+
 def generate_password_hash_sha256(password):
     """Genera un hash SHA-256 de la contraseña con salt"""
     # Generar un salt aleatorio
@@ -68,20 +152,115 @@ def track_page_visit(page_name):
         db.session.commit()
     except Exception as e:
         # Log error but don't break the page
-        print(f"Error tracking page visit: {e}")
+        logger.warning("Error tracking page visit: %s", e, extra={'page': page_name})
         db.session.rollback()
 
-@app.route('/terminos-y-condiciones')
+# Sort modes of index(); the id tie-breaker gives a stable, keyset-friendly order
+SORT_ORDERS = {
+    'price_asc': (Vehicle.price_ars_normalized.asc(), Vehicle.id.asc()),
+    'price_desc': (Vehicle.price_ars_normalized.desc(), Vehicle.id.desc()),
+    'newest': (Vehicle.created_at.desc(), Vehicle.id.desc()),
+    'km_asc': (Vehicle.kilometers.asc(), Vehicle.id.asc()),
+}
+
+def count_by_vehicle(model, vehicle_ids):
+    """Return {vehicle_id: row count} of an analytics model for the given vehicles.
+
+    Analytics tables may live in a separate database, so counts are
+    aggregated there and merged with vehicles in Python instead of joining.
+    """
+    from sqlalchemy import func
+    if not vehicle_ids:
+        return {}
+    rows = db.session.query(model.vehicle_id, func.count(model.id)).filter(
+        model.vehicle_id.in_(vehicle_ids)).group_by(model.vehicle_id).all()
+    return dict(rows)
+
+def most_counted_vehicles(model, vehicle_filters, limit=10, batch_size=100):
+    """Return the ``limit`` vehicles matching ``vehicle_filters`` with the most ``model`` rows.
+
+    The per-vehicle counts are aggregated and ranked on the analytics
+    database and read a batch at a time; only the vehicles of each batch are
+    loaded, until ``limit`` of them match. Matching vehicles without any rows
+    fill up the rest. Returns [(vehicle, count)], most counted first.
+    """
+    from sqlalchemy import func, select
+    count = func.count(model.id)
+    ranked = select(model.vehicle_id, count).group_by(model.vehicle_id).order_by(count.desc(), model.vehicle_id)
+    result = []
+    rows = db.session.execute(ranked.execution_options(yield_per=batch_size))
+    try:
+        for batch in rows.partitions():
+            counts = dict(batch)
+            vehicles = Vehicle.query.filter(Vehicle.id.in_(counts), *vehicle_filters).all()
+            vehicles.sort(key=lambda vehicle: (-counts[vehicle.id], vehicle.id))
+            result.extend((vehicle, counts[vehicle.id]) for vehicle in vehicles[:limit - len(result)])
+            if len(result) == limit:
+                break
+    finally:
+        rows.close()
+    if len(result) < limit:
+        counted = [vehicle.id for vehicle, _ in result]
+        result.extend((vehicle, 0) for vehicle in Vehicle.query.filter(*vehicle_filters, Vehicle.id.notin_(counted))
+                      .order_by(Vehicle.id).limit(limit - len(result)))
+    return result
+
+# Paths the service worker never answers from its caches
+SERVICE_WORKER_NETWORK_ONLY = ('/admin', '/panel', '/logout', '/track_click', '/busquedas-guardadas')
+
+@route('/sw.js')
+def service_worker():
+    """Service worker, served from the root so that it controls the whole site"""
+    static_files = current_app.extensions['asset_hashes']
+    body = render_template(
+        'sw.js',
+        version=current_app.extensions['asset_version'],
+        precache=[url_for('static', filename=filename) for filename in sorted(static_files)] + list(CDN_ASSETS),
+        offline_url=url_for('offline'),
+        cdn_origins=sorted({'/'.join(url.split('/')[:3]) for url in CDN_ASSETS}),
+        static_prefix=url_for('static', filename=''),
+        network_only=list(SERVICE_WORKER_NETWORK_ONLY),
+        index_url=url_for('index'),
+        listing_prefixes=[url_for('vehicle_detail', id=0)[:-1], url_for('api_search'), url_for('catalog_feed_json')],
+    )
+    response = current_app.response_class(body, mimetype='application/javascript')
+    # Browsers check for a new worker on every visit; it must never be stale
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@route('/manifest.webmanifest')
+def web_manifest():
+    manifest = {
+        'name': 'Compra/Venta de Vehículos Valle de Uco',
+        'short_name': 'AutoMarket',
+        'lang': 'es',
+        'start_url': url_for('index'),
+        'scope': url_for('index'),
+        'display': 'standalone',
+        'background_color': '#ffffff',
+        'theme_color': '#2563eb',
+        'icons': [{'src': url_for('static', filename='img/icon.svg'), 'sizes': 'any', 'type': 'image/svg+xml'}],
+    }
+    response = current_app.response_class(json.dumps(manifest, ensure_ascii=False),
+                                          mimetype='application/manifest+json')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+@route('/sin-conexion')
+def offline():
+    """Page the service worker shows when a page is requested offline and was never cached"""
+    return render_template('offline.html')
+
+@route('/terminos-y-condiciones')
 def terms_conditions():
     from datetime import datetime
     now = datetime.utcnow()
     return render_template('terms_conditions.html', now=now)
 
-@app.route('/')
+@route('/')
+@read_only
 def index():
-    # Track page visit
-    track_page_visit('index')
-    
     # Get search and filter parameters
     search_query = request.args.get('search', '').strip()
     price_min = request.args.get('price_min', type=int)
@@ -94,6 +273,10 @@ def index():
     transmission = request.args.get('transmission', '').strip()
     km_min = request.args.get('km_min', type=int)
     km_max = request.args.get('km_max', type=int)
+    radius_km = request.args.get('radius_km', type=int)
+    sort = request.args.get('sort', '').strip()
+    if sort not in SORT_ORDERS:
+        sort = ''
     
     # Start with base query
     query = Vehicle.query.filter_by(is_active=True)
@@ -110,11 +293,11 @@ def index():
             )
         )
     
-    # Apply price filters
+    # Apply price filters (in ARS, so USD listings are compared at the current rate)
     if price_min is not None:
-        query = query.filter(Vehicle.price >= price_min)
+        query = query.filter(Vehicle.price_ars_normalized >= price_min)
     if price_max is not None:
-        query = query.filter(Vehicle.price <= price_max)
+        query = query.filter(Vehicle.price_ars_normalized <= price_max)
     
     # Apply brand filter
     if brand:
@@ -126,9 +309,9 @@ def index():
     if year_max is not None:
         query = query.filter(Vehicle.year <= year_max)
     
-    # Apply location filter (assuming location is stored in a field)
+    # Apply location filter, optionally widened to nearby localities
     if location:
-        query = query.filter(Vehicle.title.ilike(f"%{location}%"))
+        query = query.filter(location_filter(location, radius_km))
     
     # Apply fuel type filter
     if fuel_type:
@@ -148,16 +331,21 @@ def index():
     page = request.args.get('page', 1, type=int)
     per_page = 10
     
-    # Order vehicles randomly for exploration
-    import random
-    all_vehicles = query.all()
-    random.shuffle(all_vehicles)
-    
-    # Calculate pagination
-    total_vehicles = len(all_vehicles)
     start_index = (page - 1) * per_page
-    end_index = start_index + per_page
-    vehicles = all_vehicles[start_index:end_index]
+    if sort:
+        # Sorted modes run entirely in SQL on the composite indexes
+        total_vehicles = query.order_by(None).count()
+        vehicles = query.order_by(*SORT_ORDERS[sort]).offset(start_index).limit(per_page).all()
+    else:
+        # Order vehicles randomly for exploration
+        import random
+        all_vehicles = query.all()
+        random.shuffle(all_vehicles)
+        
+        # Calculate pagination
+        total_vehicles = len(all_vehicles)
+        end_index = start_index + per_page
+        vehicles = all_vehicles[start_index:end_index]
     
     # Calculate pagination info
     total_pages = (total_vehicles + per_page - 1) // per_page
@@ -165,16 +353,10 @@ def index():
     has_next = page < total_pages
     
     # Get most viewed vehicles for the carousel (only Plus publications)
-    from sqlalchemy import func
-    most_viewed_vehicles = db.session.query(
-        Vehicle,
-        func.count(VehicleView.id).label('view_count')
-    ).outerjoin(VehicleView).filter(
+    most_viewed_vehicles = most_counted_vehicles(VehicleView, (
         Vehicle.is_active == True,
         Vehicle.is_plus == True  # Only Plus publications
-    ).group_by(Vehicle.id).order_by(
-        func.count(VehicleView.id).desc()
-    ).limit(10).all()
+    ))
     
     # Get unique brands for filter dropdown
     unique_brands = db.session.query(Vehicle.brand).filter(
@@ -184,10 +366,11 @@ def index():
     ).distinct().order_by(Vehicle.brand).all()
     brands = [brand[0] for brand in unique_brands]
     
-    return render_template('index.html', 
+    html = render_template('index.html', 
                          vehicles=vehicles, 
                          most_viewed_vehicles=most_viewed_vehicles,
                          brands=brands,
+                         radius_options=RADIUS_OPTIONS_KM,
                          pagination={
                              'page': page,
                              'per_page': per_page,
@@ -206,23 +389,22 @@ def index():
                              'year_min': year_min,
                              'year_max': year_max,
                              'location': location,
+                             'radius_km': radius_km,
                              'fuel_type': fuel_type,
                              'transmission': transmission,
                              'km_min': km_min,
-                             'km_max': km_max
+                             'km_max': km_max,
+                             'sort': sort
                          })
-
-@app.route('/api/search')
-def api_search():
-    """API endpoint for AJAX search"""
-    search_query = request.args.get('q', '').strip()
     
-    if not search_query:
-        return jsonify({'vehicles': []})
-    
-    # Search in title, brand, model, and description
+    # Tracked after the page's reads, so a replica retry cannot record it twice
+    track_page_visit('index')
+    return html
+
+def search_statement(search_query, limit=10):
+    """Active vehicles whose title, brand, model or description contain the query"""
     search_filter = f"%{search_query}%"
-    vehicles = Vehicle.query.filter(
+    return db.select(Vehicle).where(
         Vehicle.is_active == True,
         db.or_(
             Vehicle.title.ilike(search_filter),
@@ -230,31 +412,95 @@ def api_search():
             Vehicle.model.ilike(search_filter),
             Vehicle.description.ilike(search_filter)
         )
-    ).limit(10).all()
+    ).limit(limit)
+
+def search_result(vehicle):
+    """JSON summary of a vehicle for the AJAX search"""
+    return {
+        'id': vehicle.id,
+        'title': vehicle.title,
+        'brand': vehicle.brand,
+        'model': vehicle.model,
+        'price': vehicle.format_price(),
+        'year': vehicle.year,
+        'kilometers': vehicle.kilometers,
+        'fuel_type': vehicle.fuel_type,
+        'image': vehicle.get_main_image(),
+        'url': url_for('vehicle_detail', id=vehicle.id)
+    }
+
+@route('/api/search')
+@read_only
+def api_search():
+    """API endpoint for AJAX search"""
+    search_query = request.args.get('q', '').strip()
     
-    # Format results for JSON response
-    results = []
-    for vehicle in vehicles:
-        results.append({
-            'id': vehicle.id,
-            'title': vehicle.title,
-            'brand': vehicle.brand,
-            'model': vehicle.model,
-            'price': vehicle.format_price(),
-            'year': vehicle.year,
-            'kilometers': vehicle.kilometers,
-            'fuel_type': vehicle.fuel_type,
-            'image': vehicle.get_main_image(),
-            'url': url_for('vehicle_detail', id=vehicle.id)
-        })
+    if not search_query:
+        return jsonify({'vehicles': []})
+    
+    # Search in title, brand, model, and description
+    vehicles = db.session.execute(search_statement(search_query)).scalars()
     
-    return jsonify({'vehicles': results})
+    # Format results for JSON response
+    return jsonify({'vehicles': [search_result(vehicle) for vehicle in vehicles]})
+
+def int_arg(name):
+    """Integer query parameter that tolerates thousands separators, or None"""
+    value = request.args.get(name, '').replace('.', '').replace(',', '').replace(' ', '')
+    return int(value) if value.isdigit() else None
+
+@route('/api/precio-sugerido')
+@rate_limited('price_estimate')
+def api_price_estimate():
+    """Suggested market price for the submission form"""
+    year = int_arg('anio')
+    currency = request.args.get('moneda', 'ARS')
+    if year is None or not 1900 <= year <= datetime.utcnow().year + 1 or currency not in ('ARS', 'USD'):
+        return jsonify({'success': False, 'error': 'Indica un año y una moneda válidos'}), 400
+    
+    estimate = suggest_price(
+        brand=request.args.get('marca', ''),
+        model=request.args.get('modelo', ''),
+        year=year,
+        kilometers=int_arg('km'),
+        fuel_type=request.args.get('combustible', ''),
+        transmission=request.args.get('transmision', ''),
+        currency=currency,
+    )
+    return jsonify({'success': True, 'estimate': estimate})
 
-@app.route('/vehicle/<int:id>')
+@route('/busquedas-guardadas', methods=['POST'])
+@rate_limited('saved_search')
+def save_search_alert():
+    """Save the current filters of index() to be notified of new vehicles"""
+    filters = parse_filters(request.form)
+    phone_number = normalize_phone(request.form.get('phone_number'))
+    if phone_number is None:
+        flash('Ingresa un número de WhatsApp válido, con código de área.', 'error')
+    elif not filters:
+        flash('Elige al menos un filtro antes de guardar la búsqueda.', 'error')
+    elif save_search(phone_number, filters) is None:
+        flash('Este número ya tiene el máximo de búsquedas guardadas.', 'warning')
+    else:
+        flash('Búsqueda guardada. Te avisaremos por WhatsApp cuando se publique un vehículo que coincida.', 'success')
+    return redirect(url_for('index', **filters))
+
+@route('/busquedas-guardadas/<token>/baja')
+def unsubscribe_search(token):
+    if unsubscribe(token) is None:
+        abort(404)
+    flash('Ya no recibirás avisos de esta búsqueda.', 'info')
+    return redirect(url_for('index'))
+
+@route('/vehicle/<int:id>')
+@rate_limited('vehicle_detail')
+@read_only
 def vehicle_detail(id):
     vehicle = Vehicle.query.get_or_404(id)
+    html = render_template('vehicle_detail.html', vehicle=vehicle,
+                           similar_vehicles=similar_vehicles(vehicle))
     
-    # Track view
+    # Track view, after the page's reads so a replica retry cannot record it twice
     view = VehicleView(
         vehicle_id=vehicle.id,
         ip_address=request.remote_addr,
@@ -263,9 +509,10 @@ def vehicle_detail(id):
     db.session.add(view)
     db.session.commit()
     
-    return render_template('vehicle_detail.html', vehicle=vehicle)
+    return html
 
-@app.route('/track_click/<int:vehicle_id>/<click_type>')
+@route('/track_click/<int:vehicle_id>/<click_type>')
+@rate_limited('track_click')
 def track_click(vehicle_id, click_type):
     vehicle = Vehicle.query.get_or_404(vehicle_id)
     
@@ -279,7 +526,10 @@ def track_click(vehicle_id, click_type):
     db.session.add(click)
     db.session.commit()
     
-    # Generate WhatsApp URL
+    return redirect(whatsapp_url(vehicle, click_type))
+
+def whatsapp_url(vehicle, click_type):
+    """wa.me link with the message for a contact or offer click"""
     if click_type == 'whatsapp':
         message = vehicle.get_whatsapp_contact_message()
     elif click_type == 'offer':
@@ -292,11 +542,10 @@ def track_click(vehicle_id, click_type):
     else:
         message = f"Consulta sobre: {vehicle.title}"
     
-    whatsapp_url = f"https://wa.me/{vehicle.whatsapp_number.replace('+', '')}?text={urllib.parse.quote(message)}"
-    return redirect(whatsapp_url)
+    return f"https://wa.me/{vehicle.whatsapp_number.replace('+', '')}?text={urllib.parse.quote(message)}"
 
 
-@app.route('/panel/login', methods=['GET', 'POST'])
+@route('/panel/login', methods=['GET', 'POST'])
 def panel_login():
     if request.method == 'POST':
         username = request.form['username']
@@ -318,13 +567,13 @@ def panel_login():
     
     return render_template('login.html')
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.pop('admin_logged_in', None)
     session.pop('admin_id', None)
     return redirect(url_for('index'))
 
-@app.route('/panel')
+@route('/panel')
 def admin_dashboard():
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -344,16 +593,9 @@ def admin_dashboard():
     ).count()
     
     # Most viewed vehicles (all publications for admin)
-    from sqlalchemy import func
-    most_viewed = db.session.query(
-        Vehicle,
-        func.count(VehicleView.id).label('view_count'),
-        func.count(Click.id).label('click_count')
-    ).outerjoin(VehicleView).outerjoin(Click).filter(
-        Vehicle.is_active == True
-    ).group_by(Vehicle.id).order_by(
-        func.count(VehicleView.id).desc()
-    ).limit(10).all()
+    most_viewed = most_counted_vehicles(VehicleView, (Vehicle.is_active == True,))
+    click_counts = count_by_vehicle(Click, [vehicle.id for vehicle, _ in most_viewed])
+    most_viewed = [(vehicle, view_count, click_counts.get(vehicle.id, 0)) for vehicle, view_count in most_viewed]
     
     stats = {
         'total_vehicles': total_vehicles,
@@ -363,12 +605,103 @@ def admin_dashboard():
         'most_viewed': most_viewed,
         'pending_requests_count': pending_requests_count,
         'total_page_visits': total_page_visits,
-        'today_visits': today_visits
+        'today_visits': today_visits,
+        'usd_rate': ExchangeRate.query.filter_by(currency='USD').first()
     }
     
     return render_template('admin_dashboard.html', stats=stats)
 
-@app.route('/admin/add_vehicle', methods=['GET', 'POST'])
+def selected_vehicle_ids():
+    """Vehicles selected by the vehiculos / marca parameters: explicit ids, a brand, or all (None)"""
+    ids = [int(value) for value in request.args.get('vehiculos', '').split(',') if value.strip().isdigit()]
+    brand = request.args.get('marca', '').strip()
+    if brand:
+        ids += [vehicle_id for (vehicle_id,) in
+                db.session.query(Vehicle.id).filter(Vehicle.brand.ilike(brand))]
+        return ids
+    return ids or None
+
+@route('/admin/api/reportes/embudo')
+def funnel_report_api():
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    try:
+        start, end = parse_range(request.args.get('desde'), request.args.get('hasta'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Rango de fechas inválido'}), 400
+    report = funnel_report(start, end, selected_vehicle_ids())
+    return jsonify({'success': True, **report, 'conversion': conversion_rates(report['totals'])})
+
+@route('/admin/reportes/embudo')
+def admin_funnel_report():
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('panel_login'))
+    try:
+        start, end = parse_range(request.args.get('desde'), request.args.get('hasta'))
+    except ValueError:
+        flash('Rango de fechas inválido', 'error')
+        start, end = parse_range(None, None)
+    report = funnel_report(start, end, selected_vehicle_ids())
+    titles = dict(db.session.query(Vehicle.id, Vehicle.title).filter(Vehicle.id.in_(report['vehicles'])))
+    vehicles = sorted(report['vehicles'].items(), key=lambda item: item[1]['views'], reverse=True)
+    # Most recent first, days without activity left out
+    daily_rows = [(day, counts) for day, counts in zip(reversed(report['days']), reversed(report['daily']))
+                  if any(counts)]
+    return render_template('admin_funnel_report.html', report=report, steps=FUNNEL_STEPS, daily_rows=daily_rows,
+                           conversion=conversion_rates(report['totals']), vehicles=vehicles, titles=titles,
+                           all_vehicles=Vehicle.query.order_by(Vehicle.title).all(),
+                           filters={'desde': start.isoformat(), 'hasta': end.isoformat(),
+                                    'vehiculos': request.args.get('vehiculos', ''),
+                                    'marca': request.args.get('marca', '')})
+
+@route('/admin/exportar/<any(vehiculos, solicitudes, visitas, clics, paginas):dataset>.<any(csv, jsonl):fmt>')
+@read_only
+def export_data(dataset, fmt):
+    """Stream a table as CSV or JSONL (?gzip=1 for a .gz file), filtered by desde / hasta / vehiculos / marca"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('panel_login'))
+    try:
+        start, end = parse_dates(request.args.get('desde'), request.args.get('hasta'))
+    except ValueError:
+        abort(400)
+    compress = request.args.get('gzip') in ('1', 'true')
+    statement = export_statement(DATASETS[dataset], start, end, selected_vehicle_ids())
+    filename = f"{dataset}_{datetime.utcnow():%Y%m%d}.{fmt}" + ('.gz' if compress else '')
+    response = current_app.response_class(
+        stream_with_context(stream_export(DATASETS[dataset], fmt, statement, compress)),
+        mimetype='application/gzip' if compress else FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@route('/admin/tipo-de-cambio', methods=['POST'])
+def update_exchange_rate():
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('panel_login'))
+    
+    rate_str = request.form.get('usd_rate', '').replace('.', '').replace(',', '.').replace(' ', '')
+    try:
+        rate = float(rate_str)
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        flash('Tipo de cambio inválido', 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    updated = set_exchange_rate('USD', rate)
+    flash(f'Tipo de cambio actualizado: 1 USD = {rate:g} ARS ({updated} vehículos recalculados)', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+def queue_vehicle_alerts(vehicle):
+    """Notify the saved searches a new vehicle matches; never fails the publication"""
+    try:
+        queue_alerts(vehicle)
+    except Exception:
+        db.session.rollback()
+        logger.exception("Error queuing alerts for vehicle %s", vehicle.id, extra={'vehicle_id': vehicle.id})
+
+@route('/admin/add_vehicle', methods=['GET', 'POST'])
 def add_vehicle():
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -390,6 +723,7 @@ def add_vehicle():
             fuel_type=request.form['fuel_type'],
             transmission=request.form['transmission'],
             color=request.form['color'],
+            location=request.form.get('location') or None,
             whatsapp_number=request.form.get('whatsapp_number', ''),
             call_number=request.form.get('call_number', ''),
             contact_type=request.form.get('contact_type', 'whatsapp'),  # Legacy field
@@ -397,22 +731,8 @@ def add_vehicle():
         )
         
         # Handle uploaded images
-        image_urls = []
-        if 'vehicle_images' in request.files:
-            files = request.files.getlist('vehicle_images')
-            for file in files:
-                if file and file.filename and allowed_file(file.filename):
-                    # Generate unique filename
-                    filename = secure_filename(file.filename)
-                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                    filename = f"{timestamp}_{filename}"
-                    
-                    # Save file
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    
-                    # Store relative URL
-                    image_urls.append(f"uploads/{filename}")
+        image_urls, rejected = save_uploaded_images(request.files.getlist('vehicle_images'))
+        flash_rejected_images(rejected)
         
         vehicle.images = json.dumps(image_urls)
         
@@ -422,13 +742,14 @@ def add_vehicle():
         
         db.session.add(vehicle)
         db.session.commit()
+        queue_vehicle_alerts(vehicle)
         
         flash('Vehículo agregado exitosamente', 'success')
         return redirect(url_for('admin_dashboard'))
     
-    return render_template('add_vehicle.html')
+    return render_template('add_vehicle.html', localities=LOCALITIES)
 
-@app.route('/admin/edit_vehicle/<int:id>', methods=['GET', 'POST'])
+@route('/admin/edit_vehicle/<int:id>', methods=['GET', 'POST'])
 def edit_vehicle(id):
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -450,6 +771,7 @@ def edit_vehicle(id):
         vehicle.fuel_type = request.form['fuel_type']
         vehicle.transmission = request.form['transmission']
         vehicle.color = request.form['color']
+        vehicle.location = request.form.get('location') or None
         vehicle.whatsapp_number = request.form.get('whatsapp_number', '')
         vehicle.call_number = request.form.get('call_number', '')
         vehicle.contact_type = request.form.get('contact_type', 'whatsapp')  # Legacy field
@@ -457,57 +779,42 @@ def edit_vehicle(id):
         vehicle.is_plus = request.form.get('is_plus') == 'true'
         
         # Handle new uploaded images
-        if 'vehicle_images' in request.files:
-            files = request.files.getlist('vehicle_images')
-            if any(file.filename for file in files):  # If new images are uploaded
-                new_image_urls = []
-                for file in files:
-                    if file and file.filename and allowed_file(file.filename):
-                        filename = secure_filename(file.filename)
-                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                        filename = f"{timestamp}_{filename}"
-                        
-                        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                        file.save(file_path)
-                        
-                        new_image_urls.append(f"uploads/{filename}")
-                
-                if new_image_urls:  # Replace images only if new ones were uploaded
-                    vehicle.images = json.dumps(new_image_urls)
+        new_image_urls, rejected = save_uploaded_images(request.files.getlist('vehicle_images'))
+        flash_rejected_images(rejected)
+        replaced_images = []
+        if new_image_urls:  # Replace images only if new ones were uploaded
+            replaced_images = image_paths(vehicle.images)
+            vehicle.images = json.dumps(new_image_urls)
+            vehicle.main_image_index = 0
         
         db.session.commit()
+        delete_unreferenced(replaced_images)
         flash('Vehículo actualizado exitosamente', 'success')
         return redirect(url_for('admin_dashboard'))
     
-    return render_template('edit_vehicle.html', vehicle=vehicle)
+    return render_template('edit_vehicle.html', vehicle=vehicle, localities=LOCALITIES, image_items=image_items)
 
-@app.route('/admin/delete_vehicle/<int:id>', methods=['POST'])
+@route('/admin/delete_vehicle/<int:id>', methods=['POST'])
 def delete_vehicle(id):
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
     
     vehicle = Vehicle.query.get_or_404(id)
     
-    # Delete associated images from filesystem
-    if vehicle.images:
-        image_urls = json.loads(vehicle.images)
-        for image_url in image_urls:
-            if image_url.startswith('uploads/'):
-                image_path = os.path.join('static', image_url)
-                if os.path.exists(image_path):
-                    try:
-                        os.remove(image_path)
-                    except OSError:
-                        pass  # Ignore if file can't be deleted
+    vehicle_images = image_paths(vehicle.images)
     
     # Delete vehicle from database
     db.session.delete(vehicle)
     db.session.commit()
     
+    # Delete associated images no other listing or request still uses
+    delete_unreferenced(vehicle_images)
+    
     flash('Vehículo eliminado exitosamente', 'success')
     return redirect(url_for('admin_dashboard'))
 
-@app.route('/solicitar-publicacion', methods=['GET', 'POST'])
+@route('/solicitar-publicacion', methods=['GET', 'POST'])
+@rate_limited('client_request', methods=('POST',))
 def client_request():
     if request.method == 'POST':
         # Handle form submission
@@ -534,22 +841,8 @@ def client_request():
         )
         
         # Handle uploaded images
-        image_urls = []
-        if 'vehicle_images' in request.files:
-            files = request.files.getlist('vehicle_images')
-            for file in files:
-                if file and file.filename and allowed_file(file.filename):
-                    # Generate unique filename
-                    filename = secure_filename(file.filename)
-                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                    filename = f"client_{timestamp}_{filename}"
-                    
-                    # Save file
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    
-                    # Store relative URL
-                    image_urls.append(f"uploads/{filename}")
+        image_urls, rejected = save_uploaded_images(request.files.getlist('vehicle_images'), prefix='client_')
+        flash_rejected_images(rejected)
         
         client_request.images = json.dumps(image_urls)
         
@@ -561,16 +854,17 @@ def client_request():
     
     return render_template('client_request.html')
 
-@app.route('/admin/solicitudes-pendientes')
+@route('/admin/solicitudes-pendientes')
 def admin_pending_requests():
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
     
     pending_requests = ClientRequest.query.filter_by(status='pending').order_by(ClientRequest.created_at.desc()).all()
+    duplicates = find_duplicates(pending_requests)
     
-    return render_template('admin_pending_requests.html', requests=pending_requests)
+    return render_template('admin_pending_requests.html', requests=pending_requests, duplicates=duplicates)
 
-@app.route('/admin/procesar-solicitud/<int:request_id>/<action>')
+@route('/admin/procesar-solicitud/<int:request_id>/<action>')
 def process_client_request(request_id, action):
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -582,7 +876,8 @@ def process_client_request(request_id, action):
         try:
             # Get premium duration from query parameter
             duration_months = int(request.args.get('duration', 1))
-            print(f"Processing approval for request {request_id} with duration {duration_months} months")
+            logger.info("Processing approval for request %s with duration %s months", request_id, duration_months,
+                        extra={'request_id': request_id, 'duration_months': duration_months})
             
             # Create vehicle from client request
             vehicle = Vehicle(
@@ -597,6 +892,7 @@ def process_client_request(request_id, action):
                 fuel_type=client_request.fuel_type,
                 transmission=client_request.transmission,
                 color=client_request.color,
+                location=client_request.location,
                 images=client_request.images,
                 whatsapp_number=client_request.phone_number,
                 is_plus=(client_request.publication_type == 'plus'),
@@ -605,7 +901,6 @@ def process_client_request(request_id, action):
             )
             
             # Set premium expiration date
-            from datetime import datetime, timedelta
             vehicle.premium_expires_at = datetime.utcnow() + timedelta(days=duration_months * 30)
             
             db.session.add(vehicle)
@@ -614,12 +909,13 @@ def process_client_request(request_id, action):
             client_request.processed_by_admin_id = admin_id
             
             db.session.commit()
-            print(f"Successfully approved request {request_id}")
+            logger.info("Successfully approved request %s", request_id, extra={'request_id': request_id})
+            queue_vehicle_alerts(vehicle)
             flash(f'Solicitud aprobada y vehículo publicado: {vehicle.title} (Premium por {duration_months} meses)', 'success')
             
         except Exception as e:
             db.session.rollback()
-            print(f"Error approving request {request_id}: {str(e)}")
+            logger.exception("Error approving request %s", request_id, extra={'request_id': request_id})
             flash(f'Error al aprobar la solicitud: {str(e)}', 'error')
     
     elif action == 'reject':
@@ -632,7 +928,7 @@ def process_client_request(request_id, action):
     db.session.commit()
     return redirect(url_for('admin_pending_requests'))
 
-@app.route('/admin/editar-solicitud/<int:request_id>', methods=['GET', 'POST'])
+@route('/admin/editar-solicitud/<int:request_id>', methods=['GET', 'POST'])
 def edit_client_request(request_id):
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -662,31 +958,89 @@ def edit_client_request(request_id):
         client_request.admin_notes = request.form.get('admin_notes', '')
         
         # Handle new uploaded images
-        if 'vehicle_images' in request.files:
-            files = request.files.getlist('vehicle_images')
-            if any(file.filename for file in files):  # If new images are uploaded
-                new_image_urls = []
-                for file in files:
-                    if file and file.filename and allowed_file(file.filename):
-                        filename = secure_filename(file.filename)
-                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                        filename = f"client_{timestamp}_{filename}"
-                        
-                        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                        file.save(file_path)
-                        
-                        new_image_urls.append(f"uploads/{filename}")
-                
-                if new_image_urls:  # Replace images only if new ones were uploaded
-                    client_request.images = json.dumps(new_image_urls)
+        new_image_urls, rejected = save_uploaded_images(request.files.getlist('vehicle_images'), prefix='client_')
+        flash_rejected_images(rejected)
+        replaced_images = []
+        if new_image_urls:  # Replace images only if new ones were uploaded
+            replaced_images = image_paths(client_request.images)
+            client_request.images = json.dumps(new_image_urls)
         
         db.session.commit()
+        delete_unreferenced(replaced_images)
         flash('Solicitud actualizada exitosamente', 'success')
         return redirect(url_for('admin_pending_requests'))
     
-    return render_template('edit_client_request.html', client_request=client_request)
+    return render_template('edit_client_request.html', client_request=client_request, image_items=image_items)
+
+# Incremental image management used by the edit pages
+IMAGE_OWNERS = {'vehiculo': (Vehicle, ''), 'solicitud': (ClientRequest, 'client_')}
+
+def images_response(item, status=200, **extra):
+    return jsonify({'success': status == 200, **image_items(item), **extra}), status
+
+def change_images(item, change):
+    """Apply an image list change and delete the files it dropped"""
+    try:
+        old_paths, new_paths = update_images(item, change)
+    except ValueError:
+        return images_response(item, 400, error='La imagen indicada no pertenece a esta publicación')
+    except ImageListConflict:
+        return images_response(item, 409, error='Las imágenes cambiaron mientras se editaban, intenta de nuevo')
+    delete_unreferenced(set(old_paths) - set(new_paths))
+    return images_response(item)
+
+def requested_image_path():
+    path = (request.get_json(silent=True) or {}).get('path')
+    return path if isinstance(path, str) else None
+
+@route('/admin/api/<any(vehiculo, solicitud):kind>/<int:item_id>/imagenes', methods=['GET', 'POST', 'DELETE'])
+def item_images(kind, item_id):
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    
+    model, prefix = IMAGE_OWNERS[kind]
+    item = model.query.get_or_404(item_id)
+    
+    if request.method == 'GET':
+        return images_response(item)
+    
+    if request.method == 'DELETE':
+        path = requested_image_path()
+        return change_images(item, lambda paths, main_index: remove_image(paths, main_index, path))
+    
+    new_paths, rejected = save_uploaded_images(request.files.getlist('vehicle_images'), prefix=prefix)
+    if not new_paths:
+        return images_response(item, 400, error='No se recibió ninguna imagen válida', rejected=rejected)
+    try:
+        update_images(item, lambda paths, main_index: add_images(paths, main_index, new_paths))
+    except ImageListConflict:
+        delete_unreferenced(new_paths)
+        return images_response(item, 409, error='Las imágenes cambiaron mientras se editaban, intenta de nuevo')
+    return images_response(item, rejected=rejected)
 
-@app.route('/admin/usuarios-vehiculos')
+@route('/admin/api/<any(vehiculo, solicitud):kind>/<int:item_id>/imagenes/orden', methods=['PUT'])
+def reorder_item_images(kind, item_id):
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    
+    model, _ = IMAGE_OWNERS[kind]
+    item = model.query.get_or_404(item_id)
+    order = (request.get_json(silent=True) or {}).get('order')
+    if not isinstance(order, list) or not all(isinstance(path, str) for path in order):
+        return images_response(item, 400, error='Orden de imágenes inválido')
+    return change_images(item, lambda paths, main_index: reorder_images(paths, main_index, order))
+
+@route('/admin/api/<any(vehiculo, solicitud):kind>/<int:item_id>/imagenes/principal', methods=['PUT'])
+def set_item_main_image(kind, item_id):
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    
+    model, _ = IMAGE_OWNERS[kind]
+    item = model.query.get_or_404(item_id)
+    path = requested_image_path()
+    return change_images(item, lambda paths, main_index: set_main_image(paths, main_index, path))
+
+@route('/admin/usuarios-vehiculos')
 def admin_users_vehicles():
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -716,7 +1070,7 @@ def admin_users_vehicles():
     now = datetime.utcnow()
     return render_template('admin_users_vehicles.html', owners=owners, now=now)
 
-@app.route('/admin/update-premium-duration/<int:vehicle_id>/<int:months>', methods=['POST'])
+@route('/admin/update-premium-duration/<int:vehicle_id>/<int:months>', methods=['POST'])
 def update_premium_duration(vehicle_id, months):
     if not session.get('admin_logged_in'):
         return jsonify({'success': False, 'error': 'No autorizado'})
@@ -742,7 +1096,7 @@ def update_premium_duration(vehicle_id, months):
     
     return jsonify({'success': True, 'message': f'Duración premium actualizada a {months} meses'})
 
-@app.route('/admin/toggle-vehicle/<int:vehicle_id>')
+@route('/admin/toggle-vehicle/<int:vehicle_id>')
 def toggle_vehicle_status(vehicle_id):
     if not session.get('admin_logged_in'):
         return redirect(url_for('panel_login'))
@@ -755,7 +1109,7 @@ def toggle_vehicle_status(vehicle_id):
     flash(f'Vehículo "{vehicle.title}" ha sido {status_text}', 'success')
     return redirect(url_for('admin_users_vehicles'))
 
-@app.route('/admin/delete-vehicle/<int:vehicle_id>', methods=['DELETE'])
+@route('/admin/delete-vehicle/<int:vehicle_id>', methods=['DELETE'])
 def delete_vehicle_ajax(vehicle_id):
     if not session.get('admin_logged_in'):
         return jsonify({'success': False, 'error': 'No autorizado'})
@@ -763,23 +1117,15 @@ def delete_vehicle_ajax(vehicle_id):
     try:
         vehicle = Vehicle.query.get_or_404(vehicle_id)
         
-        # Delete associated images from filesystem
-        import os
-        upload_folder = app.config['UPLOAD_FOLDER']
-        
-        if vehicle.images:
-            for image_path in vehicle.images:
-                full_path = os.path.join(upload_folder, image_path)
-                if os.path.exists(full_path):
-                    try:
-                        os.remove(full_path)
-                    except OSError as e:
-                        print(f"Error deleting image {full_path}: {e}")
+        vehicle_images = image_paths(vehicle.images)
         
         # Delete vehicle from database
         db.session.delete(vehicle)
         db.session.commit()
         
+        # Delete associated images no other listing or request still uses
+        delete_unreferenced(vehicle_images)
+        
         return jsonify({
             'success': True, 
             'message': f'Vehículo "{vehicle.brand} {vehicle.model}" eliminado correctamente'
@@ -793,12 +1139,78 @@ def delete_vehicle_ajax(vehicle_id):
         })
 
 
+def feed_response(feed, extra_entries=(), **options):
+    """Stream a cached feed with ETag / Last-Modified conditional GET support"""
+    etag, last_modified = catalog_signature()
+    response = current_app.response_class(
+        stream_with_context(feed.stream(etag, extra_entries, **options)), mimetype=feed.mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+@route('/uploads/<name>')
+def uploaded_file(name):
+    """Let the front proxy send an uploaded image (X-Accel-Redirect / X-Sendfile)"""
+    headers = get_storage().offload_headers(name)
+    if headers is None:
+        abort(404)
+    response = current_app.response_class(headers=headers, mimetype=mimetypes.guess_type(name)[0])
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+def sitemap_static_pages():
+    return [
+        f"<url><loc>{url_for(endpoint, _external=True)}</loc></url>"
+        for endpoint in ('index', 'client_request', 'terms_conditions')
+    ]
+
+@route('/sitemap.xml')
+@read_only
+def sitemap():
+    return feed_response(SITEMAP, sitemap_static_pages())
+
+@route('/sitemap-<int:page>.xml')
+@read_only
+def sitemap_page(page):
+    etag, _ = catalog_signature()
+    if not 1 <= page <= SITEMAP.page_count(etag, sitemap_static_pages()):
+        abort(404)
+    return feed_response(SITEMAP, sitemap_static_pages(), page=page)
+
+@route('/feed/catalogo.json')
+@read_only
+def catalog_feed_json():
+    return feed_response(CATALOG_JSON)
+
+@route('/feed/catalogo.xml')
+@read_only
+def catalog_feed_xml():
+    return feed_response(CATALOG_XML)
+
+
 # Error handlers
-@app.errorhandler(404)
+@errorhandler(404)
 def not_found_error(error):
     return render_template('base.html'), 404
 
-@app.errorhandler(500)
+@errorhandler(429)
+def too_many_requests_error(error):
+    message = 'Demasiadas solicitudes. Intenta de nuevo en unos minutos.'
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+    if request.accept_mimetypes.best == 'application/json' or request.path.startswith('/api/'):
+        return jsonify({'success': False, 'error': message}), 429, headers
+    flash(message, 'warning')
+    return render_template('base.html'), 429, headers
+
+@route('/admin/api/rate-limits')
+def rate_limit_stats():
+    if not session.get('admin_logged_in'):
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    return jsonify(current_app.extensions['rate_limiter'].stats())
+
+@errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('base.html'), 500
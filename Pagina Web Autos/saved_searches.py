@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+
+from flask import current_app, url_for
+from sqlalchemy import func, or_, select, tuple_, update
+
+from locations import localities_within
+from models import db, AlertNotification, SavedSearch, SavedSearchTerm
+from notifications import get_sender
+
+logger = logging.getLogger(__name__)
+
+# The filters of index() that a search saves, with their types
+FILTERS = {
+    'search': str,
+    'price_min': int,
+    'price_max': int,
+    'brand': str,
+    'year_min': int,
+    'year_max': int,
+    'location': str,
+    'radius_km': int,
+    'fuel_type': str,
+    'transmission': str,
+    'km_min': int,
+    'km_max': int,
+}
+
+# Active searches a phone number may keep
+MAX_SEARCHES_PER_PHONE = 10
+
+# Delivery attempts before a notification is marked as failed
+MAX_ATTEMPTS = 5
+
+# Notifications claimed per delivery round
+DELIVERY_BATCH = 50
+
+# A notification still 'sending' after this was claimed by a worker that died
+# or hung mid-delivery, and goes back to the queue
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+_PHONE = re.compile(r'^\+?\d{8,15}$')
+
+# Field of the term that matches every vehicle, for searches without equality filters
+_ANY = ('*', '')
+
+
+def _fold(value):
+    value = unicodedata.normalize('NFKD', value or '')
+    return ''.join(char for char in value if not unicodedata.combining(char)).casefold()
+
+
+def parse_filters(values):
+    """Filters of a saved search from request values, parsed like index() does"""
+    filters = {}
+    for name, kind in FILTERS.items():
+        value = (values.get(name) or '').strip()
+        if kind is int:
+            value = int(value) if value.lstrip('-').isdigit() else None
+        if value not in (None, ''):
+            filters[name] = value
+    if 'location' not in filters:
+        filters.pop('radius_km', None)
+    return filters
+
+
+def normalize_phone(phone_number):
+    """Phone number without spaces or dashes, or None if it does not look like one"""
+    phone_number = re.sub(r'[\s\-()]', '', phone_number or '')
+    return phone_number if _PHONE.match(phone_number) else None
+
+
+# -- inverted index -----------------------------------------------------------
+
+def search_terms(filters):
+    """Equality conditions of a search as (field, value) terms.
+
+    A vehicle can only match if it has a term of every field listed here.
+    A location with a radius is expanded to every locality within it.
+    Ranges, free text and the brand (a substring match in index(), so
+    "Toyo" finds Toyotas) are checked afterwards.
+    """
+    terms = set()
+    if filters.get('location'):
+        if filters.get('radius_km'):
+            nearby = db.session.execute(localities_within(filters['location'], filters['radius_km'])).scalars()
+            terms.update(('location', locality) for locality in nearby)
+        terms.add(('location', filters['location']))
+    for field in ('fuel_type', 'transmission'):
+        if filters.get(field):
+            terms.add((field, filters[field]))
+    return terms or {_ANY}
+
+
+def vehicle_terms(vehicle):
+    """Every term a search may require of ``vehicle``"""
+    terms = {_ANY}
+    for field in ('location', 'fuel_type', 'transmission'):
+        if getattr(vehicle, field):
+            terms.add((field, getattr(vehicle, field)))
+    return terms
+
+
+def matches(filters, vehicle):
+    """Whether ``vehicle`` satisfies ``filters`` with the semantics of index()"""
+    if filters.get('search'):
+        needle = _fold(filters['search'])
+        fields = (vehicle.title, vehicle.brand, vehicle.model, vehicle.description)
+        if not any(needle in _fold(value) for value in fields if value):
+            return False
+    if filters.get('brand') and _fold(filters['brand']) not in _fold(vehicle.brand):
+        return False
+    for name, column in (('price', 'price_ars_normalized'), ('year', 'year'), ('km', 'kilometers')):
+        value = getattr(vehicle, column)
+        low, high = filters.get(f'{name}_min'), filters.get(f'{name}_max')
+        if (low is not None or high is not None) and value is None:
+            return False
+        if low is not None and value < low or high is not None and value > high:
+            return False
+    # Location, fuel and transmission were already matched through the terms
+    return True
+
+
+def save_search(phone_number, filters):
+    """Store a search and its index terms; returns it, or None if the phone has too many.
+
+    Saving the same filters twice for a phone returns the existing search.
+    """
+    encoded = json.dumps(filters, sort_keys=True, ensure_ascii=False)
+    active = SavedSearch.query.filter_by(phone_number=phone_number, is_active=True)
+    existing = active.filter_by(filters=encoded).first()
+    if existing is not None:
+        return existing
+    if active.count() >= MAX_SEARCHES_PER_PHONE:
+        return None
+    terms = search_terms(filters)
+    saved = SavedSearch(phone_number=phone_number, filters=encoded, token=secrets.token_urlsafe(24),
+                        term_count=len({field for field, _ in terms}))
+    saved.terms = [SavedSearchTerm(field=field, value=value[:100]) for field, value in terms]
+    db.session.add(saved)
+    db.session.commit()
+    logger.info("Search saved", extra={'saved_search_id': saved.id, 'terms': len(terms)})
+    return saved
+
+
+def reindex_brand_terms():
+    """Drop the brand terms of searches saved when brands were indexed; returns the number updated"""
+    searches = (SavedSearch.query.join(SavedSearchTerm, SavedSearchTerm.search_id == SavedSearch.id)
+                .filter(SavedSearchTerm.field == 'brand').distinct().all())
+    for saved in searches:
+        terms = [term for term in saved.terms if term.field != 'brand']
+        saved.terms = terms or [SavedSearchTerm(field=_ANY[0], value=_ANY[1])]
+        saved.term_count = len({term.field for term in saved.terms})
+    db.session.commit()
+    if searches:
+        logger.info("Saved searches reindexed", extra={'searches': len(searches)})
+    return len(searches)
+
+
+def unsubscribe(token):
+    """Deactivate the search with ``token``; returns it, or None if unknown"""
+    saved = SavedSearch.query.filter_by(token=token).first()
+    if saved is not None and saved.is_active:
+        saved.is_active = False
+        db.session.commit()
+    return saved
+
+
+# -- percolation --------------------------------------------------------------
+
+def matching_searches(vehicle):
+    """Active saved searches ``vehicle`` satisfies, found in one pass over the index.
+
+    A single grouped query keeps the searches whose every equality field has
+    a term among the vehicle's; only those are then checked against their
+    ranges and free text, so the cost follows the number of candidates and
+    not the number of saved searches.
+    """
+    terms = sorted(vehicle_terms(vehicle))
+    statement = (
+        select(SavedSearch)
+        .join(SavedSearchTerm, SavedSearchTerm.search_id == SavedSearch.id)
+        .where(SavedSearch.is_active == True,
+               tuple_(SavedSearchTerm.field, SavedSearchTerm.value).in_(terms))
+        .group_by(SavedSearch.id)
+        .having(func.count(func.distinct(SavedSearchTerm.field)) == SavedSearch.term_count)
+    )
+    candidates = db.session.execute(statement).scalars().all()
+    return [saved for saved in candidates if matches(json.loads(saved.filters), vehicle)]
+
+
+def alert_body(vehicle, saved):
+    return (f"Nuevo vehículo para tu búsqueda guardada en AutoMarket: {vehicle.title} - "
+            f"{vehicle.format_price_with_currency()}. {vehicle.get_full_url()}\n"
+            f"Para dejar de recibir avisos: {url_for('unsubscribe_search', token=saved.token, _external=True)}")
+
+
+def queue_alerts(vehicle):
+    """Queue a notification for every saved search a newly published vehicle matches.
+
+    Runs inside the request that published the vehicle; delivery happens
+    later through the notification sender. Returns the number queued.
+    """
+    if not vehicle.is_active:
+        return 0
+    matched = matching_searches(vehicle)
+    now = datetime.utcnow()
+    for saved in matched:
+        db.session.add(AlertNotification(saved_search_id=saved.id, vehicle_id=vehicle.id,
+                                         phone_number=saved.phone_number, body=alert_body(vehicle, saved)))
+        saved.last_notified_at = now
+    db.session.commit()
+    if matched:
+        logger.info("Alerts queued", extra={'vehicle_id': vehicle.id, 'alerts': len(matched)})
+        dispatcher = current_app.extensions.get('alert_dispatcher')
+        if dispatcher is not None:
+            dispatcher.wake()
+    return len(matched)
+
+
+# -- delivery -----------------------------------------------------------------
+
+def requeue_stale_claims(timeout=CLAIM_TIMEOUT):
+    """Release notifications left 'sending' for longer than ``timeout``.
+
+    Those that already used their ``MAX_ATTEMPTS`` are marked as failed, the
+    rest go back to 'pending'. Returns (requeued, failed).
+    """
+    stale = (AlertNotification.status == 'sending',
+             or_(AlertNotification.claimed_at.is_(None), AlertNotification.claimed_at < datetime.utcnow() - timeout))
+    failed = db.session.execute(
+        update(AlertNotification).where(*stale, AlertNotification.attempts >= MAX_ATTEMPTS)
+        .values(status='failed', error='Delivery interrupted')
+        .execution_options(synchronize_session=False)).rowcount
+    requeued = db.session.execute(
+        update(AlertNotification).where(*stale)
+        .values(status='pending', error='Delivery interrupted')
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    if requeued or failed:
+        logger.warning("Stale notification claims released", extra={'requeued': requeued, 'failed': failed})
+    return requeued, failed
+
+
+def deliver_pending(sender=None, batch_size=DELIVERY_BATCH, claim_timeout=CLAIM_TIMEOUT):
+    """Send queued notifications; returns {'sent': n, 'failed': n, 'retry': n}.
+
+    Each row is claimed with a conditional UPDATE before it is sent, so
+    several workers can deliver from the same outbox without sending a
+    message twice, and marked as sent right after. Claims older than
+    ``claim_timeout`` are released first (see ``requeue_stale_claims``), so
+    a crash between claiming and sending only delays the message.
+    """
+    sender = sender or get_sender()
+    requeued, failed = requeue_stale_claims(claim_timeout)
+    report = {'sent': 0, 'failed': failed, 'retry': requeued}
+    pending = db.session.execute(
+        select(AlertNotification.id, AlertNotification.phone_number, AlertNotification.body,
+               AlertNotification.attempts)
+        .where(AlertNotification.status == 'pending')
+        .order_by(AlertNotification.id).limit(batch_size)
+    ).all()
+    for notification in pending:
+        attempts = (notification.attempts or 0) + 1
+        claimed = db.session.execute(
+            update(AlertNotification)
+            .where(AlertNotification.id == notification.id, AlertNotification.status == 'pending')
+            .values(status='sending', attempts=attempts, claimed_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            continue
+        try:
+            sender.send(notification.phone_number, notification.body)
+        except Exception as e:
+            logger.warning("Error sending notification %s: %s", notification.id, e,
+                           extra={'notification_id': notification.id})
+            failed = attempts >= MAX_ATTEMPTS
+            values = {'status': 'failed' if failed else 'pending', 'error': str(e)[:500]}
+            report['failed' if failed else 'retry'] += 1
+        else:
+            values = {'status': 'sent', 'sent_at': datetime.utcnow(), 'error': None}
+            report['sent'] += 1
+        db.session.execute(
+            update(AlertNotification).where(AlertNotification.id == notification.id).values(**values)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+    return report
+
+
+class AlertDispatcher:
+    """Background thread that delivers queued notifications.
+
+    One thread runs per worker process, started on its first request so it
+    survives ``gunicorn --preload``. It wakes up every ``interval`` seconds,
+    or right away after this worker queues alerts.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._pid = None
+        self._guard = threading.Lock()
+        self._wake = threading.Event()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._guard:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='alert-dispatcher', daemon=True).start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    try:
+                        # Keep going while full batches go out; failures wait for the next round
+                        while deliver_pending()['sent'] == DELIVERY_BATCH:
+                            pass
+                    finally:
+                        db.session.remove()
+            except Exception:
+                logger.exception("Alert delivery failed")
+
+
+def init_app(app):
+    interval = app.config.get('ALERT_DELIVERY_INTERVAL_SECONDS', 0)
+    if not interval:
+        return
+    dispatcher = AlertDispatcher(app, interval)
+    app.extensions['alert_dispatcher'] = dispatcher
+    app.before_request(dispatcher.ensure_started)
@@ -0,0 +1,210 @@
+import numpy as np
+from flask import current_app
+
+from incremental_index import IncrementalIndex, Source
+from models import Vehicle
+
+# Extra distance (in standard deviations) for a different brand / model
+BRAND_PENALTY = 1.5
+MODEL_PENALTY = 1.0
+
+# Budget of distance-matrix cells computed at once while (re)building
+_CHUNK_CELLS = 2_000_000
+
+
+class SimilarVehiclesIndex(IncrementalIndex):
+    """k-nearest-neighbour index over active vehicles.
+
+    Each vehicle is a point (year, log kilometers, log price in ARS),
+    standardized with the statistics of the last full build, plus brand and
+    model codes that add a fixed penalty when they differ. The k neighbours of
+    every vehicle are precomputed, so a lookup is a dict access and a slice.
+    """
+
+    name = 'similar_vehicles'
+    sources = {
+        'vehicle': Source(Vehicle, (Vehicle.id, Vehicle.brand, Vehicle.model, Vehicle.year, Vehicle.kilometers,
+                                    Vehicle.price_ars_normalized, Vehicle.updated_at), Vehicle.is_active == True),
+    }
+
+    def __init__(self, k=6, refresh_seconds=60):
+        self.k = k
+        super().__init__(refresh_seconds)
+
+    def _reset(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.features = np.empty((0, 3), dtype=np.float32)
+        self.brands = np.empty(0, dtype=np.int32)
+        self.models = np.empty(0, dtype=np.int32)
+        self.alive = np.empty(0, dtype=bool)
+        self.neighbours = np.empty((0, self.k), dtype=np.int64)
+        self.neighbour_distances = np.empty((0, self.k), dtype=np.float32)
+        self.positions = {}
+        self._codes = {}
+        self.center = np.zeros(3, dtype=np.float32)
+        self.scale = np.ones(3, dtype=np.float32)
+
+    # -- public API -------------------------------------------------------
+
+    def similar_ids(self, vehicle_id, limit=4):
+        """Return up to ``limit`` ids of the vehicles closest to ``vehicle_id``"""
+        with self._synced() as ready:
+            row = self.positions.get(vehicle_id) if ready else None
+            if row is None:
+                return []
+            finite = np.isfinite(self.neighbour_distances[row])
+            return [int(i) for i in self.neighbours[row][finite][:limit]]
+
+    # -- building ---------------------------------------------------------
+
+    def _load(self, rows):
+        rows = rows['vehicle']
+        raw = self._raw_features(rows)
+        if len(rows):
+            self.center = np.nanmean(raw, axis=0)
+            self.center = np.where(np.isnan(self.center), 0, self.center).astype(np.float32)
+            scale = np.nanstd(raw, axis=0)
+            self.scale = np.where(np.isnan(scale) | (scale == 0), 1, scale).astype(np.float32)
+        self.ids = np.array([row.id for row in rows], dtype=np.int64)
+        self.features = self._standardize(raw)
+        self.brands = np.array([self._code('brand', row.brand) for row in rows], dtype=np.int32)
+        self.models = np.array([self._code('model', row.brand, row.model) for row in rows], dtype=np.int32)
+        self.alive = np.ones(len(rows), dtype=bool)
+        self.positions = {int(vehicle_id): row for row, vehicle_id in enumerate(self.ids)}
+        self.neighbours = np.full((len(rows), self.k), -1, dtype=np.int64)
+        self.neighbour_distances = np.full((len(rows), self.k), np.inf, dtype=np.float32)
+        self._recompute(np.arange(len(rows)))
+
+    def _count(self, kind):
+        return int(self.alive.sum())
+
+    def _apply(self, kind, rows, requested_ids):
+        """Insert, update or drop the given vehicles and repair affected neighbour lists"""
+        seen = {row.id for row in rows}
+        gone = [vehicle_id for vehicle_id in requested_ids if vehicle_id not in seen]
+        changed_rows = []
+        for vehicle_id in gone:
+            row = self.positions.get(vehicle_id)
+            if row is not None:
+                self.alive[row] = False
+                changed_rows.append(row)
+        if rows:
+            raw = self._raw_features(rows)
+            features = self._standardize(raw)
+            for row, values in zip(rows, features):
+                position = self.positions.get(row.id)
+                if position is None:
+                    if not row.live:
+                        continue
+                    position = self._append(row.id)
+                self.features[position] = values
+                self.brands[position] = self._code('brand', row.brand)
+                self.models[position] = self._code('model', row.brand, row.model)
+                self.alive[position] = bool(row.live)
+                changed_rows.append(position)
+        if not changed_rows:
+            return
+        changed_rows = np.array(sorted(set(changed_rows)), dtype=np.int64)
+        changed_ids = self.ids[changed_rows]
+
+        # Rows that referenced a changed vehicle, plus rows it may now enter
+        affected = np.isin(self.neighbours, changed_ids).any(axis=1)
+        live_changed = changed_rows[self.alive[changed_rows]]
+        if len(live_changed):
+            distances = self._distances(live_changed)
+            affected |= (distances < self.neighbour_distances[:, -1]).any(axis=0)
+        affected[changed_rows] = True
+        self._recompute(np.flatnonzero(affected))
+
+    def _append(self, vehicle_id):
+        position = len(self.ids)
+        self.ids = np.append(self.ids, vehicle_id)
+        self.features = np.vstack([self.features, np.zeros((1, 3), dtype=np.float32)])
+        self.brands = np.append(self.brands, 0).astype(np.int32)
+        self.models = np.append(self.models, 0).astype(np.int32)
+        self.alive = np.append(self.alive, False)
+        self.neighbours = np.vstack([self.neighbours, np.full((1, self.k), -1, dtype=np.int64)])
+        self.neighbour_distances = np.vstack(
+            [self.neighbour_distances, np.full((1, self.k), np.inf, dtype=np.float32)])
+        self.positions[int(vehicle_id)] = position
+        return position
+
+    def _recompute(self, rows):
+        """Recompute the k nearest neighbours of ``rows`` in chunks"""
+        total = len(self.ids)
+        if not total or not len(rows):
+            return
+        chunk = max(1, _CHUNK_CELLS // total)
+        k = min(self.k, total)
+        for start in range(0, len(rows), chunk):
+            batch = rows[start:start + chunk]
+            distances = self._distances(batch)
+            distances[np.arange(len(batch)), batch] = np.inf  # never your own neighbour
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < total else \
+                np.tile(np.arange(total), (len(batch), 1))
+            nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1)
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            nearest_distances = np.take_along_axis(nearest_distances, order, axis=1)
+            self.neighbours[batch] = -1
+            self.neighbour_distances[batch] = np.inf
+            self.neighbours[batch, :k] = self.ids[nearest]
+            self.neighbour_distances[batch, :k] = nearest_distances
+        dead = rows[~self.alive[rows]]
+        self.neighbours[dead] = -1
+        self.neighbour_distances[dead] = np.inf
+
+    def _distances(self, rows):
+        """Distance matrix between ``rows`` and every indexed vehicle"""
+        squared = np.zeros((len(rows), len(self.ids)), dtype=np.float32)
+        for column in range(self.features.shape[1]):
+            squared += (self.features[rows, column][:, None] - self.features[:, column][None, :]) ** 2
+        distances = np.sqrt(squared)
+        distances += BRAND_PENALTY * (self.brands[rows][:, None] != self.brands[None, :])
+        distances += MODEL_PENALTY * (self.models[rows][:, None] != self.models[None, :])
+        distances[:, ~self.alive] = np.inf
+        return distances
+
+    # -- features ---------------------------------------------------------
+
+    def _raw_features(self, rows):
+        raw = np.full((len(rows), 3), np.nan, dtype=np.float32)
+        for i, row in enumerate(rows):
+            if row.year:
+                raw[i, 0] = row.year
+            if row.kilometers is not None:
+                raw[i, 1] = np.log1p(max(row.kilometers, 0))
+            if row.price_ars_normalized:
+                raw[i, 2] = np.log1p(max(row.price_ars_normalized, 0))
+        return raw
+
+    def _standardize(self, raw):
+        # Missing values sit at the mean, so they add no distance
+        filled = np.where(np.isnan(raw), self.center, raw)
+        return ((filled - self.center) / self.scale).astype(np.float32)
+
+    def _code(self, kind, *values):
+        key = (kind,) + tuple((value or '').strip().lower() for value in values)
+        return self._codes.setdefault(key, len(self._codes))
+
+
+def similar_vehicles(vehicle, limit=4):
+    """Return the active vehicles most similar to ``vehicle``, closest first"""
+    index = current_app.extensions['similar_vehicles']
+    ids = index.similar_ids(vehicle.id, limit)
+    if not ids:
+        return []
+    by_id = {v.id: v for v in Vehicle.query.filter(Vehicle.id.in_(ids), Vehicle.is_active == True)}
+    return [by_id[vehicle_id] for vehicle_id in ids if vehicle_id in by_id]
+
+
+def init_app(app):
+    index = SimilarVehiclesIndex(
+        k=app.config.get('SIMILAR_VEHICLES_K', 6),
+        refresh_seconds=app.config.get('SIMILAR_VEHICLES_REFRESH_SECONDS', 60),
+    )
+    app.extensions[index.name] = index
+    app.before_request(index.ensure_started)
+
+
+SimilarVehiclesIndex.track_changes()
@@ -14,6 +14,18 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Initialize search and filter functionality
     initializeSearchAndFilters();
+    
+    // Incremental image editing on the edit pages
+    initializeImageManagers();
+    
+    // Resize photos in the browser before they are uploaded
+    initializeImageCompression();
+    
+    // Market price suggestion on the submission forms
+    initializePriceSuggestion();
+    
+    // Offline caching for repeat visits
+    initializeServiceWorker();
 });
 
 // Offer Modal Functionality
@@ -287,7 +299,7 @@ function initializeSearchAndFilters() {
         });
         
         // Handle other filter changes
-        const filterSelectors = ['brandFilter', 'locationFilter', 'fuelType', 'transmissionFilter'];
+        const filterSelectors = ['brandFilter', 'locationFilter', 'radiusFilter', 'fuelType', 'transmissionFilter', 'sortOrder'];
         filterSelectors.forEach(selectorId => {
             const selector = document.getElementById(selectorId);
             if (selector) {
@@ -325,7 +337,7 @@ function applyFilters() {
     
     // Clear existing filter parameters
     const filterParams = ['search', 'price_min', 'price_max', 'brand', 'year_min', 'year_max', 
-                         'location', 'fuel_type', 'transmission', 'km_min', 'km_max'];
+                         'location', 'fuel_type', 'transmission', 'km_min', 'km_max', 'radius_km', 'sort', 'page'];
     filterParams.forEach(param => url.searchParams.delete(param));
     
     // Add search parameter if exists
@@ -359,7 +371,7 @@ function applyFilters() {
     }
     
     // Add other filters
-    const otherFilters = ['brand', 'location', 'fuel_type', 'transmission'];
+    const otherFilters = ['brand', 'location', 'radius_km', 'fuel_type', 'transmission', 'sort'];
     otherFilters.forEach(filter => {
         const value = formData.get(filter);
         if (value) {
@@ -376,7 +388,7 @@ function clearAllFilters() {
     
     // Clear all filter parameters
     const filterParams = ['search', 'price_min', 'price_max', 'brand', 'year_min', 'year_max', 
-                         'location', 'fuel_type', 'transmission', 'km_min', 'km_max'];
+                         'location', 'fuel_type', 'transmission', 'km_min', 'km_max', 'radius_km', 'sort', 'page'];
     filterParams.forEach(param => url.searchParams.delete(param));
     
     // Reset form
@@ -420,3 +432,444 @@ function initializeSearchSuggestions() {
         }, 300);
     });
 }
+
+// Client-side image compression
+// File inputs marked with data-compress-images are resized and re-encoded
+// before the form is submitted, so raw phone photos never hit the network.
+function initializeImageCompression() {
+    document.querySelectorAll('input[type="file"][data-compress-images]').forEach(input => {
+        const form = input.form;
+        if (!form || !window.DataTransfer || !window.Blob) return;
+        
+        form.addEventListener('submit', function(e) {
+            if (form.dataset.compressed === 'true' || !input.files.length) return;
+            if (form.classList.contains('needs-validation') && !form.checkValidity()) return;
+            
+            e.preventDefault();
+            compressInputImages(input).finally(() => {
+                form.dataset.compressed = 'true';
+                // submit() does not fire the submit event again
+                form.submit();
+            });
+        });
+        
+        input.addEventListener('change', function() {
+            delete form.dataset.compressed;
+        });
+    });
+}
+
+async function compressInputImages(input) {
+    const files = await compressImageFiles(input);
+    const transfer = new DataTransfer();
+    files.forEach(file => transfer.items.add(file));
+    input.files = transfer.files;
+}
+
+async function compressImageFiles(input) {
+    const options = {
+        maxDimension: parseInt(input.dataset.maxDimension, 10) || 1600,
+        quality: parseFloat(input.dataset.quality) || 0.8,
+        format: await pickImageFormat(input.dataset.format)
+    };
+    const files = Array.from(input.files);
+    const progress = showCompressionProgress(input, files.length);
+    const compressed = [];
+    
+    for (let i = 0; i < files.length; i++) {
+        let file = files[i];
+        try {
+            file = await compressImage(file, options);
+        } catch (error) {
+            console.warn('No se pudo comprimir la imagen, se envía la original:', file.name, error);
+        }
+        compressed.push(file);
+        progress.update(i + 1);
+    }
+    
+    progress.done();
+    return compressed;
+}
+
+async function compressImage(file, options) {
+    // GIFs may be animated and unknown types cannot be decoded reliably
+    if (!/^image\/(jpeg|png|webp|heic|heif)$/.test(file.type)) return file;
+    
+    const orientation = file.type === 'image/jpeg' ? await readExifOrientation(file) : 1;
+    const source = await decodeImage(file);
+    const rotated = source.orientation === 'applied' ? 1 : orientation;
+    const swap = rotated >= 5 && rotated <= 8;
+    const width = swap ? source.height : source.width;
+    const height = swap ? source.width : source.height;
+    const scale = Math.min(1, options.maxDimension / Math.max(width, height));
+    
+    // Already small and correctly oriented: keep the original bytes
+    if (scale === 1 && rotated === 1 && file.size <= 500 * 1024) {
+        source.close();
+        return file;
+    }
+    
+    const targetWidth = Math.round(width * scale);
+    const targetHeight = Math.round(height * scale);
+    const canvas = createCanvas(targetWidth, targetHeight);
+    const context = canvas.getContext('2d');
+    context.imageSmoothingQuality = 'high';
+    applyOrientation(context, rotated, targetWidth, targetHeight);
+    const drawWidth = swap ? targetHeight : targetWidth;
+    const drawHeight = swap ? targetWidth : targetHeight;
+    context.drawImage(source.image, 0, 0, drawWidth, drawHeight);
+    source.close();
+    
+    const blob = await canvasToBlob(canvas, options.format, options.quality);
+    if (!blob || (blob.size >= file.size && scale === 1 && rotated === 1)) return file;
+    
+    const extension = options.format === 'image/webp' ? 'webp' : 'jpg';
+    const name = file.name.replace(/\.[^.]*$/, '') + '.' + extension;
+    return new File([blob], name, { type: options.format, lastModified: Date.now() });
+}
+
+async function decodeImage(file) {
+    if (window.createImageBitmap) {
+        try {
+            const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+            return {
+                image: bitmap,
+                width: bitmap.width,
+                height: bitmap.height,
+                orientation: 'applied',
+                close: () => bitmap.close()
+            };
+        } catch (error) {
+            // Fall back to an <img> element below
+        }
+    }
+    
+    const url = URL.createObjectURL(file);
+    const image = new Image();
+    image.src = url;
+    await image.decode();
+    // Browsers that honour image-orientation already draw the photo upright
+    const autoOriented = window.CSS && CSS.supports && CSS.supports('image-orientation', 'from-image');
+    return {
+        image: image,
+        width: image.naturalWidth,
+        height: image.naturalHeight,
+        orientation: autoOriented ? 'applied' : 'raw',
+        close: () => URL.revokeObjectURL(url)
+    };
+}
+
+// EXIF orientation tag (1-8) of a JPEG file, 1 when absent
+async function readExifOrientation(file) {
+    const view = new DataView(await file.slice(0, 128 * 1024).arrayBuffer());
+    if (view.byteLength < 4 || view.getUint16(0) !== 0xFFD8) return 1;
+    
+    let offset = 2;
+    while (offset + 4 <= view.byteLength) {
+        const marker = view.getUint16(offset);
+        const length = view.getUint16(offset + 2);
+        if (marker === 0xFFE1 && offset + 10 <= view.byteLength && view.getUint32(offset + 4) === 0x45786966) {
+            const tiff = offset + 10;
+            const little = view.getUint16(tiff) === 0x4949;
+            const entries = tiff + view.getUint32(tiff + 4, little);
+            const count = view.getUint16(entries, little);
+            for (let i = 0; i < count; i++) {
+                const entry = entries + 2 + i * 12;
+                if (entry + 10 > view.byteLength) break;
+                if (view.getUint16(entry, little) === 0x0112) {
+                    return view.getUint16(entry + 8, little);
+                }
+            }
+            return 1;
+        }
+        if ((marker & 0xFF00) !== 0xFF00 || marker === 0xFFDA) break;
+        offset += 2 + length;
+    }
+    return 1;
+}
+
+function applyOrientation(context, orientation, width, height) {
+    switch (orientation) {
+        case 2: context.transform(-1, 0, 0, 1, width, 0); break;
+        case 3: context.transform(-1, 0, 0, -1, width, height); break;
+        case 4: context.transform(1, 0, 0, -1, 0, height); break;
+        case 5: context.transform(0, 1, 1, 0, 0, 0); break;
+        case 6: context.transform(0, 1, -1, 0, width, 0); break;
+        case 7: context.transform(0, -1, -1, 0, width, height); break;
+        case 8: context.transform(0, -1, 1, 0, 0, height); break;
+    }
+}
+
+function createCanvas(width, height) {
+    if (window.OffscreenCanvas) {
+        return new OffscreenCanvas(width, height);
+    }
+    const canvas = document.createElement('canvas');
+    canvas.width = width;
+    canvas.height = height;
+    return canvas;
+}
+
+function canvasToBlob(canvas, type, quality) {
+    if (canvas.convertToBlob) {
+        return canvas.convertToBlob({ type: type, quality: quality });
+    }
+    return new Promise(resolve => canvas.toBlob(resolve, type, quality));
+}
+
+// WebP when requested and the browser can encode it, JPEG otherwise
+async function pickImageFormat(requested) {
+    if (requested !== 'webp') return 'image/jpeg';
+    const blob = await canvasToBlob(createCanvas(1, 1), 'image/webp', 0.8);
+    return blob && blob.type === 'image/webp' ? 'image/webp' : 'image/jpeg';
+}
+
+function showCompressionProgress(input, total) {
+    const wrapper = document.createElement('div');
+    wrapper.className = 'mt-2';
+    wrapper.innerHTML = `
+        <div class="small text-muted mb-1">
+            <i class="fas fa-compress-alt me-1"></i>Optimizando imágenes (<span>0</span>/${total})...
+        </div>
+        <div class="progress" style="height: 6px;">
+            <div class="progress-bar progress-bar-striped progress-bar-animated" role="progressbar" style="width: 0%"></div>
+        </div>
+    `;
+    const container = input.closest('.input-group') || input;
+    container.insertAdjacentElement('afterend', wrapper);
+    const counter = wrapper.querySelector('span');
+    const bar = wrapper.querySelector('.progress-bar');
+    
+    const submitButtons = input.form ? input.form.querySelectorAll('button[type="submit"]') : [];
+    submitButtons.forEach(button => button.disabled = true);
+    
+    return {
+        update(done) {
+            counter.textContent = done;
+            bar.style.width = `${Math.round(done / total * 100)}%`;
+        },
+        done() {
+            bar.classList.remove('progress-bar-animated');
+            bar.classList.add('bg-success');
+            submitButtons.forEach(button => button.disabled = false);
+            setTimeout(() => wrapper.remove(), 1500);
+        }
+    };
+}
+
+// Image manager on the edit pages
+// Each action (add, remove, reorder, main image) is a single JSON request
+// that only touches the affected image; the rest of the form posts as usual.
+function initializeImageManagers() {
+    document.querySelectorAll('[data-image-manager]').forEach(manager => {
+        const url = manager.dataset.imagesUrl;
+        const grid = manager.querySelector('[data-image-grid]');
+        const status = manager.querySelector('[data-image-status]');
+        const input = manager.querySelector('input[type="file"]');
+        let state = JSON.parse(manager.dataset.images);
+        let busy = false;
+        
+        // Files go through the API, not through the form submission
+        if (input) {
+            input.removeAttribute('name');
+            input.removeAttribute('data-compress-images');
+        }
+        
+        function render() {
+            grid.innerHTML = '';
+            state.images.forEach((image, index) => {
+                const isMain = index === state.main_index;
+                const column = document.createElement('div');
+                column.className = 'col-md-3 mb-3';
+                column.innerHTML = `
+                    <div class="position-relative">
+                        <img class="img-fluid rounded" style="height: 150px; width: 100%; object-fit: cover;" alt="Imagen ${index + 1}">
+                        ${isMain ? '<span class="badge bg-warning text-dark position-absolute top-0 start-0 m-1"><i class="fas fa-star me-1"></i>Principal</span>' : ''}
+                    </div>
+                    <div class="btn-group btn-group-sm w-100 mt-1" role="group">
+                        <button type="button" class="btn btn-outline-secondary" data-image-action="left" title="Mover antes" ${index === 0 ? 'disabled' : ''}>
+                            <i class="fas fa-arrow-left"></i>
+                        </button>
+                        <button type="button" class="btn btn-outline-warning" data-image-action="main" title="Marcar como principal" ${isMain ? 'disabled' : ''}>
+                            <i class="fas fa-star"></i>
+                        </button>
+                        <button type="button" class="btn btn-outline-secondary" data-image-action="right" title="Mover después" ${index === state.images.length - 1 ? 'disabled' : ''}>
+                            <i class="fas fa-arrow-right"></i>
+                        </button>
+                        <button type="button" class="btn btn-outline-danger" data-image-action="remove" title="Eliminar">
+                            <i class="fas fa-trash"></i>
+                        </button>
+                    </div>
+                `;
+                column.querySelector('img').src = image.url;
+                column.dataset.index = index;
+                grid.appendChild(column);
+            });
+            
+            if (!state.images.length) {
+                grid.innerHTML = '<div class="col-12 mb-3"><small class="text-muted">Sin imágenes</small></div>';
+            }
+        }
+        
+        function showStatus(message, type) {
+            status.innerHTML = '';
+            if (!message) return;
+            const alert = document.createElement('div');
+            alert.className = `alert alert-${type} py-2 small`;
+            alert.textContent = message;
+            status.appendChild(alert);
+        }
+        
+        async function send(method, suffix, body) {
+            if (busy) return;
+            busy = true;
+            manager.classList.add('opacity-75');
+            try {
+                const options = { method: method, body: body };
+                if (!(body instanceof FormData)) {
+                    options.headers = { 'Content-Type': 'application/json' };
+                    options.body = JSON.stringify(body);
+                }
+                const response = await fetch(url + suffix, options);
+                const data = await response.json();
+                if (data.images) {
+                    state = data;
+                    render();
+                }
+                if (!data.success) {
+                    showStatus(data.error || 'No se pudo guardar el cambio', 'danger');
+                } else if (data.rejected && data.rejected.length) {
+                    showStatus(`Algunas imágenes no se guardaron: ${data.rejected.join(', ')}`, 'warning');
+                } else {
+                    showStatus('', '');
+                }
+            } catch (error) {
+                showStatus('No se pudo guardar el cambio. Verifica tu conexión.', 'danger');
+            } finally {
+                busy = false;
+                manager.classList.remove('opacity-75');
+            }
+        }
+        
+        grid.addEventListener('click', function(e) {
+            const button = e.target.closest('[data-image-action]');
+            if (!button) return;
+            const index = parseInt(button.closest('[data-index]').dataset.index, 10);
+            const path = state.images[index].path;
+            const action = button.dataset.imageAction;
+            
+            if (action === 'remove') {
+                if (confirm('¿Eliminar esta imagen?')) {
+                    send('DELETE', '', { path: path });
+                }
+            } else if (action === 'main') {
+                send('PUT', '/principal', { path: path });
+            } else {
+                const order = state.images.map(image => image.path);
+                const target = action === 'left' ? index - 1 : index + 1;
+                [order[index], order[target]] = [order[target], order[index]];
+                send('PUT', '/orden', { order: order });
+            }
+        });
+        
+        if (input) {
+            input.addEventListener('change', async function() {
+                if (!input.files.length || busy) return;
+                let files = Array.from(input.files);
+                if (window.DataTransfer && window.Blob) {
+                    files = await compressImageFiles(input);
+                }
+                const body = new FormData();
+                files.forEach(file => body.append('vehicle_images', file));
+                input.value = '';
+                await send('POST', '', body);
+            });
+        }
+        
+        render();
+    });
+}
+
+// Price suggestion
+// Price inputs marked with data-price-estimate ask the estimator as the
+// vehicle details are typed and offer the suggested market price.
+function initializePriceSuggestion() {
+    document.querySelectorAll('input[data-price-estimate]').forEach(priceInput => {
+        const form = priceInput.form;
+        const hint = priceInput.parentElement.querySelector('[data-price-suggestion]');
+        if (!form || !hint) return;
+        
+        const fields = {
+            anio: 'year', marca: 'brand', modelo: 'model', km: 'kilometers',
+            combustible: 'fuel_type', transmision: 'transmission', moneda: 'currency'
+        };
+        let timer;
+        let controller;
+        
+        function formatAmount(amount) {
+            return amount.toLocaleString('es-AR');
+        }
+        
+        function update() {
+            const params = new URLSearchParams();
+            Object.entries(fields).forEach(([param, name]) => {
+                const field = form.elements[name];
+                if (field && field.value.trim()) params.set(param, field.value.trim());
+            });
+            if (!params.has('anio') || !params.has('moneda')) {
+                hint.hidden = true;
+                return;
+            }
+            if (controller) controller.abort();
+            controller = new AbortController();
+            fetch(`${priceInput.dataset.priceEstimate}?${params}`, { signal: controller.signal })
+                .then(response => response.ok ? response.json() : null)
+                .then(data => {
+                    const estimate = data && data.estimate;
+                    if (!estimate) {
+                        hint.hidden = true;
+                        return;
+                    }
+                    const symbol = estimate.currency === 'USD' ? 'US$' : '$';
+                    hint.innerHTML = `<i class="fas fa-chart-line me-1"></i>Precio de mercado sugerido: ` +
+                        `<strong>${symbol} ${formatAmount(estimate.price)}</strong> ` +
+                        `(entre ${symbol} ${formatAmount(estimate.low)} y ${symbol} ${formatAmount(estimate.high)}, ` +
+                        `${estimate.sample_size} publicaciones) ` +
+                        `<a href="#" class="ms-1" data-use-price>Usar</a>`;
+                    hint.querySelector('[data-use-price]').addEventListener('click', event => {
+                        event.preventDefault();
+                        priceInput.value = estimate.price;
+                        priceInput.dispatchEvent(new Event('input', { bubbles: true }));
+                    });
+                    hint.hidden = false;
+                })
+                .catch(error => {
+                    if (error.name !== 'AbortError') console.error('Price estimate error:', error);
+                });
+        }
+        
+        Object.values(fields).forEach(name => {
+            const field = form.elements[name];
+            if (!field) return;
+            ['input', 'change'].forEach(type => field.addEventListener(type, () => {
+                clearTimeout(timer);
+                timer = setTimeout(update, 300);
+            }));
+        });
+        update();
+    });
+}
+
+// Register the service worker that caches assets, photos and visited listings
+function initializeServiceWorker() {
+    const url = document.body.dataset.serviceWorker;
+    if (!url || !('serviceWorker' in navigator)) {
+        return;
+    }
+    // After the page has loaded, so the worker's precaching does not compete with it
+    window.addEventListener('load', () => {
+        navigator.serviceWorker.register(url).catch(error => {
+            console.warn('Service worker registration failed:', error);
+        });
+    });
+}
@@ -0,0 +1,162 @@
+import io
+import mimetypes
+import os
+import shutil
+from collections import namedtuple
+from datetime import timezone
+
+from flask import current_app, url_for
+
+# Stored image paths look like "uploads/<name>"; the name is the storage key
+UPLOAD_PREFIX = 'uploads/'
+
+# Uploaded names are unique (timestamped), so the bytes never change
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+# An entry listed by a storage backend (mtime in epoch seconds)
+StoredFile = namedtuple('StoredFile', 'name size mtime')
+
+
+class LocalStorage:
+    """Uploads kept in a directory of this node.
+
+    ``serve_mode`` picks how the bytes reach the browser: ``static`` links to
+    Flask's static route (the default, for a single node), while
+    ``x-accel-redirect`` and ``x-sendfile`` link to the ``uploaded_file``
+    view, which only answers with a header telling the front proxy (nginx,
+    Apache, lighttpd) which file to send.
+    """
+
+    def __init__(self, folder, serve_mode='static', accel_prefix='/protected-uploads/'):
+        self.folder = folder
+        self.serve_mode = serve_mode
+        self.accel_prefix = accel_prefix.rstrip('/') + '/'
+
+    def _path(self, name):
+        return os.path.join(self.folder, os.path.basename(name))
+
+    def save(self, stream, name, content_type=None):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self._path(name), 'wb') as output:
+            shutil.copyfileobj(stream, output)
+
+    def open(self, name):
+        return open(self._path(name), 'rb')
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def url(self, name):
+        if self.serve_mode == 'static':
+            return url_for('static', filename=UPLOAD_PREFIX + name)
+        return url_for('uploaded_file', name=name)
+
+    def iter_files(self):
+        try:
+            entries = os.scandir(self.folder)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield StoredFile(entry.name, stat.st_size, stat.st_mtime)
+
+    def offload_headers(self, name):
+        """Headers that make the front proxy send ``name``, or None if it cannot"""
+        if not os.path.isfile(self._path(name)):
+            return None
+        if self.serve_mode == 'x-accel-redirect':
+            return {'X-Accel-Redirect': self.accel_prefix + os.path.basename(name)}
+        if self.serve_mode == 'x-sendfile':
+            return {'X-Sendfile': os.path.abspath(self._path(name))}
+        return None
+
+
+class S3Storage:
+    """Uploads kept in an S3-compatible bucket (AWS S3, MinIO, R2...).
+
+    Every node reads and writes the same bucket and browsers fetch the images
+    straight from ``public_url`` (the bucket or a CDN in front of it), so no
+    worker time is spent streaming image bytes.
+    """
+
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 public_url=None, key_prefix=UPLOAD_PREFIX):
+        try:
+            import boto3
+        except ImportError as e:
+            raise RuntimeError("UPLOAD_STORAGE=s3 requires boto3 (pip install boto3)") from e
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region,
+                                   aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+        if public_url is None:
+            public_url = f"{endpoint_url.rstrip('/')}/{bucket}" if endpoint_url else f"https://{bucket}.s3.amazonaws.com"
+        self.public_url = public_url.rstrip('/')
+
+    def _key(self, name):
+        return self.key_prefix + os.path.basename(name)
+
+    def save(self, stream, name, content_type=None):
+        content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.client.upload_fileobj(stream, self.bucket, self._key(name),
+                                   ExtraArgs={'ContentType': content_type, 'CacheControl': CACHE_CONTROL})
+
+    def open(self, name):
+        body = self.client.get_object(Bucket=self.bucket, Key=self._key(name))['Body']
+        return io.BytesIO(body.read())
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+    def url(self, name):
+        return f"{self.public_url}/{self._key(name)}"
+
+    def iter_files(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key_prefix):
+            for item in page.get('Contents', ()):
+                name = item['Key'][len(self.key_prefix):]
+                if name and '/' not in name:
+                    modified = item['LastModified'].replace(tzinfo=item['LastModified'].tzinfo or timezone.utc)
+                    yield StoredFile(name, item['Size'], modified.timestamp())
+
+    def offload_headers(self, name):
+        return None
+
+
+def get_storage():
+    return current_app.extensions['upload_storage']
+
+
+def upload_url(path):
+    """Public URL of a stored image path; external URLs are returned unchanged"""
+    if path.startswith(UPLOAD_PREFIX):
+        return get_storage().url(path[len(UPLOAD_PREFIX):])
+    return path
+
+
+def create_storage(config):
+    backend = config.get('UPLOAD_STORAGE', 'local')
+    if backend == 's3':
+        return S3Storage(
+            bucket=config['S3_BUCKET'],
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            access_key=config.get('S3_ACCESS_KEY_ID'),
+            secret_key=config.get('S3_SECRET_ACCESS_KEY'),
+            public_url=config.get('S3_PUBLIC_URL'),
+        )
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'], serve_mode=config.get('UPLOAD_SERVE_MODE', 'static'),
+                            accel_prefix=config.get('UPLOAD_ACCEL_PREFIX', '/protected-uploads/'))
+    raise ValueError(f"Unknown UPLOAD_STORAGE backend: {backend}")
+
+
+def init_app(app):
+    app.extensions['upload_storage'] = create_storage(app.config)
@@ -0,0 +1,151 @@
+// Service worker: keeps the site's assets, listing photos and recently seen
+// listings on the phone, so repeat visits on mobile data only fetch what changed.
+//
+// - static files (ours, fingerprinted with ?v=, and the CDN ones): cache first
+// - listing photos: stale while revalidate
+// - listing pages and search JSON: network first, cached copy or offline page
+//
+// Each cache keeps at most LIMITS[name] entries and evicts the least recently
+// used. The Cache API lists keys in insertion order and put() moves an entry
+// to the end, so re-putting an entry whenever it is used keeps keys() in LRU
+// order. The static and page caches are named after the deployed asset
+// version; a deploy installs a new worker that drops them.
+
+const VERSION = {{ version|tojson }};
+const PRECACHE = {{ precache|tojson }};
+const OFFLINE_URL = {{ offline_url|tojson }};
+const CDN_ORIGINS = {{ cdn_origins|tojson }};
+const STATIC_PREFIX = {{ static_prefix|tojson }};
+const NETWORK_ONLY = {{ network_only|tojson }};
+const INDEX_URL = {{ index_url|tojson }};
+const LISTING_PREFIXES = {{ listing_prefixes|tojson }};
+
+const CACHES = {
+    static: `static-${VERSION}`,
+    images: 'images',
+    pages: `pages-${VERSION}`,
+};
+
+const LIMITS = {
+    [CACHES.static]: 80,
+    [CACHES.images]: 150,
+    [CACHES.pages]: 40,
+};
+
+self.addEventListener('install', event => {
+    event.waitUntil((async () => {
+        const cache = await caches.open(CACHES.static);
+        await cache.addAll([OFFLINE_URL, ...PRECACHE.filter(url => url.startsWith('/'))]);
+        // A CDN that is down must not keep the worker from installing
+        await Promise.all(PRECACHE.filter(url => !url.startsWith('/')).map(url => cache.add(url).catch(() => {})));
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const current = new Set(Object.values(CACHES));
+        for (const name of await caches.keys()) {
+            if (!current.has(name)) {
+                await caches.delete(name);
+            }
+        }
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+    const url = new URL(request.url);
+    const sameOrigin = url.origin === self.location.origin;
+
+    if (sameOrigin && NETWORK_ONLY.some(prefix => url.pathname.startsWith(prefix))) {
+        return;
+    }
+    if ((sameOrigin && url.pathname.startsWith(STATIC_PREFIX) && request.destination !== 'image')
+            || CDN_ORIGINS.includes(url.origin)) {
+        event.respondWith(cacheFirst(event, CACHES.static));
+    } else if (request.destination === 'image') {
+        event.respondWith(staleWhileRevalidate(event, CACHES.images));
+    } else if (sameOrigin && (request.mode === 'navigate' || isListing(url))) {
+        event.respondWith(networkFirst(event, isListing(url) ? CACHES.pages : null));
+    }
+});
+
+function isListing(url) {
+    return url.pathname === INDEX_URL || LISTING_PREFIXES.some(prefix => url.pathname.startsWith(prefix));
+}
+
+async function remember(cacheName, request, response) {
+    const cache = await caches.open(cacheName);
+    await cache.put(request, response);
+    const keys = await cache.keys();
+    const excess = keys.length - LIMITS[cacheName];
+    for (let i = 0; i < excess; i++) {
+        await cache.delete(keys[i]);
+    }
+}
+
+function cacheable(response) {
+    return response.ok && !response.redirected;
+}
+
+async function cacheFirst(event, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(event.request);
+    if (cached) {
+        event.waitUntil(remember(cacheName, event.request, cached.clone()));
+        return cached;
+    }
+    const response = await fetch(event.request);
+    // CDN files requested without CORS come back opaque; they are still worth keeping
+    if (cacheable(response) || response.type === 'opaque') {
+        event.waitUntil(remember(cacheName, event.request, response.clone()));
+    }
+    return response;
+}
+
+async function staleWhileRevalidate(event, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(event.request);
+    const network = fetch(event.request).then(response => {
+        // Opaque (cross-origin) photos are not stored: their size cannot be
+        // known and browsers count them as several megabytes of quota
+        if (cacheable(response)) {
+            return remember(cacheName, event.request, response.clone()).then(() => response);
+        }
+        return response;
+    });
+    if (cached) {
+        event.waitUntil(network.catch(() => {}));
+        return cached;
+    }
+    return network;
+}
+
+async function networkFirst(event, cacheName) {
+    const request = event.request;
+    try {
+        const response = await fetch(request);
+        if (cacheName && cacheable(response)) {
+            event.waitUntil(remember(cacheName, request, response.clone()));
+        }
+        return response;
+    } catch (error) {
+        const cached = cacheName && await caches.match(request, {cacheName});
+        if (cached) {
+            event.waitUntil(remember(cacheName, request, cached.clone()));
+            return cached;
+        }
+        if (request.mode === 'navigate') {
+            return caches.match(OFFLINE_URL);
+        }
+        return new Response(JSON.stringify({success: false, error: 'Sin conexión', vehicles: []}), {
+            status: 503,
+            headers: {'Content-Type': 'application/json'},
+        });
+    }
+}
@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+
+from app import create_app, init_db
+from models import db, ClientRequest, Vehicle
+
+# Environment variables create_app() reads that would point a test at a real deployment
+_DEPLOYMENT_VARIABLES = ('DATABASE_URL', 'ANALYTICS_DATABASE_URL', 'REPLICA_DATABASE_URL', 'UPLOAD_STORAGE',
+                         'APP_ENV', 'LOG_LEVEL')
+
+INDEXES = ('similar_vehicles', 'duplicate_index', 'price_estimator')
+
+
+@pytest.fixture
+def config(tmp_path):
+    """test_config of the app fixture; tests may change it before using ``app``"""
+    return {
+        'TESTING': True,
+        'APP_ENV': 'testing',
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'BACKUP_DIR': str(tmp_path / 'backups'),
+        'RATE_LIMIT_ENABLED': False,
+        'ALERT_DELIVERY_INTERVAL_SECONDS': 0,
+        'UPLOAD_GC_INTERVAL_SECONDS': 0,
+        'BACKUP_INTERVAL_SECONDS': 0,
+    }
+
+
+@pytest.fixture
+def app(config, monkeypatch):
+    for name in _DEPLOYMENT_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+    app = create_app(config)
+    with app.app_context():
+        init_db()
+        # Build the in-memory indexes up front instead of on a background thread
+        for name in INDEXES:
+            app.extensions[name].build()
+        yield app
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin_client(client):
+    from models import Admin
+
+    admin = Admin.query.first()
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+        session['admin_id'] = admin.id
+    return client
+
+
+def make_vehicle(**values):
+    fields = {
+        'title': 'Toyota Corolla', 'description': 'Único dueño', 'price': 20_000_000, 'currency': 'ARS',
+        'year': 2018, 'brand': 'Toyota', 'model': 'Corolla', 'kilometers': 80_000, 'fuel_type': 'Nafta',
+        'transmission': 'Manual', 'location': 'Tunuyán', 'images': '[]', 'whatsapp_number': '+5492604000000',
+    }
+    fields.update(values)
+    vehicle = Vehicle(**fields)
+    db.session.add(vehicle)
+    db.session.commit()
+    return vehicle
+
+
+def make_request(images=(), **values):
+    fields = {
+        'full_name': 'Ana Pérez', 'dni': '30111222', 'phone_number': '+5492604111111', 'location': 'Tunuyán',
+        'title': 'Ford Ka', 'description': 'Buen estado', 'price': 9_000_000, 'currency': 'ARS',
+        'year': 2015, 'brand': 'Ford', 'model': 'Ka', 'kilometers': 120_000, 'images': json.dumps(list(images)),
+    }
+    fields.update(values)
+    client_request = ClientRequest(**fields)
+    db.session.add(client_request)
+    db.session.commit()
+    return client_request
+
+
+def write_upload(app, name, data=b'image', age_seconds=0):
+    """Put a file straight into the local upload folder, ``age_seconds`` old"""
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if age_seconds:
+        mtime = os.path.getmtime(path) - age_seconds
+        os.utime(path, (mtime, mtime))
+    return path
@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import inspect, text
+
+from conftest import make_vehicle
+from database import analytics_is_separate
+from models import db, ANALYTICS_BIND, Click, Vehicle, VehicleView
+from routes import count_by_vehicle, most_counted_vehicles
+
+
+def add_views(vehicle, count):
+    db.session.add_all(VehicleView(vehicle_id=vehicle.id, ip_address='10.0.0.1') for _ in range(count))
+    db.session.commit()
+
+
+@pytest.fixture(params=['shared', 'separate'])
+def config(request, config, tmp_path):
+    if request.param == 'separate':
+        config['SQLALCHEMY_BINDS'] = {ANALYTICS_BIND: {'url': f"sqlite:///{tmp_path / 'analytics.db'}"}}
+    return config
+
+
+def test_tracking_tables_live_on_the_analytics_bind(app):
+    tables = inspect(db.engines[ANALYTICS_BIND]).get_table_names()
+    assert {'vehicle_view', 'click', 'page_visit'} <= set(tables)
+    if analytics_is_separate():
+        assert 'vehicle' not in tables
+
+
+def test_sqlite_connections_are_tuned(app):
+    for engine in db.engines.values():
+        with engine.connect() as connection:
+            assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert connection.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+
+
+def test_most_counted_vehicles_ranks_matching_vehicles(app):
+    popular = make_vehicle(title='Popular')
+    hidden = make_vehicle(title='Inactiva', is_active=False)
+    free = make_vehicle(title='Gratis', is_plus=False)
+    second = make_vehicle(title='Segunda')
+    make_vehicle(title='Sin visitas')
+    add_views(hidden, 9)
+    add_views(free, 8)
+    add_views(popular, 5)
+    add_views(second, 2)
+
+    result = most_counted_vehicles(VehicleView, (Vehicle.is_active == True, Vehicle.is_plus == True),
+                                   limit=3, batch_size=1)
+
+    assert [(vehicle.title, count) for vehicle, count in result] == [('Popular', 5), ('Segunda', 2),
+                                                                      ('Sin visitas', 0)]
+
+
+def test_count_by_vehicle_only_counts_the_given_vehicles(app):
+    first, second, third = make_vehicle(), make_vehicle(), make_vehicle()
+    db.session.add_all([Click(vehicle_id=first.id, click_type='whatsapp'),
+                        Click(vehicle_id=first.id, click_type='offer'),
+                        Click(vehicle_id=third.id, click_type='whatsapp')])
+    db.session.commit()
+
+    assert count_by_vehicle(Click, [first.id, second.id]) == {first.id: 2}
+    assert count_by_vehicle(Click, []) == {}
+
+
+def test_home_and_dashboard_show_most_viewed(app, admin_client):
+    vehicle = make_vehicle(title='Toyota Hilux')
+    add_views(vehicle, 3)
+
+    assert 'Toyota Hilux' in admin_client.get('/').get_data(as_text=True)
+    assert 'Toyota Hilux' in admin_client.get('/panel').get_data(as_text=True)
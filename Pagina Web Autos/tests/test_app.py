@@ -0,0 +1,82 @@
+import gc
+import os
+import weakref
+
+import pytest
+from sqlalchemy.engine import Engine
+
+import app as app_module
+
+from app import create_app
+from conftest import _DEPLOYMENT_VARIABLES
+from models import db, Admin
+
+
+@pytest.fixture
+def build(config, monkeypatch):
+    """create_app() on the test configuration, without init_db()"""
+    for name in _DEPLOYMENT_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+    apps = []
+
+    def build():
+        app = create_app(config)
+        apps.append(app)
+        return app
+    yield build
+    for app in apps:
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+
+def database_path(config):
+    return config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+
+
+def test_building_the_app_does_not_touch_the_database(build, config):
+    app = build()
+
+    assert 'index' in app.view_functions and 'sitemap_page' in app.view_functions
+    assert not os.path.exists(database_path(config))
+
+
+def test_each_app_gets_its_own_extensions(build):
+    first, second = build(), build()
+
+    assert first.url_map is not second.url_map
+    for name in ('rate_limiter', 'upload_storage', 'similar_vehicles', 'price_estimator'):
+        assert first.extensions[name] is not second.extensions[name]
+
+
+def test_init_db_command_creates_the_schema_and_admin_once(build, config):
+    app = build()
+    runner = app.test_cli_runner()
+
+    first = runner.invoke(args=['init-db'])
+    second = runner.invoke(args=['init-db'])
+
+    assert first.exit_code == 0 and 'Admin user created.' in first.output
+    assert second.exit_code == 0 and 'Admin user created.' not in second.output
+    with app.app_context():
+        assert Admin.query.count() == 1
+
+
+def test_fork_handler_disposes_the_engines_of_live_apps(build, config, monkeypatch):
+    monkeypatch.setattr(app_module, '_apps', weakref.WeakSet())
+    first, second = build(), build()
+    disposed = []
+    monkeypatch.setattr(Engine, 'dispose', lambda engine, close=True: disposed.append((engine, close)))
+
+    app_module._dispose_engines_after_fork()
+
+    engines = []
+    for built in (first, second):
+        with built.app_context():
+            engines.extend(db.engines.values())
+    assert sorted(map(id, engines)) == sorted(id(engine) for engine, _ in disposed)
+    assert not any(close for _, close in disposed)
+    # Apps are held weakly: one that is gone is no longer disposed
+    create_app(config)
+    gc.collect()
+    assert set(app_module._apps) == {first, second}
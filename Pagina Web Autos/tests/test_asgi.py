@@ -0,0 +1,149 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from conftest import make_vehicle
+from db_routing import REPLICA_BIND
+from models import db, Admin, Click, VehicleView
+
+
+@pytest.fixture
+def config(request, config, tmp_path):
+    if getattr(request, 'param', None) == 'replica':
+        config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: f"sqlite:///{tmp_path / 'replica.db'}"}
+    config['RATE_LIMIT_ENABLED'] = True
+    config['RATE_LIMITS'] = {'track_click': (1, 60, 1)}
+    config['ASGI_SYNC_THREADS'] = 2
+    return config
+
+
+@pytest.fixture
+def routes(app):
+    pytest.importorskip('a2wsgi')
+    pytest.importorskip('aiosqlite')
+    # Imported after the app fixture cleared the deployment variables
+    from asgi import AsyncRoutes
+
+    routes = AsyncRoutes(app)
+    routes.loop = asyncio.new_event_loop()
+    yield routes
+    if routes.database is not None:
+        routes.loop.run_until_complete(routes.database.dispose())
+    routes.loop.close()
+
+
+def call(routes, path, method='GET', query=b'', headers=(), client='198.51.100.1'):
+    """One HTTP request through the ASGI app; returns (status, headers, body)"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': query,
+             'headers': [(b'host', b'localhost'), *headers], 'client': (client, 50000),
+             'server': ('localhost', 80)}
+    routes.loop.run_until_complete(routes(scope, receive, send))
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, body
+
+
+def test_vehicle_detail_is_served_async_and_records_the_view(routes):
+    vehicle = make_vehicle(title='Peugeot 208')
+
+    status, _, body = call(routes, f'/vehicle/{vehicle.id}', headers=[(b'user-agent', b'pytest')])
+
+    assert status == 200 and 'Peugeot 208' in body.decode()
+    assert routes.database is not None
+    view = VehicleView.query.one()
+    assert (view.vehicle_id, view.user_agent, view.ip_address) == (vehicle.id, 'pytest', '198.51.100.1')
+    assert call(routes, '/vehicle/999')[0] == 404
+
+
+def test_head_request_has_no_body(routes):
+    vehicle = make_vehicle()
+
+    status, _, body = call(routes, f'/vehicle/{vehicle.id}', method='HEAD')
+
+    assert (status, body) == (200, b'')
+
+
+def test_api_search_is_served_async(routes):
+    make_vehicle(title='Fiat Cronos', brand='Fiat', model='Cronos')
+    make_vehicle()
+
+    status, _, body = call(routes, '/api/search', query=b'q=cronos')
+
+    assert status == 200
+    assert [vehicle['title'] for vehicle in json.loads(body)['vehicles']] == ['Fiat Cronos']
+    assert json.loads(call(routes, '/api/search')[2]) == {'vehicles': []}
+
+
+def test_track_click_records_and_is_rate_limited_per_client(routes):
+    vehicle = make_vehicle()
+    url = f'/track_click/{vehicle.id}/whatsapp'
+
+    status, headers, _ = call(routes, url)
+    limited, limited_headers, _ = call(routes, url)
+    # The client address behind the trusted proxy gets its own bucket
+    other, _, _ = call(routes, url, headers=[(b'x-forwarded-for', b'203.0.113.7')])
+
+    assert status == 302 and headers['location'].startswith('https://wa.me/')
+    assert limited == 429 and int(limited_headers['retry-after']) >= 1
+    assert other == 302
+    assert [click.ip_address for click in Click.query.order_by(Click.id)] == ['198.51.100.1', '203.0.113.7']
+
+
+def test_logged_in_admins_are_limited_apart_from_their_ip(app, routes):
+    vehicle = make_vehicle()
+    url = f'/track_click/{vehicle.id}/whatsapp'
+    cookie = app.session_interface.get_signing_serializer(app).dumps(
+        {'admin_logged_in': True, 'admin_id': Admin.query.first().id})
+    call(routes, url)
+
+    assert call(routes, url)[0] == 429
+    assert call(routes, url, headers=[(b'cookie', f'session={cookie}'.encode())])[0] == 302
+
+
+def test_other_requests_go_to_the_flask_app(routes):
+    status, _, body = call(routes, '/')
+
+    assert status == 200 and b'<html' in body.lower()
+    assert routes.database is None
+    assert call(routes, '/no-existe')[0] == 404
+
+
+def test_lifespan_disposes_the_async_engines(routes):
+    vehicle = make_vehicle()
+    call(routes, f'/vehicle/{vehicle.id}')
+    messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    sent = []
+
+    async def receive():
+        return next(messages)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    routes.loop.run_until_complete(routes({'type': 'lifespan'}, receive, send))
+
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+
+@pytest.mark.parametrize('config', ['replica'], indirect=True)
+def test_clients_that_just_wrote_read_from_the_primary(app, routes):
+    # The replica has the schema but none of the primary's rows
+    db.metadatas[None].create_all(db.engines[REPLICA_BIND])
+    vehicle = make_vehicle()
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'db_primary_until': time.time() + 10})
+    url = f'/vehicle/{vehicle.id}'
+
+    assert call(routes, url)[0] == 404
+    assert call(routes, url, headers=[(b'cookie', f'session={cookie}'.encode())])[0] == 200
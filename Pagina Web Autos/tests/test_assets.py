@@ -0,0 +1,93 @@
+import json
+import re
+import shutil
+import subprocess
+
+import pytest
+
+from assets import IMMUTABLE_MAX_AGE, asset_version, hash_assets
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def test_hash_assets_covers_static_files_but_not_uploads(tmp_path):
+    write(tmp_path / 'css' / 'style.css', 'body {}')
+    write(tmp_path / 'js' / 'main.js', '')
+    write(tmp_path / 'img' / 'photo.jpg', 'jpeg')
+    write(tmp_path / 'uploads' / 'logo.svg', '<svg/>')
+
+    hashes = hash_assets(str(tmp_path))
+
+    assert sorted(hashes) == ['css/style.css', 'js/main.js']
+    assert all(re.fullmatch('[0-9a-f]{12}', digest) for digest in hashes.values())
+
+
+def test_asset_version_changes_with_any_file(tmp_path):
+    write(tmp_path / 'css' / 'style.css', 'body {}')
+    before = asset_version(hash_assets(str(tmp_path)))
+    assert asset_version(hash_assets(str(tmp_path))) == before
+
+    write(tmp_path / 'css' / 'style.css', 'body { margin: 0 }')
+
+    assert asset_version(hash_assets(str(tmp_path))) != before
+
+
+def test_pages_link_static_files_with_their_hash(app, client):
+    digest = app.extensions['asset_hashes']['css/style.css']
+
+    page = client.get('/').get_data(as_text=True)
+
+    assert f'/static/css/style.css?v={digest}' in page
+    assert '/manifest.webmanifest' in page
+
+
+def test_current_hash_is_cached_for_a_year(app, client):
+    digest = app.extensions['asset_hashes']['css/style.css']
+
+    current = client.get(f'/static/css/style.css?v={digest}')
+    stale = client.get('/static/css/style.css?v=0')
+
+    assert current.cache_control.max_age == IMMUTABLE_MAX_AGE
+    assert stale.cache_control.max_age != IMMUTABLE_MAX_AGE
+
+
+def worker_constant(body, name):
+    return json.loads(re.search(rf'^const {name} = (.*);$', body, re.MULTILINE).group(1))
+
+
+def test_service_worker_precaches_the_fingerprinted_assets(app, client):
+    response = client.get('/sw.js')
+    body = response.get_data(as_text=True)
+
+    assert response.mimetype == 'application/javascript'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert worker_constant(body, 'VERSION') == app.extensions['asset_version']
+    precache = worker_constant(body, 'PRECACHE')
+    assert f"/static/js/main.js?v={app.extensions['asset_hashes']['js/main.js']}" in precache
+    assert not any('/uploads/' in url for url in precache)
+    assert '/admin' in worker_constant(body, 'NETWORK_ONLY')
+    assert worker_constant(body, 'OFFLINE_URL') == '/sin-conexion'
+    assert client.get('/sin-conexion').status_code == 200
+
+
+def test_service_worker_is_valid_javascript(client, tmp_path):
+    node = shutil.which('node')
+    if node is None:
+        pytest.skip('node is not installed')
+    script = tmp_path / 'sw.js'
+    script.write_bytes(client.get('/sw.js').data)
+
+    subprocess.run([node, '--check', str(script)], check=True, capture_output=True)
+
+
+def test_manifest(client):
+    response = client.get('/manifest.webmanifest')
+    manifest = response.get_json(force=True)
+
+    assert response.mimetype == 'application/manifest+json'
+    assert response.cache_control.max_age == 86400
+    assert (manifest['lang'], manifest['start_url'], manifest['display']) == ('es', '/', 'standalone')
+    assert manifest['icons'][0]['src'].startswith('/static/img/icon.svg?v=')
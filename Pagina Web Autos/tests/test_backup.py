@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+import backup
+from backup import (OBJECTS, backup_lock, backup_sqlite, create_backup, list_snapshots, prune_backups, restore_backup,
+                    verify_backup)
+from conftest import make_vehicle, write_upload
+from models import db, ANALYTICS_BIND, VehicleView
+
+
+def rows(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+    finally:
+        connection.close()
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    # Tracking rows in their own database, which is backed up next to the primary
+    config['SQLALCHEMY_BINDS'] = {ANALYTICS_BIND: {'url': f"sqlite:///{tmp_path / 'analytics.db'}"}}
+    return config
+
+
+@pytest.fixture
+def listings(app):
+    vehicles = [make_vehicle(title=f'Auto {n}') for n in range(3)]
+    db.session.add(VehicleView(vehicle_id=vehicles[0].id))
+    db.session.commit()
+    write_upload(app, 'a.jpg', b'first photo')
+    write_upload(app, 'b.jpg', b'second photo')
+    write_upload(app, 'copy.jpg', b'first photo')
+    return vehicles
+
+
+def test_backup_verify_restore_round_trip(app, listings, tmp_path):
+    runner = app.test_cli_runner()
+
+    backed_up = runner.invoke(args=['backup', '--keep', '0'])
+    verified = runner.invoke(args=['verify-backup'])
+    snapshot = list_snapshots(app.config['BACKUP_DIR'])[-1]
+    target = tmp_path / 'restored'
+    restored = runner.invoke(args=['restore-backup', snapshot, str(target)])
+
+    assert backed_up.exit_code == 0 and 'uploads: 3 files, 2 new' in backed_up.output
+    assert 'primary: primary.sqlite3' in backed_up.output and f'{ANALYTICS_BIND}: ' in backed_up.output
+    assert verified.exit_code == 0 and verified.output.endswith('OK\n')
+    assert restored.exit_code == 0 and 'Restored into' in restored.output
+    assert rows(target / 'primary.sqlite3', 'vehicle') == 3
+    assert rows(target / f'{ANALYTICS_BIND}.sqlite3', 'vehicle_view') == 1
+    assert (target / 'uploads' / 'copy.jpg').read_bytes() == b'first photo'
+    assert sorted(os.listdir(target / 'uploads')) == ['a.jpg', 'b.jpg', 'copy.jpg']
+
+
+def test_unchanged_uploads_are_not_copied_again(app, listings):
+    folder = app.config['BACKUP_DIR']
+    create_backup(folder, pause=0)
+    write_upload(app, 'c.jpg', b'third photo')
+
+    report = create_backup(folder, pause=0)['upload_report']
+
+    assert report == {'files': 4, 'hashed': 1, 'new_objects': 1, 'new_bytes': len(b'third photo')}
+
+
+def test_verify_reports_corrupt_files(app, listings):
+    folder = app.config['BACKUP_DIR']
+    manifest = create_backup(folder, pause=0)
+    with open(os.path.join(manifest['path'], 'primary.sqlite3'), 'ab') as f:
+        f.write(b'garbage')
+    os.remove(backup._object_path(folder, manifest['uploads']['b.jpg']['sha256']))
+
+    problems = verify_backup(manifest['path'])['problems']
+
+    assert problems == ['primary.sqlite3: checksum mismatch', 'upload b.jpg: missing or corrupt']
+    result = app.test_cli_runner().invoke(args=['verify-backup'])
+    assert result.exit_code == 1 and '2 problems found.' in result.output
+
+
+def test_restore_needs_an_empty_directory(app, listings, tmp_path):
+    manifest = create_backup(app.config['BACKUP_DIR'], pause=0)
+    (tmp_path / 'restored').mkdir()
+    (tmp_path / 'restored' / 'live.db').write_bytes(b'')
+
+    with pytest.raises(ValueError):
+        restore_backup(manifest['path'], str(tmp_path / 'restored'))
+
+
+def test_sqlite_copy_is_the_snapshot_at_its_start(app, listings, tmp_path, monkeypatch):
+    source = db.engines[None].url.database
+    for n in range(200):
+        make_vehicle(title=f'Relleno {n}', description='x' * 2000)
+    writer = sqlite3.connect(source, timeout=30)
+    written = []
+
+    def sleep(seconds):
+        # A write committed between two steps of the copy
+        if not written:
+            writer.execute("UPDATE vehicle SET title = 'Cambiado'")
+            writer.commit()
+            written.append(True)
+
+    monkeypatch.setattr(backup.time, 'sleep', sleep)
+    info = backup_sqlite(source, str(tmp_path / 'copy.sqlite3'), pages=1, pause=0.001)
+    writer.close()
+
+    copy = sqlite3.connect(tmp_path / 'copy.sqlite3')
+    assert written and info['steps'] > 1
+    assert copy.execute("SELECT count(*) FROM vehicle WHERE title = 'Cambiado'").fetchone()[0] == 0
+    assert info['tables']['vehicle'] == 203
+    copy.close()
+
+
+def test_prune_keeps_the_newest_snapshots_and_their_objects(app, listings):
+    folder = app.config['BACKUP_DIR']
+    create_backup(folder, pause=0)
+    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], 'b.jpg'))
+    newest = create_backup(folder, pause=0)
+
+    report = prune_backups(folder, keep=1)
+
+    assert report == {'snapshots_removed': 1, 'objects_removed': 1}
+    assert list_snapshots(folder) == [os.path.basename(newest['path'])]
+    assert verify_backup(newest['path'])['problems'] == []
+    assert sum(len(files) for _, _, files in os.walk(os.path.join(folder, OBJECTS))) == 1
+
+
+def test_prune_waits_for_a_backup_in_progress(app, listings):
+    folder = app.config['BACKUP_DIR']
+    create_backup(folder, pause=0)
+    pruned = threading.Event()
+
+    with backup_lock(folder):
+        with backup_lock(folder, blocking=False) as locked:
+            assert not locked
+        thread = threading.Thread(target=lambda: (prune_backups(folder, keep=0), pruned.set()))
+        thread.start()
+        assert not pruned.wait(0.2)
+    thread.join(5)
+
+    assert pruned.is_set()
@@ -0,0 +1,55 @@
+import pytest
+from flask import session
+from sqlalchemy.exc import DBAPIError
+
+import db_routing
+import routes
+from conftest import make_vehicle
+from db_routing import REPLICA_BIND
+from models import db, VehicleView
+
+
+@pytest.fixture(params=['primary', 'replica'])
+def config(request, config, tmp_path):
+    if request.param == 'replica':
+        config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: f"sqlite:///{tmp_path / 'replica.db'}"}
+    db_routing._replica_down_until.clear()
+    yield config
+    db_routing._replica_down_until.clear()
+
+
+@pytest.fixture
+def replica(app):
+    if REPLICA_BIND not in db.engines:
+        pytest.skip('needs a replica')
+    db.metadatas[None].create_all(db.engines[REPLICA_BIND])
+    return db.engines[REPLICA_BIND]
+
+
+def test_writes_pin_the_client_to_the_primary_only_with_a_replica(app):
+    with app.test_request_context():
+        make_vehicle()
+
+        assert ('db_primary_until' in session) == (REPLICA_BIND in db.engines)
+
+
+def test_replica_failure_reruns_the_view_without_recording_twice(client, replica, monkeypatch):
+    vehicle = make_vehicle()
+    with replica.begin() as connection:
+        connection.execute(vehicle.__table__.insert(), {
+            column.name: getattr(vehicle, column.name) for column in vehicle.__table__.columns})
+    similar_vehicles = routes.similar_vehicles
+    calls = []
+
+    def replica_goes_down(vehicle):
+        calls.append(vehicle.id)
+        if len(calls) == 1:
+            db_routing._mark_replica_down(replica)
+            raise DBAPIError('SELECT', {}, ConnectionError('replica gone'))
+        return similar_vehicles(vehicle)
+
+    monkeypatch.setattr(routes, 'similar_vehicles', replica_goes_down)
+
+    assert client.get(f'/vehicle/{vehicle.id}').status_code == 200
+    assert len(calls) == 2
+    assert VehicleView.query.filter_by(vehicle_id=vehicle.id).count() == 1
@@ -0,0 +1,104 @@
+import io
+
+import numpy as np
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from conftest import make_request, make_vehicle
+from duplicates import MAX_IMAGE_DISTANCE, find_duplicates, image_hash, minhash_signature
+from models import db, ImageFingerprint
+from routes import save_uploaded_images
+from storage import get_storage
+
+DESCRIPTION = "Toyota Corolla 2018 unico dueño, service oficial al dia, cubiertas nuevas, impecable"
+
+
+def photo(size, fmt='JPEG'):
+    Image = pytest.importorskip('PIL.Image')
+    x, y = np.meshgrid(np.linspace(0, 255, size[0]), np.linspace(0, 255, size[1]))
+    pixels = np.stack([x, y, (x + y) / 2], axis=-1).astype(np.uint8)
+    pixels[size[1] // 3:size[1] // 2, size[0] // 4:size[0] // 2] = 30
+    stream = io.BytesIO()
+    Image.fromarray(pixels).save(stream, fmt)
+    stream.seek(0)
+    return stream
+
+
+def test_minhash_estimates_text_similarity():
+    same = minhash_signature(DESCRIPTION)
+    reworded = minhash_signature(DESCRIPTION.upper() + "!!")
+    different = minhash_signature("Ford Ranger 4x4 diesel, doble cabina, ideal campo")
+
+    assert np.mean(same == reworded) == 1.0
+    assert np.mean(same == different) < 0.2
+    assert minhash_signature("  ") is None
+
+
+def test_image_hash_survives_resizing_and_reencoding():
+    original = image_hash(photo((1200, 900)))
+    resized = image_hash(photo((600, 450), fmt='PNG'))
+
+    assert original is not None
+    assert (int(original, 16) ^ int(resized, 16)).bit_count() <= MAX_IMAGE_DISTANCE
+
+
+def test_request_with_similar_text_is_flagged(app):
+    vehicle = make_vehicle(title='Toyota Corolla 2018', description=DESCRIPTION)
+    make_vehicle(title='Ford Ranger', description='Doble cabina 4x4, ideal campo')
+    copy = make_request(title='Toyota Corolla 2018', description=DESCRIPTION + ' Escucho ofertas')
+    unrelated = make_request(title='Fiat Uno', description='Motor fire, pocos kilometros')
+
+    found = find_duplicates([copy, unrelated])
+
+    assert list(found) == [copy.id]
+    assert found[copy.id][0]['kind'] == 'vehicle'
+    assert found[copy.id][0]['id'] == vehicle.id
+    assert found[copy.id][0]['similar_text']
+
+
+def test_request_reusing_a_photo_is_flagged(app):
+    db.session.add_all([ImageFingerprint(path='uploads/car.jpg', phash='f0f0f0f0f0f0f0f0'),
+                        ImageFingerprint(path='uploads/client_car.jpg', phash='f0f0f0f0f0f0f0f1')])
+    db.session.commit()
+    vehicle = make_vehicle(title='Peugeot 208', description='Versión full', images='["uploads/car.jpg"]')
+    copy = make_request(title='Vendo auto', description='Consultar', images=['uploads/client_car.jpg'])
+
+    match, = find_duplicates([copy])[copy.id]
+
+    assert (match['id'], match['shared_images'], match['similar_text']) == (vehicle.id, 1, False)
+
+
+def test_processed_requests_leave_the_index(app):
+    make_vehicle(title='Toyota Corolla 2018', description=DESCRIPTION)
+    copy = make_request(title='Toyota Corolla 2018', description=DESCRIPTION)
+    assert find_duplicates([copy])
+
+    copy.status = 'rejected'
+    db.session.commit()
+
+    assert find_duplicates([copy]) == {}
+
+
+def upload(name='auto.jpg', size=(800, 600)):
+    return FileStorage(photo(size), filename=name, content_type='image/jpeg')
+
+
+def test_stored_uploads_are_fingerprinted(app):
+    with app.test_request_context():
+        paths, rejected = save_uploaded_images([upload(), upload('enorme.jpg', size=(4000, 3000))])
+        db.session.commit()
+
+    assert rejected == ['enorme.jpg']
+    assert [row.path for row in ImageFingerprint.query] == paths
+
+
+def test_failed_store_leaves_no_fingerprint(app, monkeypatch):
+    def fail(stream, name, content_type=None):
+        raise OSError('disk full')
+    monkeypatch.setattr(get_storage(), 'save', fail)
+
+    with app.test_request_context(), pytest.raises(OSError):
+        save_uploaded_images([upload()])
+    db.session.commit()
+
+    assert ImageFingerprint.query.count() == 0
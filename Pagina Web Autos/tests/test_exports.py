@@ -0,0 +1,92 @@
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+import exports
+from conftest import make_request, make_vehicle
+from exports import DATASETS, export_statement, parse_dates, stream_export
+from models import db, Click
+
+
+def export(dataset, fmt, compress=False, **filters):
+    data = b''.join(stream_export(DATASETS[dataset], fmt, export_statement(DATASETS[dataset], **filters), compress))
+    return gzip.decompress(data) if compress else data
+
+
+@pytest.fixture
+def vehicles(app):
+    vehicles = [make_vehicle(title=f'Auto "{n}", ñandú', price=n * 1_000_000) for n in range(1, 6)]
+    vehicles[0].created_at = datetime(2024, 1, 10, 12)
+    db.session.commit()
+    return vehicles
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_csv_round_trip(vehicles, monkeypatch, compress):
+    # Small chunks so the export is flushed (and compressed) in several pieces
+    monkeypatch.setattr(exports, 'CHUNK_SIZE', 2)
+    monkeypatch.setattr(exports, 'FLUSH_BYTES', 100)
+
+    rows = list(csv.DictReader(io.StringIO(export('vehiculos', 'csv', compress).decode())))
+
+    assert [row['title'] for row in rows] == [vehicle.title for vehicle in vehicles]
+    assert rows[0]['price'] == '1000000' and rows[0]['created_at'] == '2024-01-10T12:00:00'
+    assert set(rows[0]) == {column.name for column in DATASETS['vehiculos'].columns}
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_jsonl_round_trip(vehicles, monkeypatch, compress):
+    monkeypatch.setattr(exports, 'FLUSH_BYTES', 100)
+
+    lines = export('vehiculos', 'jsonl', compress).decode().splitlines()
+
+    rows = [json.loads(line) for line in lines]
+    assert [row['id'] for row in rows] == [vehicle.id for vehicle in vehicles]
+    assert rows[-1]['title'] == 'Auto "5", ñandú' and rows[-1]['price'] == 5_000_000
+
+
+def test_empty_export_is_still_a_valid_file(app):
+    assert export('clics', 'csv', compress=True).decode().strip().split(',')[:2] == ['id', 'vehicle_id']
+    assert export('clics', 'jsonl', compress=True) == b''
+
+
+def test_filters_by_date_and_vehicle(vehicles):
+    first, second = vehicles[:2]
+    published = make_vehicle(client_request_id=make_request(title='Publicada').id)
+    make_request(title='Pendiente')
+    db.session.add_all([Click(vehicle_id=first.id, click_type='whatsapp'),
+                        Click(vehicle_id=second.id, click_type='offer')])
+    db.session.commit()
+    start, end = parse_dates('2024-01-10', '2024-01-10')
+
+    by_date = export('vehiculos', 'jsonl', start=start, end=end)
+    clicks = export('clics', 'jsonl', vehicle_ids=[second.id])
+    requests = export('solicitudes', 'jsonl', vehicle_ids=[published.id])
+
+    assert [json.loads(line)['id'] for line in by_date.splitlines()] == [first.id]
+    assert [json.loads(line)['click_type'] for line in clicks.splitlines()] == ['offer']
+    assert [json.loads(line)['title'] for line in requests.splitlines()] == ['Publicada']
+
+
+def test_parse_dates():
+    assert parse_dates(None, None) == (None, None)
+    assert parse_dates('2024-01-10', '2024-01-10') == (datetime(2024, 1, 10), datetime(2024, 1, 11))
+    with pytest.raises(ValueError):
+        parse_dates('2024-01-11', '2024-01-10')
+
+
+def test_export_route_streams_a_gzip_attachment(admin_client, vehicles):
+    response = admin_client.get('/admin/exportar/vehiculos.jsonl?gzip=1')
+
+    assert response.mimetype == 'application/gzip'
+    assert response.headers['Content-Disposition'].endswith('.jsonl.gz"')
+    assert len(gzip.decompress(response.data).splitlines()) == len(vehicles)
+    assert admin_client.get('/admin/exportar/vehiculos.csv?desde=ayer').status_code == 400
+
+
+def test_export_route_requires_an_admin(client):
+    assert client.get('/admin/exportar/vehiculos.csv').status_code == 302
@@ -0,0 +1,111 @@
+import json
+import logging
+from xml.etree import ElementTree
+
+import pytest
+
+from conftest import make_vehicle
+from feeds import SITEMAP
+from models import db
+
+NAMESPACE = {'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config['FEED_CACHE_DIR'] = str(tmp_path / 'feeds')
+    return config
+
+
+@pytest.fixture
+def sitemap_limits(monkeypatch):
+    def limit(max_urls=SITEMAP.max_urls, max_bytes=SITEMAP.max_bytes):
+        monkeypatch.setattr(SITEMAP, 'max_urls', max_urls)
+        monkeypatch.setattr(SITEMAP, 'max_bytes', max_bytes)
+    return limit
+
+
+def locations(response, tag='url'):
+    root = ElementTree.fromstring(response.get_data())
+    return [loc.text for loc in root.findall(f'sm:{tag}/sm:loc', NAMESPACE)]
+
+
+def test_feed_answers_304_until_the_catalog_changes(client):
+    vehicle = make_vehicle(title='Ford Ka')
+
+    first = client.get('/feed/catalogo.json')
+    etag = first.headers['ETag']
+    assert [item['title'] for item in json.loads(first.get_data())['vehicles']] == ['Ford Ka']
+    assert client.get('/feed/catalogo.json', headers={'If-None-Match': etag}).status_code == 304
+
+    vehicle.title = 'Ford Ka Freestyle'
+    db.session.commit()
+    changed = client.get('/feed/catalogo.json', headers={'If-None-Match': etag})
+
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert [item['title'] for item in json.loads(changed.get_data())['vehicles']] == ['Ford Ka Freestyle']
+
+
+def test_xml_catalog_drops_deactivated_vehicles(client):
+    kept = make_vehicle(title='Peugeot 208')
+    paused = make_vehicle(title='Fiat Cronos')
+    client.get('/feed/catalogo.xml')
+
+    paused.is_active = False
+    db.session.commit()
+    root = ElementTree.fromstring(client.get('/feed/catalogo.xml').get_data())
+
+    assert [item.findtext('id') for item in root.findall('vehicle')] == [str(kept.id)]
+
+
+def test_small_sitemap_is_a_single_urlset(client):
+    vehicle = make_vehicle()
+
+    urls = locations(client.get('/sitemap.xml'))
+
+    assert len(urls) == 4
+    assert urls[-1] == f'http://localhost/vehicle/{vehicle.id}'
+    assert client.get('/sitemap-1.xml').get_data() == client.get('/sitemap.xml').get_data()
+    assert client.get('/sitemap-2.xml').status_code == 404
+
+
+def test_sitemap_over_the_url_limit_becomes_an_index(client, sitemap_limits):
+    vehicles = [make_vehicle() for _ in range(5)]
+    sitemap_limits(max_urls=4)
+
+    index = client.get('/sitemap.xml')
+
+    assert locations(index, 'sitemap') == ['http://localhost/sitemap-1.xml', 'http://localhost/sitemap-2.xml']
+    first, second = locations(client.get('/sitemap-1.xml')), locations(client.get('/sitemap-2.xml'))
+    assert len(first) == 4 and first[-1] == f'http://localhost/vehicle/{vehicles[0].id}'
+    assert second == [f'http://localhost/vehicle/{vehicle.id}' for vehicle in vehicles[1:]]
+    assert client.get('/sitemap-3.xml').status_code == 404
+
+
+def test_sitemap_pages_stay_under_the_size_limit(client, sitemap_limits):
+    for _ in range(6):
+        make_vehicle()
+    single = client.get('/sitemap.xml').get_data()
+    sitemap_limits(max_bytes=len(single) // 2)
+
+    pages = locations(client.get('/sitemap.xml'), 'sitemap')
+    bodies = [client.get(url).get_data() for url in pages]
+
+    assert len(pages) >= 2
+    assert all(len(body) <= len(single) // 2 for body in bodies)
+    assert sum(len(locations(client.get(url))) for url in pages) == 9
+
+
+def test_each_host_keeps_its_own_incremental_cache(client, caplog):
+    make_vehicle(title='Ford Ka')
+    hosts = ['autos.example', 'www.autos.example']
+    for host in hosts:
+        client.get('/feed/catalogo.json', base_url=f'https://{host}')
+    make_vehicle(title='Fiat Cronos')
+    caplog.set_level(logging.INFO, logger='feeds')
+
+    feeds = [json.loads(client.get('/feed/catalogo.json', base_url=f'https://{host}').get_data()) for host in hosts]
+
+    assert [[item['url'] for item in feed['vehicles']][0].split('/')[2] for feed in feeds] == hosts
+    assert [record.incremental for record in caplog.records if record.msg == 'Feed regenerated'] == [True, True]
@@ -0,0 +1,116 @@
+from datetime import date, datetime
+
+import pytest
+
+import funnel
+from conftest import make_vehicle
+from funnel import conversion_rates, funnel_report, parse_range
+from models import db, Click, VehicleView
+
+START, END = date(2024, 3, 1), date(2024, 3, 3)
+
+
+def add_events(vehicle, day, views=0, **clicks):
+    timestamp = datetime.combine(day, datetime.min.time())
+    db.session.add_all(VehicleView(vehicle_id=vehicle.id, timestamp=timestamp) for _ in range(views))
+    for click_type, count in clicks.items():
+        db.session.add_all(Click(vehicle_id=vehicle.id, click_type=click_type, timestamp=timestamp)
+                           for _ in range(count))
+    db.session.commit()
+
+
+@pytest.fixture
+def config(config):
+    config['FUNNEL_REFRESH_SECONDS'] = 0
+    return config
+
+
+@pytest.fixture
+def vehicles(app):
+    toyota, ford = make_vehicle(), make_vehicle(title='Ford Ka', brand='Ford')
+    add_events(toyota, START, views=4, whatsapp=2, offer=1)
+    add_events(toyota, date(2024, 3, 3), views=2, call=1)
+    add_events(ford, START, views=3, whatsapp=1, unknown=5)
+    # Outside the range
+    add_events(ford, date(2024, 2, 29), views=10, whatsapp=10)
+    return toyota, ford
+
+
+def test_report_counts_each_step_per_day_and_vehicle(vehicles):
+    toyota, ford = vehicles
+
+    report = funnel_report(START, END)
+
+    assert report['days'] == ['2024-03-01', '2024-03-02', '2024-03-03']
+    assert report['daily'] == [[7, 3, 0, 1], [0, 0, 0, 0], [2, 0, 1, 0]]
+    assert report['totals'] == {'views': 9, 'whatsapp': 3, 'call': 1, 'offer': 1}
+    assert report['vehicles'] == {toyota.id: {'views': 6, 'whatsapp': 2, 'call': 1, 'offer': 1},
+                                  ford.id: {'views': 3, 'whatsapp': 1, 'call': 0, 'offer': 0}}
+
+
+def test_report_filters_by_vehicle(vehicles):
+    toyota, ford = vehicles
+
+    report = funnel_report(START, END, [ford.id])
+
+    assert report['totals'] == {'views': 3, 'whatsapp': 1, 'call': 0, 'offer': 0}
+    assert list(report['vehicles']) == [ford.id]
+
+
+def test_new_events_are_appended_and_clear_the_cache(vehicles, monkeypatch):
+    toyota, _ = vehicles
+    assert funnel_report(START, END)['totals']['views'] == 9
+    monkeypatch.setattr(funnel, 'CHUNK_SIZE', 1)
+
+    add_events(toyota, END, views=1, offer=2)
+
+    assert funnel_report(START, END)['totals'] == {'views': 10, 'whatsapp': 3, 'call': 1, 'offer': 3}
+
+
+def test_rows_committed_under_a_loaded_id_are_counted(vehicles):
+    toyota, _ = vehicles
+    timestamp = datetime.combine(START, datetime.min.time())
+    db.session.add(VehicleView(id=1000, vehicle_id=toyota.id, timestamp=timestamp))
+    db.session.commit()
+    assert funnel_report(START, END)['totals']['views'] == 10
+
+    # A transaction that took id 500 before id 1000 but committed after it
+    db.session.add(VehicleView(id=500, vehicle_id=toyota.id, timestamp=timestamp))
+    db.session.commit()
+
+    assert funnel_report(START, END)['totals']['views'] == 11
+    assert funnel_report(START, END)['totals']['views'] == 11
+
+
+def test_cached_report_until_the_refresh_interval(app, vehicles):
+    app.extensions['funnel_store'].refresh_seconds = 3600
+    first = funnel_report(START, END)
+
+    add_events(vehicles[0], START, views=5)
+
+    assert funnel_report(START, END) is first
+
+
+def test_conversion_rates_and_range_parsing():
+    assert conversion_rates({'views': 8, 'whatsapp': 2, 'call': 1, 'offer': 0}) == {
+        'whatsapp': 25.0, 'call': 12.5, 'offer': 0.0}
+    assert conversion_rates({'views': 0}) == {'whatsapp': 0.0, 'call': 0.0, 'offer': 0.0}
+    assert parse_range('2024-03-01', '2024-03-03') == (START, END)
+    start, end = parse_range(None, '2024-03-30')
+    assert (start, end) == (date(2024, 3, 1), date(2024, 3, 30))
+    for bad in (('2024-03-03', '2024-03-01'), ('2020-01-01', '2024-01-01'), ('ayer', None)):
+        with pytest.raises(ValueError):
+            parse_range(*bad)
+
+
+def test_api_reports_by_brand_and_rejects_bad_ranges(admin_client, vehicles):
+    response = admin_client.get('/admin/api/reportes/embudo?desde=2024-03-01&hasta=2024-03-03&marca=ford')
+
+    body = response.get_json()
+    assert body['totals']['views'] == 3 and body['conversion']['whatsapp'] == 33.3
+    assert admin_client.get('/admin/api/reportes/embudo?desde=2024-03-03&hasta=2024-03-01').status_code == 400
+    assert admin_client.get('/admin/reportes/embudo?desde=2024-03-01&hasta=2024-03-03').status_code == 200
+
+
+def test_report_requires_an_admin(client):
+    assert client.get('/admin/api/reportes/embudo').status_code == 401
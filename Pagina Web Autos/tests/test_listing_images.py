@@ -0,0 +1,122 @@
+import json
+import os
+
+import pytest
+from sqlalchemy import update
+
+import listing_images
+from conftest import make_request, make_vehicle, write_upload
+from listing_images import (ImageListConflict, add_images, remove_image, reorder_images, set_main_image,
+                            update_images)
+from models import db, Vehicle
+
+PATHS = ['uploads/a.jpg', 'uploads/b.jpg', 'uploads/c.jpg']
+
+
+def test_remove_image_keeps_the_main_image():
+    assert remove_image(list(PATHS), 2, 'uploads/a.jpg') == (PATHS[1:], 1)
+    assert remove_image(list(PATHS), 1, 'uploads/b.jpg') == (['uploads/a.jpg', 'uploads/c.jpg'], 0)
+    with pytest.raises(ValueError):
+        remove_image(list(PATHS), 0, 'uploads/other.jpg')
+
+
+def test_reorder_images_follows_the_main_image():
+    order = ['uploads/c.jpg', 'uploads/a.jpg', 'uploads/b.jpg']
+
+    assert reorder_images(list(PATHS), 0, order) == (order, 1)
+    assert reorder_images(list(PATHS), None, order) == (order, None)
+    with pytest.raises(ValueError):
+        reorder_images(list(PATHS), 0, order[:2])
+
+
+def test_set_main_image_moves_request_images_to_the_front():
+    assert set_main_image(list(PATHS), 0, 'uploads/c.jpg') == (PATHS, 2)
+    assert set_main_image(list(PATHS), None, 'uploads/c.jpg') == (['uploads/c.jpg'] + PATHS[:2], None)
+
+
+def concurrent_edit(item, images):
+    """Commit ``images`` to the row from another connection, as a second tab would"""
+    with db.engine.begin() as connection:
+        connection.execute(update(type(item)).where(type(item).id == item.id).values(images=json.dumps(images)))
+
+
+def test_update_images_reapplies_the_change_after_a_concurrent_edit(app):
+    vehicle = make_vehicle(images=json.dumps(PATHS[:1]))
+    calls = []
+
+    def change(paths, main_index):
+        if not calls:
+            concurrent_edit(vehicle, PATHS[:2])
+        calls.append(list(paths))
+        return add_images(paths, main_index, ['uploads/new.jpg'])
+
+    old, new = update_images(vehicle, change)
+
+    assert calls == [PATHS[:1], PATHS[:2]]
+    assert (old, new) == (PATHS[:2], PATHS[:2] + ['uploads/new.jpg'])
+    assert json.loads(vehicle.images) == new
+
+
+def test_update_images_gives_up_when_the_list_keeps_changing(app):
+    vehicle = make_vehicle(images='[]')
+    edits = iter([PATHS[:1], PATHS[:2], PATHS])
+
+    def change(paths, main_index):
+        concurrent_edit(vehicle, next(edits))
+        return add_images(paths, main_index, ['uploads/new.jpg'])
+
+    with pytest.raises(ImageListConflict):
+        update_images(vehicle, change)
+    db.session.expire_all()
+    assert json.loads(vehicle.images) == PATHS
+
+
+def test_api_lists_and_deletes_images(admin_client, app):
+    vehicle = make_vehicle(images=json.dumps(PATHS), main_image_index=1)
+    make_request(images=['uploads/c.jpg'])
+    for name in ('a.jpg', 'c.jpg'):
+        write_upload(app, name)
+    url = f'/admin/api/vehiculo/{vehicle.id}/imagenes'
+
+    listed = admin_client.get(url).get_json()
+    assert [image['path'] for image in listed['images']] == PATHS and listed['main_index'] == 1
+
+    assert admin_client.delete(url, json={'path': 'uploads/a.jpg'}).get_json()['main_index'] == 0
+    admin_client.delete(url, json={'path': 'uploads/c.jpg'})
+    assert admin_client.delete(url, json={'path': 'uploads/a.jpg'}).status_code == 400
+
+    # a.jpg is gone; c.jpg is kept because the request still lists it
+    assert sorted(os.listdir(app.config['UPLOAD_FOLDER'])) == ['c.jpg']
+
+
+def test_api_reorders_and_sets_the_main_image_of_a_request(admin_client):
+    client_request = make_request(images=PATHS)
+    url = f'/admin/api/solicitud/{client_request.id}/imagenes'
+
+    reordered = admin_client.put(f'{url}/orden', json={'order': PATHS[::-1]}).get_json()
+    main = admin_client.put(f'{url}/principal', json={'path': 'uploads/b.jpg'}).get_json()
+
+    assert [image['path'] for image in reordered['images']] == PATHS[::-1]
+    assert [image['path'] for image in main['images']] == ['uploads/b.jpg', 'uploads/c.jpg', 'uploads/a.jpg']
+    assert admin_client.put(f'{url}/orden', json={'order': 'a'}).status_code == 400
+
+
+def test_upload_conflict_answers_409_and_removes_the_new_files(admin_client, app, monkeypatch):
+    pytest.importorskip('PIL')
+    from test_duplicates import photo
+
+    vehicle = make_vehicle(images='[]')
+    monkeypatch.setattr(listing_images, 'MAX_ATTEMPTS', 0)
+
+    response = admin_client.post(f'/admin/api/vehiculo/{vehicle.id}/imagenes', data={
+        'vehicle_images': (photo((800, 600)), 'auto.jpg')}, content_type='multipart/form-data')
+
+    assert response.status_code == 409
+    assert os.listdir(app.config['UPLOAD_FOLDER']) == []
+
+
+def test_image_api_requires_an_admin(client):
+    vehicle = make_vehicle()
+
+    assert client.get(f'/admin/api/vehiculo/{vehicle.id}/imagenes').status_code == 401
+    assert db.session.get(Vehicle, vehicle.id).images == '[]'
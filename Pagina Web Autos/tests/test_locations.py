@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import make_request, make_vehicle
+from locations import LOCALITIES, backfill_vehicle_locations, canonical_locality, haversine_km, location_filter
+from models import db, Vehicle
+
+
+def matching_titles(location, radius_km=None):
+    query = Vehicle.query.filter(location_filter(location, radius_km)).order_by(Vehicle.id)
+    return [vehicle.title for vehicle in query]
+
+
+@pytest.fixture
+def listings(app):
+    make_vehicle(title='En Tunuyán', location='Tunuyán')
+    make_vehicle(title='En Tupungato', location='Tupungato')
+    make_vehicle(title='Texto libre', location='Tunuyán centro')
+    make_vehicle(title='Auto en Tunuyán sin ubicación', location=None)
+    make_vehicle(title='En Mendoza', location='Mendoza')
+
+
+def test_distances_between_localities():
+    assert haversine_km(LOCALITIES['Tunuyán'], LOCALITIES['Tunuyán']) == 0
+    assert 20 < haversine_km(LOCALITIES['Tunuyán'], LOCALITIES['Tupungato']) < 30
+
+
+def test_location_without_radius_keeps_unmatched_listings(listings):
+    assert matching_titles('Tunuyán') == ['En Tunuyán', 'Texto libre', 'Auto en Tunuyán sin ubicación']
+
+
+def test_radius_only_matches_known_localities(listings):
+    assert matching_titles('Tunuyán', radius_km=30) == ['En Tunuyán', 'En Tupungato']
+
+
+def test_index_filters_by_location(client, listings):
+    assert client.get('/?location=Tunuyán').status_code == 200
+    assert client.get('/?location=Tunuyán&radius_km=50').status_code == 200
+
+
+def test_canonical_locality_ignores_case_accents_and_spacing():
+    assert canonical_locality('  tunuyan ') == 'Tunuyán'
+    assert canonical_locality('SAN  CARLOS') == 'San Carlos'
+    assert canonical_locality('Mendoza') is None
+
+
+def test_backfill_copies_normalizes_and_reports_unmatched(app, caplog):
+    client_request = make_request(location='Tupungato')
+    from_request = make_vehicle(location=None, client_request_id=client_request.id)
+    misspelled = make_vehicle(location='tunuyan')
+    make_vehicle(location='Mendoza')
+    make_vehicle(location='Mendoza')
+
+    report = backfill_vehicle_locations()
+
+    assert report == {'copied': 1, 'normalized': 1, 'unmatched': 2}
+    db.session.expire_all()
+    assert (from_request.location, misspelled.location) == ('Tupungato', 'Tunuyán')
+    assert "Vehicle locations outside the known localities" in caplog.text
+    assert caplog.records[-1].unmatched == {'Mendoza': 2}
@@ -0,0 +1,68 @@
+import logging
+
+import pytest
+from flask import Flask
+
+from logging_config import configure_logging
+
+
+@pytest.fixture
+def root_level(monkeypatch):
+    """Restore the root and library levels configure_logging() changes"""
+    for name in ('APP_ENV', 'LOG_LEVEL'):
+        monkeypatch.delenv(name, raising=False)
+    loggers = [logging.getLogger(name) for name in ('', 'sqlalchemy.engine', 'sqlalchemy.pool', 'werkzeug')]
+    levels = [logger.level for logger in loggers]
+    yield lambda: logging.getLogger().level
+    for logger, level in zip(loggers, levels):
+        logger.setLevel(level)
+
+
+def configured(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    configure_logging(app)
+
+
+@pytest.mark.parametrize('environment, level', [
+    (None, logging.INFO),
+    ('production', logging.INFO),
+    ('staging', logging.INFO),
+    ('development', logging.DEBUG),
+    ('testing', logging.WARNING),
+])
+def test_level_follows_the_environment(root_level, monkeypatch, environment, level):
+    if environment:
+        monkeypatch.setenv('APP_ENV', environment)
+
+    configured()
+
+    assert root_level() == level
+
+
+def test_log_level_overrides_the_environment(root_level, monkeypatch):
+    monkeypatch.setenv('APP_ENV', 'development')
+
+    configured(LOG_LEVEL='error')
+
+    assert root_level() == logging.ERROR
+    assert logging.getLogger('werkzeug').level == logging.ERROR
+
+
+def test_unknown_log_level_falls_back_with_a_warning(root_level, caplog):
+    configured(APP_ENV='production', LOG_LEVEL='verbose')
+
+    assert root_level() == logging.INFO
+    assert "Unknown LOG_LEVEL 'verbose'" in caplog.text
+
+
+def test_handlers_added_by_others_are_kept(root_level):
+    handler = logging.NullHandler()
+    logging.getLogger().addHandler(handler)
+    try:
+        configured()
+        configured()
+
+        assert handler in logging.getLogger().handlers
+    finally:
+        logging.getLogger().removeHandler(handler)
@@ -0,0 +1,67 @@
+import math
+
+from conftest import make_vehicle
+from models import db, Vehicle
+from price_estimate import suggest_price
+
+
+def catalog():
+    """Corollas losing 8% a year and 0.5% per 10,000 km, plus a few Fords"""
+    for year in range(2010, 2024):
+        for kilometers in (30_000, 90_000, 150_000):
+            price = 30_000_000 * math.exp(-0.08 * (2023 - year) - 0.005 * kilometers / 10_000)
+            make_vehicle(year=year, kilometers=kilometers, price=int(price))
+    for year in (2012, 2016, 2020):
+        make_vehicle(brand='Ford', model='Ka', year=year, price=8_000_000 + (year - 2012) * 500_000)
+
+
+def test_estimate_follows_the_model_curve(app):
+    catalog()
+    app.extensions['price_estimator'].build()
+
+    estimate = suggest_price('Toyota', 'Corolla', 2018, kilometers=60_000)
+
+    expected = 30_000_000 * math.exp(-0.08 * 5 - 0.005 * 6)
+    assert estimate['group'] == 'model'
+    assert abs(estimate['price'] - expected) / expected < 0.1
+    assert estimate['low'] < estimate['price'] < estimate['high']
+
+
+def test_unknown_model_falls_back_to_brand_and_catalog(app):
+    catalog()
+    app.extensions['price_estimator'].build()
+
+    assert suggest_price('Toyota', 'Etios', 2018)['group'] == 'brand'
+    assert suggest_price('Renault', 'Clio', 2018)['group'] == 'global'
+
+
+def test_estimates_are_converted_to_the_requested_currency(app):
+    catalog()
+    app.extensions['price_estimator'].build()
+
+    in_ars = suggest_price('Toyota', 'Corolla', 2018, kilometers=60_000)
+    in_usd = suggest_price('Toyota', 'Corolla', 2018, kilometers=60_000, currency='USD')
+
+    # The seeded rate is 1000 ARS per USD
+    assert in_usd['currency'] == 'USD'
+    assert abs(in_usd['price'] * 1000 - in_ars['price']) / in_ars['price'] < 0.01
+
+
+def test_new_listings_update_the_estimate_incrementally(app):
+    assert suggest_price('Fiat', 'Cronos', 2020) is None
+    for year in (2019, 2020, 2021):
+        make_vehicle(brand='Fiat', model='Cronos', year=year, price=15_000_000)
+
+    assert suggest_price('Fiat', 'Cronos', 2020)['sample_size'] == 3
+
+    for vehicle in Vehicle.query.filter_by(model='Cronos'):
+        vehicle.is_active = False
+    db.session.commit()
+
+    assert suggest_price('Fiat', 'Cronos', 2020) is None
+
+
+def test_price_api_validates_its_arguments(client):
+    assert client.get('/api/precio-sugerido?anio=1800').status_code == 400
+    response = client.get('/api/precio-sugerido?anio=2018&marca=Toyota&moneda=ARS')
+    assert response.get_json() == {'success': True, 'estimate': None}
@@ -0,0 +1,82 @@
+from sqlalchemy import update
+
+from conftest import make_vehicle
+from models import db, ExchangeRate, Vehicle
+from pricing import backfill_normalized_prices, normalized_price, set_exchange_rate
+from routes import SORT_ORDERS
+
+
+def usd_rate():
+    return ExchangeRate.query.filter_by(currency='USD').one().rate_to_ars
+
+
+def test_normalized_price():
+    assert normalized_price(20_000_000, 'ARS', None) == 20_000_000
+    assert normalized_price(15_000, 'USD', 1_000.4) == 15_006_000
+    assert normalized_price(15_000, 'USD', None) is None
+    assert normalized_price(None, 'USD', 1_000) is None
+
+
+def test_new_and_repriced_vehicles_are_normalized(app):
+    vehicle = make_vehicle(price=15_000, currency='USD')
+    assert vehicle.price_ars_normalized == 15_000 * usd_rate()
+
+    vehicle.price = 12_000
+    db.session.commit()
+    assert vehicle.price_ars_normalized == 12_000 * usd_rate()
+
+    vehicle.currency = 'ARS'
+    db.session.commit()
+    assert vehicle.price_ars_normalized == 12_000
+
+
+def test_new_rate_renormalizes_only_that_currency(app):
+    dollars = make_vehicle(price=10_000, currency='USD')
+    pesos = make_vehicle(price=9_000_000, currency='ARS')
+
+    updated = set_exchange_rate('USD', 1_250.5)
+
+    db.session.expire_all()
+    assert updated == 1
+    assert usd_rate() == 1_250.5
+    assert dollars.price_ars_normalized == 12_505_000
+    assert pesos.price_ars_normalized == 9_000_000
+
+
+def test_new_rate_rebuilds_the_price_based_indexes(app):
+    set_exchange_rate('USD', 1_300)
+
+    assert app.extensions['similar_vehicles']._stale
+    assert app.extensions['price_estimator']._stale
+    assert not app.extensions['duplicate_index']._stale
+
+
+def test_backfill_fills_missing_normalized_prices(app):
+    dollars = make_vehicle(price=10_000, currency='USD')
+    pesos = make_vehicle(price=9_000_000, currency='ARS')
+    db.session.execute(update(Vehicle).values(price_ars_normalized=None))
+    db.session.commit()
+
+    assert backfill_normalized_prices() == 2
+
+    db.session.expire_all()
+    assert (dollars.price_ars_normalized, pesos.price_ars_normalized) == (10_000 * usd_rate(), 9_000_000)
+
+
+def test_price_sort_compares_currencies_in_pesos(app):
+    make_vehicle(title='USD caro', price=30_000, currency='USD')
+    make_vehicle(title='ARS medio', price=20_000_000, currency='ARS')
+    make_vehicle(title='USD barato', price=8_000, currency='USD')
+
+    titles = [vehicle.title for vehicle in Vehicle.query.order_by(*SORT_ORDERS['price_asc'])]
+
+    assert titles == ['USD barato', 'ARS medio', 'USD caro']
+
+
+def test_admin_sets_the_rate_with_local_number_format(admin_client):
+    response = admin_client.post('/admin/tipo-de-cambio', data={'usd_rate': '1.250,5'})
+
+    assert response.status_code == 302
+    assert usd_rate() == 1_250.5
+    assert admin_client.post('/admin/tipo-de-cambio', data={'usd_rate': 'abc'}).status_code == 302
+    assert usd_rate() == 1_250.5
@@ -0,0 +1,117 @@
+import pytest
+
+import rate_limit
+from conftest import make_vehicle
+from rate_limit import MemoryBuckets, SQLiteBuckets
+
+
+class Clock:
+    """Stands in for the ``time`` module of rate_limit"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def buckets(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBuckets()
+    return SQLiteBuckets(str(tmp_path / 'rate_limits.sqlite3'))
+
+
+def test_burst_then_wait_until_refilled(buckets, clock):
+    # 1 token per second, bursts of 3
+    assert [buckets.take('ip', rate=1.0, burst=3) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('ip', rate=1.0, burst=3) == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert buckets.take('ip', rate=1.0, burst=3) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert buckets.take('ip', rate=1.0, burst=3) == 0
+
+
+def test_refill_is_capped_at_the_burst(buckets, clock):
+    buckets.take('ip', rate=1.0, burst=2)
+    clock.now += 3600
+
+    assert [buckets.take('ip', rate=1.0, burst=2) for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+
+
+def test_keys_have_separate_buckets(buckets, clock):
+    buckets.take('a', rate=1.0, burst=1)
+
+    assert buckets.take('a', rate=1.0, burst=1) > 0
+    assert buckets.take('b', rate=1.0, burst=1) == 0
+
+
+def test_sqlite_buckets_are_shared_between_workers(tmp_path, clock):
+    path = str(tmp_path / 'rate_limits.sqlite3')
+    first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+
+    assert first.take('ip', rate=1.0, burst=1, name='track_click') == 0
+    assert second.take('ip', rate=1.0, burst=1, name='track_click') > 0
+    assert first.totals() == {'track_click.allowed': 1, 'track_click.limited': 1}
+
+
+def test_memory_buckets_drop_the_least_recently_used(clock):
+    buckets = MemoryBuckets(max_buckets=2)
+    for key in ('a', 'b', 'c'):
+        buckets.take(key, rate=1.0, burst=1)
+
+    # 'a' was dropped, so it starts again with a full bucket
+    assert buckets.take('a', rate=1.0, burst=1) == 0
+    assert buckets.take('c', rate=1.0, burst=1) > 0
+
+
+@pytest.fixture
+def config(config):
+    config['RATE_LIMIT_ENABLED'] = True
+    config['RATE_LIMITS'] = {'track_click': (2, 60, 2), 'price_estimate': (1, 60, 1)}
+    return config
+
+
+def test_requests_over_the_limit_get_429_with_retry_after(client):
+    vehicle = make_vehicle()
+    url = f'/track_click/{vehicle.id}/whatsapp'
+
+    assert [client.get(url).status_code for _ in range(2)] == [302, 302]
+    limited = client.get(url)
+
+    assert limited.status_code == 429
+    assert 1 <= int(limited.headers['Retry-After']) <= 30
+    # Another client, as seen through the trusted proxy, has its own bucket
+    assert client.get(url, headers={'X-Forwarded-For': '203.0.113.7'}).status_code == 302
+
+
+def test_api_routes_get_a_json_429(client):
+    url = '/api/precio-sugerido?anio=2018&moneda=ARS&marca=Toyota'
+    client.get(url)
+
+    limited = client.get(url)
+
+    assert limited.status_code == 429
+    assert limited.get_json()['success'] is False
+
+
+def test_logged_in_admins_are_limited_apart_from_their_ip(client, admin_client):
+    vehicle = make_vehicle()
+    url = f'/track_click/{vehicle.id}/whatsapp'
+    anonymous = client.application.test_client()
+    for _ in range(2):
+        anonymous.get(url)
+    assert anonymous.get(url).status_code == 429
+
+    assert admin_client.get(url).status_code == 302
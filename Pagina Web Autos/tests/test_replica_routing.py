@@ -0,0 +1,136 @@
+"""Primary/replica routing against PostgreSQL (``TEST_POSTGRESQL_URL`` or pytest-postgresql).
+
+The replica is a second database with the primary's schema, read-only like
+a hot standby, holding different rows so each test can tell which answered.
+"""
+import os
+import shutil
+import uuid
+
+import pytest
+from flask import g
+from sqlalchemy import create_engine, text, update
+from sqlalchemy.engine import make_url
+
+import db_routing
+from conftest import make_vehicle
+from db_routing import REPLICA_BIND
+from models import db, Vehicle, VehicleView
+
+
+def primary_vehicle(**values):
+    """Id of a vehicle only the primary has (the test's requests share its session: start them empty)"""
+    vehicle_id = make_vehicle(**values).id
+    db.session.expunge_all()
+    return vehicle_id
+
+
+@pytest.fixture(scope='module')
+def server_url(request):
+    url = os.environ.get('TEST_POSTGRESQL_URL')
+    if url:
+        return make_url(url)
+    postgresql_config = pytest.importorskip('pytest_postgresql.config')
+    if not shutil.which(postgresql_config.get_config(request).exec):
+        pytest.skip('No PostgreSQL server: set TEST_POSTGRESQL_URL or put pg_ctl on PATH')
+    server = request.getfixturevalue('postgresql_proc')
+    return make_url(f"postgresql+psycopg2://{server.user}@{server.host}:{server.port}/postgres").set(
+        password=server.password or None)
+
+
+@pytest.fixture
+def databases(server_url):
+    """URLs of a fresh primary and replica database, dropped afterwards"""
+    suffix = uuid.uuid4().hex[:8]
+    names = {'primary': f'autos_primary_{suffix}', 'replica': f'autos_replica_{suffix}'}
+    admin = create_engine(server_url, isolation_level='AUTOCOMMIT')
+    with admin.connect() as connection:
+        for name in names.values():
+            connection.execute(text(f"CREATE DATABASE {name} ENCODING 'UTF8' TEMPLATE template0"))
+    yield {role: server_url.set(database=name).render_as_string(hide_password=False)
+           for role, name in names.items()}
+    with admin.connect() as connection:
+        for name in names.values():
+            connection.execute(text(f'DROP DATABASE IF EXISTS {name} WITH (FORCE)'))
+    admin.dispose()
+
+
+@pytest.fixture
+def config(config, databases):
+    config['SQLALCHEMY_DATABASE_URI'] = databases['primary']
+    config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: {'url': databases['replica']}}
+    db_routing._replica_down_until.clear()
+    yield config
+    db_routing._replica_down_until.clear()
+
+
+@pytest.fixture
+def replica_vehicle(app, databases):
+    """Id of a vehicle only the replica has; the replica is read-only afterwards"""
+    engine = db.engines[REPLICA_BIND]
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Vehicle.__table__.insert(), {
+            'id': 1000, 'title': 'Solo en la réplica', 'description': 'Único dueño', 'price': 9_000_000, 'currency': 'ARS', 'year': 2018,
+            'brand': 'Toyota', 'images': '[]', 'whatsapp_number': '+5492604000000', 'is_active': True})
+        connection.execute(text(f"ALTER DATABASE {make_url(databases['replica']).database} "
+                                "SET default_transaction_read_only = on"))
+    engine.dispose()
+    return 1000
+
+
+def test_read_only_views_read_from_the_replica(client, replica_vehicle):
+    primary_only = primary_vehicle(title='Solo en el primario')
+
+    assert 'Solo en la réplica' in client.get(f'/vehicle/{replica_vehicle}').get_data(as_text=True)
+    assert client.get(f'/vehicle/{primary_only}').status_code == 404
+    # The view row recorded by the page went to the primary
+    assert VehicleView.query.filter_by(vehicle_id=replica_vehicle).count() == 1
+
+
+def test_writes_and_other_views_use_the_primary(admin_client, replica_vehicle):
+    vehicle = primary_vehicle(title='Solo en el primario')
+
+    assert admin_client.get(f'/admin/toggle-vehicle/{vehicle}').status_code == 302
+    assert admin_client.get(f'/admin/toggle-vehicle/{replica_vehicle}').status_code == 404
+
+    db.session.expire_all()
+    assert db.session.get(Vehicle, vehicle).is_active is False
+
+
+def test_reads_after_a_write_in_the_same_request_use_the_primary(app, replica_vehicle):
+    vehicle = primary_vehicle(title='Recién publicado')
+
+    with app.test_request_context():
+        g.db_read_only = True
+        assert db.session.get(Vehicle, vehicle) is None
+        db.session.execute(update(Vehicle).where(Vehicle.id == vehicle).values(title='Editado'))
+        assert db.session.get(Vehicle, vehicle).title == 'Editado'
+        db.session.rollback()
+
+
+def test_client_reads_its_own_writes_while_the_replica_lags(admin_client, replica_vehicle):
+    vehicle = primary_vehicle(title='Recién editado', is_active=False)
+
+    admin_client.get(f'/admin/toggle-vehicle/{vehicle}')
+    db.session.expunge_all()
+
+    # The replica has not caught up: the listing only exists on the primary
+    assert admin_client.get(f'/vehicle/{vehicle}').status_code == 200
+    db.session.expunge_all()
+    with admin_client.session_transaction() as session:
+        session['db_primary_until'] = 0
+    assert admin_client.get(f'/vehicle/{vehicle}').status_code == 404
+
+
+def test_replica_failure_retries_the_view_on_the_primary(config, databases, request):
+    config['SQLALCHEMY_BINDS'][REPLICA_BIND]['url'] = make_url(databases['replica']).set(port=1)
+    client = request.getfixturevalue('client')
+    vehicle = primary_vehicle(title='Solo en el primario')
+
+    response = client.get(f'/vehicle/{vehicle}')
+
+    assert 'Solo en el primario' in response.get_data(as_text=True)
+    assert not db_routing.replica_available(db.engines)
+    # While the replica is out of rotation the view goes straight to the primary
+    assert client.get(f'/vehicle/{vehicle}').status_code == 200
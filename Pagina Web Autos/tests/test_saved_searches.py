@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import make_vehicle
+from models import db, AlertNotification, SavedSearchTerm
+from saved_searches import (MAX_ATTEMPTS, deliver_pending, matching_searches, normalize_phone, parse_filters,
+                            queue_alerts, reindex_brand_terms, save_search)
+
+
+class RecordingSender:
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    def send(self, to, body):
+        if self.error:
+            raise self.error
+        self.sent.append((to, body))
+
+
+@pytest.fixture
+def request_context(app):
+    with app.test_request_context():
+        yield
+
+
+def test_parse_filters_and_phone():
+    assert parse_filters({'brand': 'Toyota', 'price_max': '9000', 'year_min': 'x', 'radius_km': '50'}) == \
+        {'brand': 'Toyota', 'price_max': 9000}
+    assert normalize_phone('+54 9 260 411-1111') == '+5492604111111'
+    assert normalize_phone('hola') is None
+
+
+def test_matching_searches_apply_terms_and_ranges(app):
+    toyota = save_search('+5492604111111', {'brand': 'Toyota', 'price_max': 25_000_000})
+    save_search('+5492604111112', {'brand': 'Toyota', 'price_max': 10_000_000})
+    save_search('+5492604111113', {'fuel_type': 'Diesel'})
+    anything = save_search('+5492604111114', {'search': 'corolla'})
+
+    vehicle = make_vehicle(price_ars_normalized=20_000_000)
+
+    assert {saved.id for saved in matching_searches(vehicle)} == {toyota.id, anything.id}
+
+def test_partial_brands_match_like_the_listing_page(app, client):
+    partial = save_search('+5492604111111', {'brand': 'toyo'})
+    save_search('+5492604111112', {'brand': 'Ford'})
+    vehicle = make_vehicle(title='Toyota Etios', brand='Toyota')
+
+    assert 'Toyota Etios' in client.get('/?brand=toyo').get_data(as_text=True)
+    assert [saved.id for saved in matching_searches(vehicle)] == [partial.id]
+
+
+def test_reindex_drops_brand_terms_of_older_searches(app):
+    brand_only = save_search('+5492604111111', {'brand': 'Toyo'})
+    with_fuel = save_search('+5492604111112', {'brand': 'Toyo', 'fuel_type': 'Nafta'})
+    # Indexed the way brands used to be
+    for saved in (brand_only, with_fuel):
+        saved.terms = ([term for term in saved.terms if term.field != '*']
+                       + [SavedSearchTerm(field='brand', value='toyo')])
+        saved.term_count = len({term.field for term in saved.terms})
+    db.session.commit()
+
+    assert reindex_brand_terms() == 2
+    assert reindex_brand_terms() == 0
+    assert {saved.id for saved in matching_searches(make_vehicle(brand='Toyota'))} == {brand_only.id, with_fuel.id}
+
+
+def test_saving_the_same_search_twice_returns_the_existing_one(app):
+    first = save_search('+5492604111111', {'brand': 'Ford'})
+    assert save_search('+5492604111111', {'brand': 'Ford'}).id == first.id
+
+
+def test_queued_alerts_are_delivered_once(app, request_context):
+    save_search('+5492604111111', {'brand': 'Toyota'})
+    vehicle = make_vehicle(price_ars_normalized=20_000_000)
+
+    assert queue_alerts(vehicle) == 1
+    sender = RecordingSender()
+    assert deliver_pending(sender) == {'sent': 1, 'failed': 0, 'retry': 0}
+    assert deliver_pending(sender) == {'sent': 0, 'failed': 0, 'retry': 0}
+    assert [to for to, _ in sender.sent] == ['+5492604111111']
+    assert AlertNotification.query.one().status == 'sent'
+
+
+def test_failed_sends_are_retried_then_marked_failed(app, request_context):
+    save_search('+5492604111111', {'brand': 'Toyota'})
+    queue_alerts(make_vehicle())
+    sender = RecordingSender(error=RuntimeError('boom'))
+
+    for _ in range(MAX_ATTEMPTS - 1):
+        assert deliver_pending(sender)['retry'] == 1
+    assert deliver_pending(sender)['failed'] == 1
+    notification = AlertNotification.query.one()
+    assert (notification.status, notification.attempts, notification.error) == ('failed', MAX_ATTEMPTS, 'boom')
+
+
+def test_stale_claims_are_requeued_and_eventually_failed(app, request_context):
+    save_search('+5492604111111', {'brand': 'Toyota'})
+    save_search('+5492604111112', {'brand': 'Toyota', 'year_min': 2010})
+    queue_alerts(make_vehicle())
+    stuck, exhausted = AlertNotification.query.order_by(AlertNotification.id).all()
+    # Claimed by workers that died before sending
+    stuck.status, stuck.attempts, stuck.claimed_at = 'sending', 1, datetime.utcnow() - timedelta(hours=1)
+    exhausted.status, exhausted.attempts, exhausted.claimed_at = 'sending', MAX_ATTEMPTS, None
+    db.session.commit()
+
+    sender = RecordingSender()
+    report = deliver_pending(sender)
+
+    assert report == {'sent': 1, 'failed': 1, 'retry': 1}
+    db.session.expire_all()
+    assert (stuck.status, stuck.attempts) == ('sent', 2)
+    assert exhausted.status == 'failed'
+    assert [to for to, _ in sender.sent] == ['+5492604111111']
+
+
+def test_recent_claims_are_left_alone(app, request_context):
+    save_search('+5492604111111', {'brand': 'Toyota'})
+    queue_alerts(make_vehicle())
+    notification = AlertNotification.query.one()
+    notification.status, notification.attempts, notification.claimed_at = 'sending', 1, datetime.utcnow()
+    db.session.commit()
+
+    assert deliver_pending(RecordingSender()) == {'sent': 0, 'failed': 0, 'retry': 0}
+    db.session.expire_all()
+    assert notification.status == 'sending'
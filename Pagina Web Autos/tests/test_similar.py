@@ -0,0 +1,113 @@
+import threading
+import time
+
+from conftest import make_vehicle
+from models import db
+from similar import SimilarVehiclesIndex, similar_vehicles
+
+
+def test_similar_vehicles_are_closest_first(app):
+    corolla = make_vehicle(year=2018, kilometers=80_000, price_ars_normalized=20_000_000)
+    close = make_vehicle(year=2017, kilometers=90_000, price_ars_normalized=19_000_000)
+    far = make_vehicle(year=2005, kilometers=250_000, price_ars_normalized=5_000_000)
+    other_brand = make_vehicle(brand='Ford', model='Ka', year=2018, kilometers=80_000, price_ars_normalized=20_000_000)
+    make_vehicle(is_active=False, year=2018, kilometers=80_000, price_ars_normalized=20_000_000)
+    app.extensions['similar_vehicles'].build()
+
+    assert [vehicle.id for vehicle in similar_vehicles(corolla)] == [close.id, other_brand.id, far.id]
+
+
+def test_committed_changes_are_applied_incrementally(app):
+    corolla = make_vehicle(price_ars_normalized=20_000_000)
+    twin = make_vehicle(price_ars_normalized=20_000_000)
+    assert [vehicle.id for vehicle in similar_vehicles(corolla)] == [twin.id]
+
+    twin.is_active = False
+    db.session.commit()
+
+    assert similar_vehicles(corolla) == []
+
+
+def test_lookups_do_not_wait_for_the_first_build(app, monkeypatch):
+    make_vehicle()
+    vehicle = make_vehicle()
+    index = SimilarVehiclesIndex()
+    building = threading.Event()
+    release = threading.Event()
+    load = SimilarVehiclesIndex._load
+
+    def slow_load(self, rows):
+        building.set()
+        release.wait(5)
+        load(self, rows)
+
+    monkeypatch.setattr(SimilarVehiclesIndex, '_load', slow_load)
+    index.ensure_started()
+    assert building.wait(5)
+
+    started = time.perf_counter()
+    assert index.similar_ids(vehicle.id) == []
+    assert time.perf_counter() - started < 1
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while not index.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(index.similar_ids(vehicle.id)) == 1
+
+
+def test_invalidate_keeps_serving_the_previous_build(app):
+    corolla = make_vehicle()
+    twin = make_vehicle()
+    index = app.extensions['similar_vehicles']
+    assert index.similar_ids(corolla.id) == [twin.id]
+
+    index.invalidate()
+    index._builder_pid = -1  # no background rebuild: the old contents must stay in use
+
+    assert index.similar_ids(corolla.id) == [twin.id]
+    index.build()
+    assert not index._stale
+
+
+def test_database_is_queried_without_the_lookup_lock(app, monkeypatch):
+    corolla = make_vehicle()
+    index = app.extensions['similar_vehicles']
+    index.refresh_seconds = 0
+    locked = []
+    fetch = SimilarVehiclesIndex._fetch
+
+    def checked_fetch(self, kind, query):
+        locked.append(self._lock.locked())
+        return fetch(self, kind, query)
+
+    monkeypatch.setattr(SimilarVehiclesIndex, '_fetch', checked_fetch)
+    twin = make_vehicle()
+
+    assert index.similar_ids(corolla.id) == [twin.id]
+    assert locked and not any(locked)
+
+
+def test_failed_build_is_retried_after_a_pause(app, monkeypatch):
+    make_vehicle()
+    index = SimilarVehiclesIndex()
+    attempts = []
+
+    def failing_load(self, rows):
+        attempts.append(True)
+        raise RuntimeError('database down')
+
+    def attempt():
+        index.ensure_started()
+        deadline = time.monotonic() + 5
+        while index._builder_pid is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    monkeypatch.setattr(SimilarVehiclesIndex, '_load', failing_load)
+    attempt()
+    attempt()
+    assert len(attempts) == 1 and index._stale
+
+    index._next_attempt = time.monotonic()  # the pause is over
+    attempt()
+    assert len(attempts) == 2
@@ -0,0 +1,109 @@
+import io
+import time
+from datetime import timedelta
+
+import pytest
+
+from conftest import make_vehicle
+from storage import CACHE_CONTROL, LocalStorage, S3Storage, get_storage, upload_url
+from upload_gc import reconcile_uploads
+
+BUCKET = 'autos-test'
+
+
+@pytest.fixture(params=['local', 's3'])
+def config(request, config, monkeypatch):
+    """Run every test against the local folder and a moto-backed bucket"""
+    if request.param == 's3':
+        moto = pytest.importorskip('moto')
+        boto3 = pytest.importorskip('boto3')
+        for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                            ('AWS_DEFAULT_REGION', 'us-east-1')):
+            monkeypatch.setenv(name, value)
+        mock = moto.mock_aws()
+        mock.start()
+        request.addfinalizer(mock.stop)
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        config.update(UPLOAD_STORAGE='s3', S3_BUCKET=BUCKET, S3_REGION='us-east-1')
+    return config
+
+
+@pytest.fixture
+def storage(app):
+    return get_storage()
+
+
+def stored_names(storage):
+    return sorted(stored.name for stored in storage.iter_files())
+
+
+def test_save_then_open_returns_the_bytes(storage):
+    storage.save(io.BytesIO(b'jpeg bytes'), 'car.jpg', content_type='image/jpeg')
+
+    with storage.open('car.jpg') as stored:
+        assert stored.read() == b'jpeg bytes'
+    if isinstance(storage, S3Storage):
+        head = storage.client.head_object(Bucket=BUCKET, Key='uploads/car.jpg')
+        assert (head['ContentType'], head['CacheControl']) == ('image/jpeg', CACHE_CONTROL)
+
+
+def test_iter_files_lists_saved_uploads_with_size_and_mtime(storage):
+    before = time.time() - 60
+    storage.save(io.BytesIO(b'12345'), 'first.jpg')
+    storage.save(io.BytesIO(b'123'), 'second.webp')
+
+    files = {stored.name: stored for stored in storage.iter_files()}
+
+    assert sorted(files) == ['first.jpg', 'second.webp']
+    assert files['first.jpg'].size == 5 and files['second.webp'].size == 3
+    assert all(before < stored.mtime <= time.time() + 60 for stored in files.values())
+
+
+def test_iter_files_skips_entries_outside_the_uploads(storage, app):
+    storage.save(io.BytesIO(b'x'), 'car.jpg')
+    if isinstance(storage, S3Storage):
+        storage.client.put_object(Bucket=BUCKET, Key='backups/app.sqlite3', Body=b'x')
+        storage.client.put_object(Bucket=BUCKET, Key='uploads/thumbs/car.jpg', Body=b'x')
+    else:
+        with open(f"{app.config['UPLOAD_FOLDER']}/.tmp-upload", 'wb') as hidden:
+            hidden.write(b'x')
+
+    assert stored_names(storage) == ['car.jpg']
+
+
+def test_delete_removes_the_file_and_ignores_missing_ones(storage):
+    storage.save(io.BytesIO(b'x'), 'car.jpg')
+
+    storage.delete('car.jpg')
+    storage.delete('never-uploaded.jpg')
+
+    assert stored_names(storage) == []
+
+
+def test_names_are_reduced_to_their_basename(storage):
+    storage.save(io.BytesIO(b'x'), '../../etc/car.jpg')
+
+    assert stored_names(storage) == ['car.jpg']
+
+
+def test_upload_url(storage, app):
+    with app.test_request_context():
+        url = upload_url('uploads/car.jpg')
+        assert upload_url('https://example.com/car.jpg') == 'https://example.com/car.jpg'
+
+    if isinstance(storage, LocalStorage):
+        assert url == '/static/uploads/car.jpg'
+    else:
+        assert url == f'https://{BUCKET}.s3.amazonaws.com/uploads/car.jpg'
+
+
+def test_reconcile_deletes_orphans_from_the_backend(storage):
+    make_vehicle(images='["uploads/kept.jpg"]')
+    for name in ('kept.jpg', 'orphan.jpg'):
+        storage.save(io.BytesIO(b'x'), name)
+
+    # A negative grace period counts the files just saved as old enough to go
+    report = reconcile_uploads(timedelta(minutes=-1), dry_run=False)
+
+    assert report['deleted'] == 1
+    assert stored_names(storage) == ['kept.jpg']
@@ -0,0 +1,58 @@
+import os
+from datetime import timedelta
+
+from conftest import make_request, make_vehicle, write_upload
+from models import db, ClientRequest
+from upload_gc import reconcile_uploads
+
+DAY = 24 * 3600
+
+
+def test_reconcile_keeps_referenced_and_recent_files(app):
+    make_vehicle(images='["uploads/car.jpg"]')
+    make_request(images=['uploads/client_car.jpg'])
+    for name in ('car.jpg', 'client_car.jpg', 'orphan.jpg'):
+        write_upload(app, name, age_seconds=2 * DAY)
+    write_upload(app, 'just_uploaded.jpg')
+
+    report = reconcile_uploads(timedelta(hours=24), dry_run=False)
+
+    assert report['referenced'] == 2
+    assert report['recent'] == 1
+    assert report['deleted'] == 1
+    assert sorted(os.listdir(app.config['UPLOAD_FOLDER'])) == ['car.jpg', 'client_car.jpg', 'just_uploaded.jpg']
+
+
+def test_dry_run_deletes_nothing(app):
+    path = write_upload(app, 'orphan.jpg', data=b'x' * 10, age_seconds=2 * DAY)
+
+    report = reconcile_uploads(timedelta(hours=24), dry_run=True)
+
+    assert report['orphaned'] == 1
+    assert report['reclaimable_bytes'] == 10
+    assert report['deleted'] == 0
+    assert os.path.exists(path)
+
+
+def test_rejected_request_photos_are_reclaimed_after_the_grace_period(app, admin_client):
+    client_request = make_request(images=['uploads/client_rejected.jpg'])
+    path = write_upload(app, 'client_rejected.jpg', age_seconds=2 * DAY)
+
+    response = admin_client.get(f'/admin/procesar-solicitud/{client_request.id}/reject')
+
+    assert response.status_code == 302
+    db.session.expire_all()
+    client_request = db.session.get(ClientRequest, client_request.id)
+    assert client_request.status == 'rejected'
+    assert client_request.processed_at is not None
+
+    # Still within the grace period: the photos stay in case the rejection is undone
+    assert reconcile_uploads(timedelta(hours=24), dry_run=False)['deleted'] == 0
+    assert os.path.exists(path)
+
+    client_request.processed_at -= timedelta(hours=25)
+    db.session.commit()
+    report = reconcile_uploads(timedelta(hours=24), dry_run=False)
+
+    assert report['deleted'] == 1
+    assert not os.path.exists(path)
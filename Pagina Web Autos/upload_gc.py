@@ -0,0 +1,139 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select
+
+from listing_images import image_paths
+from models import db, ClientRequest, Vehicle
+from storage import UPLOAD_PREFIX, get_storage
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip while collecting referenced paths
+CHUNK_SIZE = 1000
+
+# Stored files checked between short pauses, so a sweep never hogs the disk
+SCAN_BATCH = 500
+
+
+def referenced_names(grace):
+    """Names of the upload files referenced by vehicles and requests.
+
+    Both tables are read in one streaming pass through server-side cursors.
+    Requests rejected more than ``grace`` ago no longer protect their photos,
+    unless a vehicle still uses them.
+    """
+    rejected_before = datetime.utcnow() - grace
+    statements = (
+        select(Vehicle.images).where(Vehicle.images.isnot(None)),
+        select(ClientRequest.images).where(
+            ClientRequest.images.isnot(None),
+            or_(ClientRequest.status != 'rejected', ClientRequest.processed_at.is_(None),
+                ClientRequest.processed_at > rejected_before),
+        ),
+    )
+    names = set()
+    for statement in statements:
+        for images in db.session.execute(statement.execution_options(yield_per=CHUNK_SIZE)).scalars():
+            names.update(path[len(UPLOAD_PREFIX):] for path in image_paths(images) if path.startswith(UPLOAD_PREFIX))
+    return names
+
+
+def reconcile_uploads(grace=timedelta(hours=24), dry_run=True, pause=0.0):
+    """Delete upload files no row references and that are older than ``grace``.
+
+    The set of referenced names is built first and the storage is then
+    listed entry by entry, so files uploaded during the sweep are always
+    younger than the grace period and never touched. With ``dry_run`` nothing
+    is deleted and the report only says what would be reclaimed.
+    """
+    started = time.perf_counter()
+    storage = get_storage()
+    referenced = referenced_names(grace)
+    cutoff = time.time() - grace.total_seconds()
+    report = {'scanned': 0, 'referenced': 0, 'recent': 0, 'orphaned': 0,
+              'reclaimable_bytes': 0, 'deleted': 0, 'dry_run': dry_run}
+    for stored in storage.iter_files():
+        report['scanned'] += 1
+        if pause and report['scanned'] % SCAN_BATCH == 0:
+            time.sleep(pause)
+        if stored.name in referenced:
+            report['referenced'] += 1
+            continue
+        if stored.mtime > cutoff:
+            report['recent'] += 1
+            continue
+        report['orphaned'] += 1
+        report['reclaimable_bytes'] += stored.size
+        if dry_run:
+            continue
+        try:
+            storage.delete(stored.name)
+            report['deleted'] += 1
+        except Exception as e:
+            logger.warning("Error deleting orphaned upload %s: %s", stored.name, e, extra={'upload': stored.name})
+    report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info("Upload reconciliation finished", extra=report)
+    return report
+
+
+class UploadReconciler:
+    """Background thread that periodically deletes orphaned uploads.
+
+    One thread runs per worker process, started on its first request so it
+    survives ``gunicorn --preload``. A lock file makes the workers take turns,
+    so only one of them sweeps the storage at a time.
+    """
+
+    def __init__(self, app, interval, grace, dry_run):
+        self.app = app
+        self.interval = interval
+        self.grace = grace
+        self.dry_run = dry_run
+        self._pid = None
+        self._guard = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._guard:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='upload-reconciler', daemon=True).start()
+
+    def _run(self):
+        lock_path = os.path.join(self.app.instance_path, 'upload_gc.lock')
+        os.makedirs(self.app.instance_path, exist_ok=True)
+        while True:
+            time.sleep(self.interval)
+            try:
+                with open(lock_path, 'w') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # another worker is sweeping
+                    with self.app.app_context():
+                        try:
+                            reconcile_uploads(self.grace, dry_run=self.dry_run, pause=0.01)
+                        finally:
+                            db.session.remove()
+            except Exception:
+                logger.exception("Upload reconciliation failed")
+
+
+def init_app(app):
+    interval = app.config.get('UPLOAD_GC_INTERVAL_SECONDS', 0)
+    if not interval:
+        return
+    reconciler = UploadReconciler(
+        app, interval,
+        grace=timedelta(hours=app.config.get('UPLOAD_GC_GRACE_HOURS', 24)),
+        dry_run=app.config.get('UPLOAD_GC_DRY_RUN', False),
+    )
+    app.extensions['upload_reconciler'] = reconciler
+    app.before_request(reconciler.ensure_started)